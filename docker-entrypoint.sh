@@ -0,0 +1,18 @@
+#!/bin/sh
+# Start the shared inference worker pool, wait until its workers have loaded
+# the model, then start the API workers, which send it their frames instead
+# of each loading a copy. With INFERENCE_POOL_ADDRESS empty, every API worker
+# loads its own model and no pool is started.
+set -e
+
+if [ -n "$INFERENCE_POOL_ADDRESS" ]; then
+    python -m app.workers --address "$INFERENCE_POOL_ADDRESS" &
+    pool=$!
+    while [ ! -S "$INFERENCE_POOL_ADDRESS" ]; do
+        kill -0 "$pool" 2>/dev/null || { echo "Inference pool failed to start" >&2; exit 1; }
+        sleep 0.5
+    done
+fi
+
+# gunicorn takes its worker count from WEB_CONCURRENCY
+exec gunicorn -k uvicorn.workers.UvicornWorker app.main:app --bind "0.0.0.0:${PORT:-8000}" "$@"
@@ -0,0 +1,362 @@
+"""
+Approximate nearest-neighbour index for the identification gallery.
+
+`IVFIndex` is an inverted-file index: a spherical k-means step picks `nlist`
+coarse centroids, each user is filed under its nearest centroid, and a query
+only scans the `nprobe` lists whose centroids are closest to it. Raising
+`nprobe` trades latency for recall; `nprobe == nlist` is an exact search.
+
+Run `python -m app.ann build` to write a snapshot from the database so
+restarted workers can restore the index instead of rebuilding it.
+"""
+import argparse
+import heapq
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from .db import crud
+from .gallery import EmbeddingMatrix, active_user_ids, normalize
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# Users created or deactivated shortly before a snapshot was written (or a
+# sync ran) may not have reached the index yet, so the next replay starts a
+# bit earlier.
+SNAPSHOT_SYNC_MARGIN = timedelta(seconds=60)
+
+
+def spherical_kmeans(vectors: np.ndarray, nlist: int, iterations: int = 10,
+                     seed: int = 0, chunk_size: int = 65536) -> np.ndarray:
+    """Cluster unit vectors by cosine similarity and return unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    count = vectors.shape[0]
+    nlist = min(nlist, count)
+    centroids = vectors[rng.choice(count, nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = assign_to_centroids(vectors, centroids, chunk_size)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        sizes = np.bincount(assignment, minlength=nlist)
+
+        # Re-seed empty clusters with random points so no list goes unused
+        empty = np.flatnonzero(sizes == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(count, len(empty), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+
+def assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """Index of the most similar centroid for every row, computed in chunks."""
+    assignment = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], chunk_size):
+        block = vectors[start:start + chunk_size] @ centroids.T
+        assignment[start:start + chunk_size] = np.argmax(block, axis=1)
+    return assignment
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate index with the same interface as `EmbeddingGallery`.
+
+    Below `min_train_size` vectors the index stays untrained and every query
+    is an exact scan of a single list.
+    """
+
+    def __init__(self, nlist: int = 1024, nprobe: int = 16, train_size: int = 50000,
+                 kmeans_iterations: int = 10, min_train_size: Optional[int] = None,
+                 snapshot_path: Optional[str] = None):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.kmeans_iterations = kmeans_iterations
+        # k-means needs a few dozen points per centroid to give useful lists
+        self.min_train_size = min_train_size if min_train_size is not None else nlist * 39
+        self.snapshot_path = snapshot_path
+        self._lock = threading.RLock()
+        self._reset()
+        self.synced_at: Optional[datetime] = None
+        # Value of the shared invalidation counter at the last load or sync
+        self.generation = 0
+        self._loaded = False
+
+    def _reset(self):
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: List[EmbeddingMatrix] = [EmbeddingMatrix()]
+        self._assignment: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._assignment)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._assignment
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def list_count(self) -> int:
+        return len(self._lists)
+
+    # Building
+
+    def _all_entries(self) -> Tuple[List[str], np.ndarray]:
+        ids: List[str] = []
+        blocks = []
+        for entries in self._lists:
+            if len(entries):
+                ids.extend(entries.ids)
+                blocks.append(entries.vectors)
+        if not blocks:
+            return ids, np.empty((0, 0), dtype=np.float32)
+        return ids, np.concatenate(blocks)
+
+    def _fill(self, ids: List[str], vectors: np.ndarray, centroids: Optional[np.ndarray]):
+        """Replace the index contents, filing every vector under its centroid."""
+        self.centroids = centroids
+        self._assignment = {}
+        if centroids is None:
+            self._lists = [EmbeddingMatrix()]
+            assignment = np.zeros(len(ids), dtype=np.int64)
+        else:
+            self._lists = [EmbeddingMatrix(initial_capacity=16) for _ in range(len(centroids))]
+            assignment = assign_to_centroids(vectors, centroids) if len(ids) else np.empty(0, dtype=np.int64)
+
+        # Group rows by list so each list is filled with one bulk copy
+        order = np.argsort(assignment, kind="stable")
+        boundaries = np.searchsorted(assignment[order], np.arange(len(self._lists) + 1))
+        for list_no, entries in enumerate(self._lists):
+            rows = order[boundaries[list_no]:boundaries[list_no + 1]]
+            entries.extend([ids[i] for i in rows], vectors[rows])
+        self._assignment = dict(zip(ids, assignment.tolist()))
+
+    def train(self, seed: int = 0):
+        """(Re)train the coarse centroids on a sample of the current contents and refile everything."""
+        with self._lock:
+            ids, vectors = self._all_entries()
+            if len(ids) < max(self.min_train_size, 1):
+                return False
+            rng = np.random.default_rng(seed)
+            sample = vectors
+            if len(ids) > self.train_size:
+                sample = vectors[rng.choice(len(ids), self.train_size, replace=False)]
+            centroids = spherical_kmeans(sample, self.nlist, self.kmeans_iterations, seed=seed)
+            self._fill(ids, vectors, centroids)
+            return True
+
+    def load(self, db: Session, batch_size: int = 1000):
+        """(Re)build the index from all active users in the database."""
+        with self._lock:
+            synced_at = datetime.utcnow()
+            ids: List[str] = []
+            vectors = []
+            for user_id, embedding in crud.get_active_user_embeddings(db, batch_size=batch_size):
+                ids.append(user_id)
+                vectors.append(normalize(embedding))
+            matrix = np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+            self._fill(ids, matrix, None)
+            self.train()
+            self.synced_at = synced_at
+            self._loaded = True
+
+    def ensure_loaded(self, db: Session):
+        """Restore from the snapshot if there is one, otherwise build from the database."""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if self.snapshot_path and os.path.exists(self.snapshot_path):
+                self.restore(self.snapshot_path)
+                self.sync(db)
+                self._loaded = True
+            else:
+                self.load(db)
+                if self.snapshot_path:
+                    self.save(self.snapshot_path)
+
+    def ensure_current(self, db: Session, generation: int):
+        """Load on first use, or resync once the shared invalidation counter has moved."""
+        if self._loaded and generation == self.generation:
+            return
+        with self._lock:
+            if not self._loaded:
+                self.ensure_loaded(db)
+            elif generation != self.generation:
+                self.sync(db)
+            self.generation = generation
+
+    def sync(self, db: Session, since: Optional[datetime] = None):
+        """
+        Replay users created or deactivated since `since` (default: shortly
+        before the last sync), and drop users deleted outright, which leave no
+        row to replay.
+        """
+        with self._lock:
+            synced_at = datetime.utcnow()
+            for user_id, embedding, is_active in crud.get_users_updated_since(db, since or self.synced_at - SNAPSHOT_SYNC_MARGIN):
+                if is_active:
+                    self._add(user_id, normalize(embedding))
+                else:
+                    self._remove(user_id)
+            if len(self) > crud.count_active_users(db):
+                active = active_user_ids(db)
+                for user_id in [user_id for user_id in self._assignment if user_id not in active]:
+                    self._remove(user_id)
+            self.synced_at = synced_at
+
+    # Incremental updates
+
+    def _add(self, user_id: str, vector: np.ndarray):
+        list_no = 0
+        if self.centroids is not None:
+            list_no = int(np.argmax(self.centroids @ vector))
+        previous = self._assignment.get(user_id)
+        if previous is not None and previous != list_no:
+            self._lists[previous].remove(user_id)
+        self._lists[list_no].add(user_id, vector)
+        self._assignment[user_id] = list_no
+
+    def _remove(self, user_id: str) -> bool:
+        list_no = self._assignment.pop(user_id, None)
+        if list_no is None:
+            return False
+        return self._lists[list_no].remove(user_id)
+
+    def add(self, user_id: str, embedding: np.ndarray):
+        """Insert or replace a user's embedding into its nearest list."""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._add(user_id, normalize(embedding))
+            # The first time the gallery is big enough, switch from exact to IVF
+            if self.centroids is None and len(self) >= self.min_train_size:
+                self.train()
+
+    def remove(self, user_id: str) -> bool:
+        """Remove a user from the index."""
+        with self._lock:
+            return self._remove(user_id)
+
+    # Search
+
+    def search(self, embedding: np.ndarray, top_k: int = 5, nprobe: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Return up to `top_k` approximate best matches as (user_id, cosine similarity), best first."""
+        query = normalize(embedding)
+        with self._lock:
+            if self.centroids is None:
+                return self._lists[0].top_k(query, top_k)
+
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            centroid_scores = self.centroids @ query
+            if nprobe < len(centroid_scores):
+                probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            else:
+                probe = np.arange(len(centroid_scores))
+
+            candidates = []
+            for list_no in probe:
+                candidates.extend(self._lists[list_no].top_k(query, top_k))
+            return heapq.nlargest(top_k, candidates, key=lambda candidate: candidate[1])
+
+    # Snapshots
+
+    def save(self, path: Optional[str] = None):
+        """Write the index to an uncompressed `.npz` snapshot, atomically."""
+        path = path or self.snapshot_path
+        with self._lock:
+            synced_at = datetime.utcnow()
+            ids: List[str] = []
+            blocks = []
+            offsets = [0]
+            for entries in self._lists:
+                ids.extend(entries.ids)
+                if len(entries):
+                    blocks.append(entries.vectors)
+                offsets.append(len(ids))
+            vectors = np.concatenate(blocks) if blocks else np.empty((0, 0), dtype=np.float32)
+            centroids = self.centroids if self.centroids is not None else np.empty((0, 0), dtype=np.float32)
+
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    version=np.array(SNAPSHOT_VERSION),
+                    synced_at=np.array(synced_at.isoformat()),
+                    centroids=centroids,
+                    vectors=vectors,
+                    ids=np.array(ids, dtype=np.str_),
+                    offsets=np.array(offsets, dtype=np.int64),
+                )
+            os.replace(tmp_path, path)
+
+    def restore(self, path: Optional[str] = None):
+        """Load the index from a snapshot written by `save`."""
+        path = path or self.snapshot_path
+        with np.load(path, allow_pickle=False) as snapshot:
+            if int(snapshot["version"]) != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported index snapshot version {int(snapshot['version'])}.")
+            centroids = snapshot["centroids"]
+            vectors = snapshot["vectors"]
+            ids = snapshot["ids"].tolist()
+            offsets = snapshot["offsets"]
+            synced_at = datetime.fromisoformat(str(snapshot["synced_at"]))
+
+        with self._lock:
+            self.centroids = centroids if centroids.size else None
+            self._lists = []
+            self._assignment = {}
+            for list_no in range(len(offsets) - 1):
+                start, end = int(offsets[list_no]), int(offsets[list_no + 1])
+                entries = EmbeddingMatrix(initial_capacity=max(end - start, 16))
+                entries.extend(ids[start:end], vectors[start:end])
+                self._lists.append(entries)
+                self._assignment.update(dict.fromkeys(ids[start:end], list_no))
+            self.synced_at = synced_at
+            self._loaded = True
+
+
+def main():
+    from .core.config import settings
+    from .db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Build an IVF index snapshot from the users table.")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--output", default=settings.ANN_SNAPSHOT_PATH or "gallery.ivf.npz")
+    parser.add_argument("--nlist", type=int, default=settings.ANN_NLIST)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    index = IVFIndex(
+        nlist=args.nlist,
+        nprobe=settings.ANN_NPROBE,
+        train_size=settings.ANN_TRAIN_SIZE,
+        kmeans_iterations=settings.ANN_KMEANS_ITERATIONS,
+    )
+    db = SessionLocal()
+    try:
+        index.load(db)
+    finally:
+        db.close()
+    index.save(args.output)
+    logger.info("Wrote %d users in %d lists to %s", len(index), index.list_count, args.output)
+
+
+if __name__ == "__main__":
+    main()
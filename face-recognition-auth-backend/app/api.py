@@ -1,29 +1,183 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+import base64
+import secrets
+import numpy as np
+from fastapi import APIRouter, Depends, Header, HTTPException, status, Request, WebSocket
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from . import schemas, services
-from .db.database import get_db
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
+from . import calibration, export, schemas, services, streaming
+from .db.database import database_stats, get_async_db, get_db
 from .db import crud
+from .audit import audit_writer
+from .embedding_cache import embedding_cache
+from .executor import Overloaded, inference_executor
+from .core.config import settings
+from .blobstore import blob_store, decode_data_url, sniff_media_type
 
 router = APIRouter()
 
-def get_client_info(request: Request):
+def get_client_info(request: Union[Request, WebSocket]):
     """Extract client IP and User-Agent from request."""
     # Try to get real IP from headers (for reverse proxy setups)
     ip_address = request.headers.get("X-Forwarded-For", request.headers.get("X-Real-IP", request.client.host))
     user_agent = request.headers.get("User-Agent")
     return ip_address, user_agent
 
-@router.post("/enroll", response_model=schemas.SuccessResponse)
-def enroll(request: schemas.EnrollRequest, req: Request, db: Session = Depends(get_db)):
+IMAGE_VARIANTS = ("thumbnail", "image")
+
+def image_response(image_ref: Optional[str], image_data: Optional[str] = None,
+                   thumbnail_ref: Optional[str] = None, variant: str = "thumbnail"):
+    """
+    Stream a stored image's bytes, falling back to legacy base64 rows.
+    The 'thumbnail' variant is served when there is one, 'image' is the
+    stored crop (or frame, with IMAGE_STORAGE=frame).
+    """
+    if variant not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"variant must be one of {list(IMAGE_VARIANTS)}")
+    if variant == "thumbnail" and thumbnail_ref:
+        image_ref = thumbnail_ref
+    if image_ref:
+        try:
+            media_type = blob_store.media_type(image_ref)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Image data not found")
+        # Blobs are content-addressed, so a reference always names the same bytes
+        headers = {"ETag": f'"{image_ref}"', "Cache-Control": "private, max-age=86400, immutable"}
+        return StreamingResponse(blob_store.stream(image_ref), media_type=media_type, headers=headers)
+    if image_data:
+        img_bytes = decode_data_url(image_data)
+        return Response(content=img_bytes, media_type=sniff_media_type(img_bytes[:16]))
+    raise HTTPException(status_code=404, detail="Image data not found")
+
+def _too_large():
+    return HTTPException(
+        status_code=413,
+        detail=f"Image exceeds the {settings.MAX_IMAGE_BYTES} byte limit."
+    )
+
+async def read_upload(req: Request, file_field: str) -> Tuple[dict, List[bytes]]:
+    """
+    Read images sent as multipart/form-data (files under `file_field`) or as a
+    raw request body (application/octet-stream or image/*), without base64.
+    Returns the other form fields (or the query parameters) and the image bytes.
+    Bodies over MAX_IMAGE_BYTES are rejected before they are fully read.
+    """
+    content_type = req.headers.get("Content-Type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await req.form()
+        images = []
+        for upload in form.getlist(file_field):
+            if isinstance(upload, str):
+                raise HTTPException(status_code=400, detail=f"'{file_field}' must be a file upload")
+            if upload.size is not None and upload.size > settings.MAX_IMAGE_BYTES:
+                raise _too_large()
+            images.append(await upload.read())
+        fields = {key: value for key, value in form.items() if isinstance(value, str)}
+        return fields, images
+
+    if content_type.startswith(("application/octet-stream", "image/")):
+        declared = req.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > settings.MAX_IMAGE_BYTES:
+            raise _too_large()
+        body = bytearray()
+        async for chunk in req.stream():
+            body.extend(chunk)
+            if len(body) > settings.MAX_IMAGE_BYTES:
+                raise _too_large()
+        return dict(req.query_params), [bytes(body)] if body else []
+
+    raise HTTPException(
+        status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        detail="Send multipart/form-data or a raw application/octet-stream body"
+    )
+
+def too_busy(e: Overloaded):
+    """429 for requests turned away by the inference executor's admission control."""
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(e),
+        headers={"Retry-After": "1"}
+    )
+
+def duplicate_matches(matches: List[Tuple[str, float]]) -> List[dict]:
+    return [{"user_id": user_id, "similarity": round(score, 4)} for user_id, score in matches]
+
+def _required_field(fields: dict, name: str) -> str:
+    value = fields.get(name)
+    if not value:
+        raise HTTPException(status_code=400, detail=f"'{name}' is required")
+    return value
+
+@router.post("/enroll", response_model=schemas.EnrollResponse)
+async def enroll(request: schemas.EnrollRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Enroll a new user with multiple face images.
     Calculates a centroid embedding and stores it.
     """
     try:
         ip_address, user_agent = get_client_info(req)
-        services.enroll_user(db, request.user_id, request.images, ip_address, user_agent)
-        return {"ok": True, "user_id": request.user_id}
+        with inference_executor.admit():
+            matches = await services.enroll_user(db, request.user_id, request.images, ip_address, user_agent)
+        return {"ok": True, "user_id": request.user_id, "duplicates": duplicate_matches(matches)}
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.post("/enroll/upload", response_model=schemas.EnrollResponse)
+async def enroll_upload(req: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Enroll a new user from uploaded image files instead of base64 JSON.
+    Multipart form with `user_id` and one or more `images` files, or a raw
+    image body with `?user_id=`.
+    """
+    fields, images = await read_upload(req, "images")
+    user_id = _required_field(fields, "user_id")
+    if not images:
+        raise HTTPException(status_code=400, detail="At least one image is required")
+    try:
+        ip_address, user_agent = get_client_info(req)
+        with inference_executor.admit():
+            matches = await services.enroll_user(db, user_id, images, ip_address, user_agent)
+        return {"ok": True, "user_id": user_id, "duplicates": duplicate_matches(matches)}
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.post("/enroll/batch", response_model=schemas.BatchEnrollResponse)
+def enroll_batch(request: schemas.BatchEnrollRequest, req: Request, db: Session = Depends(get_db)):
+    """
+    Enroll many users in one call.
+    Images are embedded in parallel and users are written with bulk inserts.
+    """
+    try:
+        ip_address, user_agent = get_client_info(req)
+        users = [(user.user_id, user.images) for user in request.users]
+        results = list(services.enroll_users_batch(db, users, ip_address, user_agent))
+        return {
+            "ok": True,
+            "enrolled": sum(1 for result in results if result["status"] == "enrolled"),
+            "results": results
+        }
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -36,18 +190,100 @@ def enroll(request: schemas.EnrollRequest, req: Request, db: Session = Depends(g
         )
 
 @router.post("/verify", response_model=schemas.VerifyResponse)
-def verify(request: schemas.VerifyRequest, req: Request, db: Session = Depends(get_db)):
+async def verify(request: schemas.VerifyRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Verify a user's face against their stored embedding.
     """
     try:
         ip_address, user_agent = get_client_info(req)
-        is_match, similarity = services.verify_user(db, request.user_id, request.image, ip_address, user_agent)
+        with inference_executor.admit():
+            is_match, similarity = await services.verify_user(
+                db, request.user_id, request.image, ip_address, user_agent
+            )
         return {
             "ok": True,
             "match": is_match,
             "similarity": round(similarity, 4)
         }
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.post("/verify/upload", response_model=schemas.VerifyResponse)
+async def verify_upload(req: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Verify a user's face from an uploaded image file instead of base64 JSON.
+    Multipart form with `user_id` and an `image` file, or a raw image body
+    with `?user_id=`.
+    """
+    fields, images = await read_upload(req, "image")
+    user_id = _required_field(fields, "user_id")
+    if len(images) != 1:
+        raise HTTPException(status_code=400, detail="Exactly one image is required")
+    try:
+        ip_address, user_agent = get_client_info(req)
+        with inference_executor.admit():
+            is_match, similarity = await services.verify_user(db, user_id, images[0], ip_address, user_agent)
+        return {
+            "ok": True,
+            "match": is_match,
+            "similarity": round(similarity, 4)
+        }
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@router.websocket("/verify/stream")
+async def verify_stream(websocket: WebSocket, user_id: str):
+    """
+    Verify a user from a stream of camera frames (see `app/streaming.py`).
+    Decides after as few frames as the similarities allow, and writes one access log per session.
+    """
+    await websocket.accept()
+    ip_address, user_agent = get_client_info(websocket)
+    await streaming.VerificationStream(websocket, user_id, ip_address, user_agent).run()
+
+@router.post("/identify", response_model=schemas.IdentifyResponse)
+async def identify(request: schemas.IdentifyRequest, req: Request):
+    """
+    Identify who is in the image without a user_id (1:N search).
+    """
+    try:
+        ip_address, user_agent = get_client_info(req)
+        with inference_executor.admit():
+            user_id, similarity, candidates = await services.identify_user(
+                request.image, request.top_k, ip_address, user_agent
+            )
+        return {
+            "ok": True,
+            "match": user_id is not None,
+            "user_id": user_id,
+            "similarity": round(similarity, 4),
+            "candidates": [
+                {"user_id": candidate_id, "similarity": round(score, 4)}
+                for candidate_id, score in candidates
+            ]
+        }
+    except Overloaded as e:
+        raise too_busy(e)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -84,81 +320,311 @@ def get_user_images(user_id: str, image_type: Optional[str] = None, db: Session
     images = crud.get_user_images(db, user_id, image_type)
     return images
 
-@router.get("/users/{user_id}/images/{image_id}/data", response_model=schemas.ImageDataResponse)
-def get_user_image_data(user_id: str, image_id: int, db: Session = Depends(get_db)):
-    """Get the actual image data for viewing."""
+@router.get("/users/{user_id}/images/{image_id}/data")
+def get_user_image_data(user_id: str, image_id: int, variant: str = "thumbnail", db: Session = Depends(get_db)):
+    """Stream the image bytes for viewing: the thumbnail, or `variant=image` for the stored crop or frame."""
     user = crud.get_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    image = db.query(crud.models.UserImage).filter(
-        crud.models.UserImage.id == image_id,
-        crud.models.UserImage.user_id == user_id
-    ).first()
-    
+    image = crud.get_user_image(db, user_id, image_id)
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    return {
-        "id": image.id,
-        "user_id": image.user_id,
-        "image_data": image.image_data,
-        "image_type": image.image_type,
-        "created_at": image.created_at
-    }
+    return image_response(image.image_ref, image.image_data, image.thumbnail_ref, variant)
 
 @router.get("/users/{user_id}/stats", response_model=schemas.UserStats)
-def get_user_statistics(user_id: str, db: Session = Depends(get_db)):
-    """Get statistics for a specific user."""
+def get_user_statistics(user_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                        db: Session = Depends(get_db)):
+    """Get statistics for a specific user, optionally within an hour-aligned [since, until) window."""
     user = crud.get_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.get_user_stats(db, user_id)
+    return crud.get_user_stats(db, user_id, since, until)
+
+def export_response(query, fmt: str, filename: str, **filters):
+    """Stream an export in NDJSON or CSV."""
+    if fmt not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(export.FORMATS)}")
+    return StreamingResponse(
+        export.stream(query, fmt, **filters),
+        media_type=export.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
 
 @router.get("/access-logs", response_model=List[schemas.AccessLogInfo])
-def get_access_logs(user_id: Optional[str] = None, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Get access logs with optional user filtering."""
-    logs = crud.get_access_logs(db, user_id, skip, limit)
+def get_access_logs(response: Response, user_id: Optional[str] = None, skip: int = 0, limit: int = 100,
+                    cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Get access logs (newest first) with optional user filtering.
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    try:
+        logs = crud.get_access_logs(db, user_id, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = crud.next_cursor(logs, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return logs
 
-@router.get("/access-logs/recent")
-def get_recent_access_logs(hours: int = 24, db: Session = Depends(get_db)):
-    """Get access logs from the last N hours."""
-    logs = crud.get_recent_access_logs(db, hours)
+@router.get("/access-logs/recent", response_model=List[schemas.AccessLogInfo])
+def get_recent_access_logs(response: Response, hours: int = 24, skip: int = 0, limit: int = 100,
+                           cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Get access logs from the last N hours (newest first; use /access-logs/export for large windows).
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    try:
+        logs = crud.get_recent_access_logs(db, hours, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = crud.next_cursor(logs, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return logs
 
+@router.get("/access-logs/export")
+def export_access_logs(format: str = "ndjson", since: Optional[datetime] = None, until: Optional[datetime] = None,
+                       user_id: Optional[str] = None, include_embeddings: bool = False):
+    """Stream access logs in [since, until) as NDJSON or CSV, oldest first."""
+    return export_response(
+        crud.iter_access_logs, format, "access-logs",
+        since=since, until=until, user_id=user_id, include_embeddings=include_embeddings
+    )
+
 @router.get("/unknown-access", response_model=List[schemas.UnknownAccessInfo])
-def get_unknown_access_attempts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Get unknown access attempts."""
-    attempts = crud.get_unknown_access_logs(db, skip, limit)
+def get_unknown_access_attempts(response: Response, skip: int = 0, limit: int = 100,
+                                cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Get unknown access attempts (newest first).
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    try:
+        attempts = crud.get_unknown_access_logs(db, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = crud.next_cursor(attempts, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return attempts
 
+@router.get("/unknown-access/clusters", response_model=List[schemas.UnknownClusterInfo])
+def get_unknown_clusters(min_attempts: int = 2, since: Optional[datetime] = None, skip: int = 0, limit: int = 50,
+                         db: Session = Depends(get_db)):
+    """
+    Get unknown faces seen in at least `min_attempts` attempts, most attempts
+    first (optionally only those seen since a time), to spot repeat intruders.
+    """
+    return crud.get_unknown_clusters(db, min_attempts, since, skip, limit)
+
+@router.get("/unknown-access/clusters/{cluster_id}", response_model=schemas.UnknownClusterInfo)
+def get_unknown_cluster(cluster_id: int, db: Session = Depends(get_db)):
+    """Get one unknown face cluster."""
+    cluster = crud.get_unknown_cluster(db, cluster_id)
+    if not cluster:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    return cluster
+
+@router.get("/unknown-access/clusters/{cluster_id}/attempts", response_model=List[schemas.UnknownAccessInfo])
+def get_unknown_cluster_attempts(cluster_id: int, response: Response, skip: int = 0, limit: int = 100,
+                                 cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Get the unknown access attempts of one cluster (newest first).
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    if not crud.get_unknown_cluster(db, cluster_id):
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    try:
+        attempts = crud.get_cluster_attempts(db, cluster_id, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = crud.next_cursor(attempts, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return attempts
+
+@router.get("/unknown-access/export")
+def export_unknown_access(format: str = "ndjson", since: Optional[datetime] = None, until: Optional[datetime] = None,
+                          include_embeddings: bool = False):
+    """Stream unknown access attempts in [since, until) as NDJSON or CSV, oldest first."""
+    return export_response(
+        crud.iter_unknown_access, format, "unknown-access",
+        since=since, until=until, include_embeddings=include_embeddings
+    )
+
 @router.get("/unknown-access/{attempt_id}/image")
-def get_unknown_access_image(attempt_id: int, db: Session = Depends(get_db)):
-    """Get the image from an unknown access attempt."""
-    attempt = db.query(crud.models.UnknownAccess).filter(
-        crud.models.UnknownAccess.id == attempt_id
-    ).first()
-    
+def get_unknown_access_image(attempt_id: int, variant: str = "thumbnail", db: Session = Depends(get_db)):
+    """Stream the image bytes from an unknown access attempt (see `get_user_image_data` for `variant`)."""
+    attempt = crud.get_unknown_access(db, attempt_id)
     if not attempt:
         raise HTTPException(status_code=404, detail="Unknown access attempt not found")
     
-    return {
-        "id": attempt.id,
-        "image_data": attempt.image_data,
-        "attempted_user_id": attempt.attempted_user_id,
-        "created_at": attempt.created_at
-    }
+    return image_response(attempt.image_ref, attempt.image_data, attempt.thumbnail_ref, variant)
+
+@router.get("/duplicates", response_model=List[schemas.DuplicateInfo])
+def get_duplicate_identities(user_id: Optional[str] = None, status: Optional[str] = None, skip: int = 0,
+                             limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Get faces enrolled under more than one user ID (newest first), found at
+    enrollment or by `python -m app.duplicates audit --record`.
+    """
+    return crud.get_duplicates(db, user_id, status, skip, limit)
 
 @router.get("/stats/system", response_model=schemas.SystemStats)
-def get_system_statistics(db: Session = Depends(get_db)):
-    """Get overall system statistics."""
-    return crud.get_system_stats(db)
+def get_system_statistics(since: Optional[datetime] = None, until: Optional[datetime] = None,
+                          db: Session = Depends(get_db)):
+    """Get overall system statistics, optionally within an hour-aligned [since, until) window."""
+    return crud.get_system_stats(db, since, until)
+
+@router.get("/stats/system/timeseries", response_model=List[schemas.StatsBucket])
+def get_system_statistics_timeseries(granularity: str = "hour", user_id: Optional[str] = None,
+                                     since: Optional[datetime] = None, until: Optional[datetime] = None,
+                                     db: Session = Depends(get_db)):
+    """Get per-hour or per-day attempt counters, system-wide or for one user."""
+    try:
+        return crud.get_stats_timeseries(db, granularity, user_id, since, until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/stats/inference", response_model=schemas.InferenceStats)
+def get_inference_statistics():
+    """Get batch-size and queue-depth metrics of the inference scheduler."""
+    if services.scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.scheduler.stats()}
+
+@router.get("/stats/db", response_model=schemas.DatabaseStats)
+def get_database_statistics():
+    """Get connection pool utilization of the sync and async engines."""
+    return database_stats()
+
+@router.get("/stats/executor", response_model=schemas.ExecutorStats)
+def get_executor_statistics():
+    """Get admission-control metrics of the inference executor."""
+    return inference_executor.stats()
+
+@router.get("/stats/cache", response_model=schemas.EmbeddingCacheStats)
+def get_cache_statistics():
+    """Get hit-rate metrics of this worker's verification embedding cache."""
+    return embedding_cache.stats()
+
+@router.get("/stats/audit", response_model=schemas.AuditStats)
+def get_audit_statistics():
+    """Get queue and flush metrics of the background audit writer."""
+    return audit_writer.stats()
+
+@router.get("/calibration", response_model=schemas.CalibrationReport)
+def get_threshold_calibration(target_far: Optional[float] = None, since: Optional[datetime] = None,
+                              until: Optional[datetime] = None, max_probes: Optional[int] = None,
+                              scoring: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Genuine and impostor score distributions of logged verification attempts,
+    with FAR/FRR curves and the threshold recommended for `target_far`.
+    """
+    try:
+        return calibration.calibrate(
+            db, target_far, since, until, max_probes or settings.CALIBRATION_MAX_PROBES, scoring
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.delete("/users/{user_id}")
 def delete_user(user_id: str, db: Session = Depends(get_db)):
     """Deactivate a user (soft delete)."""
-    user = crud.deactivate_user(db, user_id)
+    user = services.deactivate_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"message": f"User {user_id} has been deactivated"}
\ No newline at end of file
+    return {"message": f"User {user_id} has been deactivated"}
+
+# Shard Endpoints, called by the shard router (`app/sharding.py`). They are
+# only mounted when SHARD_TOKEN is set, and need it in the X-Shard-Token header.
+
+def require_shard_token(x_shard_token: Optional[str] = Header(None)):
+    """Reject callers other than the shard router."""
+    if not x_shard_token or not secrets.compare_digest(x_shard_token.encode(), settings.SHARD_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid shard token")
+
+shard_router = APIRouter(prefix="/shard", dependencies=[Depends(require_shard_token)])
+
+@shard_router.post("/embed", response_model=schemas.ShardFace)
+async def shard_embed(request: schemas.IdentifyRequest):
+    """Embed the face of an identification once, for the router to search every shard with."""
+    try:
+        with inference_executor.admit():
+            embedding, crop = await services.embed_identification(request.image)
+        return {"embedding": embedding.tolist(), "crop": base64.b64encode(crop).decode("ascii")}
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@shard_router.post("/search", response_model=schemas.IdentifyResponse)
+async def shard_search(request: schemas.ShardSearchRequest):
+    """
+    Search this shard's gallery without storing or logging anything. The
+    router merges the candidates of every shard and records the outcome once.
+    """
+    try:
+        candidates = await services.search_gallery(np.asarray(request.embedding, dtype=np.float32), request.top_k)
+        match = bool(candidates) and candidates[0][1] >= settings.SIMILARITY_THRESHOLD
+        return {
+            "ok": True,
+            "match": match,
+            "user_id": candidates[0][0] if match else None,
+            "similarity": round(candidates[0][1], 4) if candidates else 0.0,
+            "candidates": [
+                {"user_id": candidate_id, "similarity": round(score, 4)}
+                for candidate_id, score in candidates
+            ]
+        }
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@shard_router.post("/identify/record")
+async def shard_record_identification(request: schemas.IdentifyRecordRequest, req: Request):
+    """Store the capture and log an identification the router decided across shards."""
+    try:
+        ip_address, user_agent = get_client_info(req)
+        embedding = None if request.embedding is None else np.asarray(request.embedding, dtype=np.float32)
+        crop = None if request.crop is None else base64.b64decode(request.crop)
+        with inference_executor.admit():
+            await services.record_identification(
+                request.image, request.user_id, request.similarity, embedding, crop, ip_address, user_agent
+            )
+        return {"ok": True}
+    except Overloaded as e:
+        raise too_busy(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@shard_router.get("/users", response_model=List[str])
+def get_shard_user_ids(after: Optional[str] = None, limit: int = 1000, db: Session = Depends(get_db)):
+    """Active user IDs in ID order; pass the last one as `after` for the next page."""
+    return crud.get_active_user_ids(db, after, limit)
+
+@shard_router.get("/users/{user_id}", response_model=schemas.UserTransfer)
+def export_shard_user(user_id: str, db: Session = Depends(get_db)):
+    """Export a user with their images, to move them to another shard."""
+    transfer = services.export_user(db, user_id)
+    if transfer is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return transfer
+
+@shard_router.post("/users", response_model=schemas.SuccessResponse)
+def import_shard_user(request: schemas.UserTransfer, db: Session = Depends(get_db)):
+    """Import a user exported by another shard."""
+    try:
+        services.import_user(db, request.model_dump())
+        return {"ok": True, "user_id": request.id}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@shard_router.delete("/users/{user_id}")
+def purge_shard_user(user_id: str, db: Session = Depends(get_db)):
+    """Delete a user that was moved to another shard (access logs are kept)."""
+    if not services.purge_user(db, user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"ok": True, "user_id": user_id}
@@ -0,0 +1,383 @@
+"""
+Asynchronous, batched writer for audit records.
+
+Access logs, unknown-access records and verification image captures are
+queued in memory and written by a background thread with bulk inserts,
+either when `batch_size` records are waiting or every `flush_interval_ms`.
+That takes the database round-trips out of the authentication response.
+
+Back-pressure: the queue is bounded; producers wait up to
+`enqueue_timeout_ms` for room and then write synchronously instead.
+
+Durability: with `spill_dir` set, every record is appended to a journal
+segment before it is queued. A segment is deleted once its records are
+committed, and leftover segments are replayed on startup, so a crash loses
+nothing (records may be written twice if the crash lands between the commit
+and the delete).
+
+Failed batches are retried with exponential backoff. After `max_retries`
+failures the batch is written record by record, and the records that still
+fail are quarantined: appended to a `quarantine-*.jsonl` file (same format
+as the journal) in `spill_dir`, or logged and dropped without one. A single
+bad record therefore cannot hold the rest back forever.
+"""
+import base64
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from .core.config import settings
+from .db import crud
+
+logger = logging.getLogger(__name__)
+
+ACCESS_LOG = "access_log"
+UNKNOWN_ACCESS = "unknown_access"
+USER_IMAGE = "user_image"
+
+
+def _to_json(record: dict) -> dict:
+    encoded = {}
+    for key, value in record.items():
+        if isinstance(value, np.ndarray):
+            value = {"ndarray": base64.b64encode(np.asarray(value, dtype="<f4").tobytes()).decode()}
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif isinstance(value, datetime):
+            value = {"datetime": value.isoformat()}
+        encoded[key] = value
+    return encoded
+
+
+def _from_json(record: dict) -> dict:
+    decoded = {}
+    for key, value in record.items():
+        if isinstance(value, dict) and "ndarray" in value:
+            value = np.frombuffer(base64.b64decode(value["ndarray"]), dtype="<f4")
+        elif isinstance(value, dict) and "datetime" in value:
+            value = datetime.fromisoformat(value["datetime"])
+        decoded[key] = value
+    return decoded
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AuditWriter:
+    """Background writer with the same call signatures as the crud logging functions."""
+
+    def __init__(self, enabled: bool = True, max_queue_size: int = 10000, batch_size: int = 200,
+                 flush_interval_ms: float = 500, enqueue_timeout_ms: float = 100,
+                 spill_dir: Optional[str] = None, max_retries: int = 5):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout_ms / 1000.0
+        self.spill_dir = spill_dir
+        self.max_retries = max(1, max_retries)
+        self._queue: "queue.Queue[Tuple[str, dict]]" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._replayed = False
+
+        # Journal segments: records are appended to the open segment, which is
+        # sealed when its records are taken for a flush.
+        self._journal_lock = threading.Lock()
+        self._segment_file = None
+        self._segment_path: Optional[str] = None
+        self._segment_number = 0
+
+        # Batches whose insert failed: (records, journal segments, failures,
+        # monotonic time of the next attempt)
+        self._retry: List[Tuple[List[Tuple[str, dict]], List[str], int, float]] = []
+
+        # Metrics
+        self.enqueued = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.quarantined = 0
+        self.sync_fallbacks = 0
+        self.total_flush = 0.0
+
+    # Lifecycle
+
+    def start(self):
+        """Replay any journal left by a previous run and start the writer thread."""
+        if not self.enabled:
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            # Once per writer: on a restart this process's segments are still in flight
+            if self.spill_dir and not self._replayed:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self._replay_journal()
+                self._replayed = True
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Flush everything still queued and stop the writer thread."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Producers
+
+    def log_access_attempt(self, db: Optional[Session], user_id: str, access_type: str, success: bool,
+                           image_ref: Optional[str] = None, embedding: Optional[np.ndarray] = None,
+                           similarity_score: Optional[float] = None, ip_address: Optional[str] = None,
+                           user_agent: Optional[str] = None, thumbnail_ref: Optional[str] = None):
+        """Queue an access log entry (see `crud.log_access_attempt`)."""
+        record = dict(
+            user_id=user_id, access_type=access_type, success=success, image_ref=image_ref,
+            embedding=embedding, similarity_score=similarity_score,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+        )
+        if not self._enqueue(ACCESS_LOG, record):
+            self._write_now(crud.log_access_attempt, db, record)
+
+    def log_unknown_access(self, db: Optional[Session], image_ref: Optional[str], embedding: Optional[np.ndarray] = None,
+                           attempted_user_id: Optional[str] = None, ip_address: Optional[str] = None,
+                           user_agent: Optional[str] = None, thumbnail_ref: Optional[str] = None):
+        """Queue an unknown access record (see `crud.log_unknown_access`)."""
+        record = dict(
+            image_ref=image_ref, embedding=embedding, attempted_user_id=attempted_user_id,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+        )
+        if not self._enqueue(UNKNOWN_ACCESS, record):
+            self._write_now(crud.log_unknown_access, db, record)
+
+    def store_user_image(self, db: Optional[Session], user_id: str, image_ref: Optional[str],
+                         embedding: np.ndarray, image_type: str, thumbnail_ref: Optional[str] = None):
+        """Queue an image capture (see `crud.store_user_image`)."""
+        record = dict(
+            user_id=user_id, image_ref=image_ref, embedding=embedding, image_type=image_type,
+            thumbnail_ref=thumbnail_ref
+        )
+        if not self._enqueue(USER_IMAGE, record):
+            self._write_now(crud.store_user_image, db, record)
+
+    @staticmethod
+    def _write_now(write, db: Optional[Session], record: dict):
+        """Synchronous fallback; callers without a sync session (async handlers) pass None."""
+        if db is not None:
+            write(db, **record)
+            return
+        from .db.database import SessionLocal
+
+        own = SessionLocal()
+        try:
+            write(own, **record)
+        finally:
+            own.close()
+
+    def _enqueue(self, kind: str, record: dict) -> bool:
+        """Queue a record; returns False when the caller should write it synchronously instead."""
+        if not self.enabled:
+            return False
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        # Timestamp now, not when the batch happens to be flushed
+        record = dict(record, created_at=datetime.utcnow())
+
+        deadline = time.monotonic() + self.enqueue_timeout
+        while True:
+            with self._journal_lock:
+                # Only producers add to the queue, and they hold this lock, so
+                # the queue cannot fill up between the check and the put
+                if not self._queue.full():
+                    if self.spill_dir:
+                        self._append_journal(kind, record)
+                    self._queue.put_nowait((kind, record))
+                    self.enqueued += 1
+                    return True
+            if time.monotonic() >= deadline:
+                self.sync_fallbacks += 1
+                return False
+            time.sleep(0.005)
+
+    # Journal
+
+    @staticmethod
+    def _journal_line(kind: str, record: dict) -> str:
+        return json.dumps({"kind": kind, "record": _to_json(record)}) + "\n"
+
+    def _append_journal(self, kind: str, record: dict):
+        if self._segment_file is None:
+            self._segment_number += 1
+            self._segment_path = os.path.join(
+                self.spill_dir, f"audit-{os.getpid()}-{int(time.time() * 1000)}-{self._segment_number}.jsonl"
+            )
+            self._segment_file = open(self._segment_path, "a")
+        self._segment_file.write(self._journal_line(kind, record))
+        self._segment_file.flush()
+
+    def _seal_segment(self) -> List[str]:
+        """Close the open segment; its records are exactly the ones drained so far."""
+        if self._segment_file is None:
+            return []
+        self._segment_file.close()
+        path = self._segment_path
+        self._segment_file = None
+        self._segment_path = None
+        return [path]
+
+    def _replay_journal(self):
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "audit-*.jsonl"))):
+            # Segments of other live workers sharing the directory are theirs to flush
+            pid = int(os.path.basename(path).split("-")[1])
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            batch = []
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Torn final line from a crash mid-write
+                    batch.append((entry["kind"], _from_json(entry["record"])))
+            self._retry.append((batch, [path], 0, 0.0))
+
+    # Writer
+
+    def _drain(self) -> Tuple[List[Tuple[str, dict]], List[str]]:
+        with self._journal_lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            return batch, self._seal_segment()
+
+    def _write(self, batch: List[Tuple[str, dict]]):
+        from .db.database import SessionLocal
+
+        grouped: Dict[str, List[dict]] = {ACCESS_LOG: [], UNKNOWN_ACCESS: [], USER_IMAGE: []}
+        for kind, record in batch:
+            grouped[kind].append(record)
+        db = SessionLocal()
+        try:
+            crud.bulk_insert_audit_records(
+                db, grouped[ACCESS_LOG], grouped[UNKNOWN_ACCESS], grouped[USER_IMAGE]
+            )
+        finally:
+            db.close()
+
+    def flush(self, force: bool = False):
+        """Write everything queued now, plus failed batches that are due for a retry (all with `force`)."""
+        batch, segments = self._drain()
+        now = time.monotonic()
+        retry, self._retry = self._retry, []
+        pending = []
+        for entry in retry:
+            (pending if force or entry[3] <= now else self._retry).append(entry)
+        if batch or segments:
+            pending.append((batch, segments, 0, now))
+        for records, paths, failures, _ in pending:
+            started = time.perf_counter()
+            try:
+                if records:
+                    self._write(records)
+            except Exception as e:
+                self.failures += 1
+                failures += 1
+                if failures < self.max_retries:
+                    logger.warning("Audit writer: flush of %d records failed, will retry: %s", len(records), e)
+                    self._retry.append((records, paths, failures, time.monotonic() + self.flush_interval * 2 ** failures))
+                    continue
+                logger.error("Audit writer: flush of %d records failed %d times, writing them one by one: %s",
+                             len(records), failures, e)
+                self._write_or_quarantine(records)
+            else:
+                self.flushes += 1
+                self.written += len(records)
+                self.total_flush += time.perf_counter() - started
+            for path in paths:
+                os.remove(path)
+
+    def _write_or_quarantine(self, records: List[Tuple[str, dict]]):
+        """Write a failing batch record by record and set aside the records that still fail."""
+        failed = []
+        for entry in records:
+            try:
+                self._write([entry])
+                self.written += 1
+            except Exception:
+                failed.append(entry)
+        if not failed:
+            return
+        self.quarantined += len(failed)
+        if not self.spill_dir:
+            logger.error("Audit writer: dropped %d records that could not be written", len(failed))
+            return
+        path = os.path.join(self.spill_dir, f"quarantine-{os.getpid()}-{int(time.time() * 1000)}.jsonl")
+        with open(path, "a") as f:
+            for kind, record in failed:
+                f.write(self._journal_line(kind, record))
+        logger.error("Audit writer: quarantined %d records that could not be written in %s", len(failed), path)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stopping.is_set():
+            # An unexpected error (a full disk, say) must not kill the thread
+            # and leave producers queueing into a writer that never flushes
+            try:
+                if self._queue.qsize() >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                    if self._queue.qsize() or self._retry:
+                        self.flush()
+                    last_flush = time.monotonic()
+            except Exception:
+                logger.exception("Audit writer: flush failed")
+                last_flush = time.monotonic()
+            self._stopping.wait(min(self.flush_interval, 0.05))
+        try:
+            self.flush(force=True)
+        except Exception:
+            logger.exception("Audit writer: final flush failed")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "quarantined": self.quarantined,
+            "pending_retry": sum(len(records) for records, _, _, _ in self._retry),
+            "sync_fallbacks": self.sync_fallbacks,
+            "mean_flush_ms": self.total_flush / self.flushes * 1000 if self.flushes else 0.0,
+        }
+
+
+audit_writer = AuditWriter(
+    enabled=settings.AUDIT_ASYNC,
+    max_queue_size=settings.AUDIT_QUEUE_SIZE,
+    batch_size=settings.AUDIT_BATCH_SIZE,
+    flush_interval_ms=settings.AUDIT_FLUSH_INTERVAL_MS,
+    enqueue_timeout_ms=settings.AUDIT_ENQUEUE_TIMEOUT_MS,
+    spill_dir=settings.AUDIT_SPILL_DIR or None,
+    max_retries=settings.AUDIT_MAX_RETRIES,
+)
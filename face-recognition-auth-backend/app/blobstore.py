@@ -0,0 +1,144 @@
+"""
+Content-addressed storage for image bytes.
+
+Images are keyed by the hex SHA-256 of their raw bytes, so the same frame
+stored as a verification image and in the access log is written once, and
+the database only keeps the 64-character reference.
+"""
+import base64
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, Iterator
+
+from .core.config import settings
+
+CHUNK_SIZE = 64 * 1024
+
+
+def decode_data_url(base64_string: str) -> bytes:
+    """Decode a base64 string (or data URL) to the raw bytes."""
+    # The string might be a data URL, so we strip the header.
+    if "," in base64_string:
+        base64_string = base64_string.split(',')[1]
+    return base64.b64decode(base64_string)
+
+
+def sniff_media_type(header: bytes) -> str:
+    """Guess an image media type from its first bytes."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith(b"BM"):
+        return "image/bmp"
+    return "application/octet-stream"
+
+
+class BlobStore:
+    """Interface for blob store backends."""
+
+    def put(self, data: bytes) -> str:
+        """Store bytes if they are not already present and return their SHA-256 reference."""
+        raise NotImplementedError
+
+    def open(self, ref: str) -> BinaryIO:
+        """Open a stored blob for reading. Raises KeyError if it does not exist."""
+        raise NotImplementedError
+
+    def exists(self, ref: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, ref: str) -> bool:
+        raise NotImplementedError
+
+    def get(self, ref: str) -> bytes:
+        with self.open(ref) as f:
+            return f.read()
+
+    def stream(self, ref: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield a stored blob in chunks without loading it all into memory."""
+        with self.open(ref) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def media_type(self, ref: str) -> str:
+        with self.open(ref) as f:
+            return sniff_media_type(f.read(16))
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Filesystem backend sharded by hash prefix: `<root>/ab/cd/abcd...`.
+
+    Two levels of 256 directories keep every directory small even with
+    millions of images.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @staticmethod
+    def _validate(ref: str):
+        if len(ref) != 64 or any(c not in "0123456789abcdef" for c in ref):
+            raise KeyError(ref)
+
+    def path(self, ref: str) -> str:
+        self._validate(ref)
+        return os.path.join(self.root, ref[:2], ref[2:4], ref)
+
+    def put(self, data: bytes) -> str:
+        ref = hashlib.sha256(data).hexdigest()
+        path = self.path(ref)
+        if os.path.exists(path):
+            return ref  # Identical image already stored
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ref
+
+    def open(self, ref: str) -> BinaryIO:
+        try:
+            return open(self.path(ref), "rb")
+        except FileNotFoundError:
+            raise KeyError(ref)
+
+    def exists(self, ref: str) -> bool:
+        try:
+            return os.path.exists(self.path(ref))
+        except KeyError:
+            return False
+
+    def delete(self, ref: str) -> bool:
+        try:
+            os.remove(self.path(ref))
+            return True
+        except (FileNotFoundError, KeyError):
+            return False
+
+
+def build_blob_store() -> BlobStore:
+    """Create the backend selected by `settings.BLOB_STORE_BACKEND`."""
+    if settings.BLOB_STORE_BACKEND == "local":
+        return LocalBlobStore(settings.BLOB_STORE_PATH)
+    raise ValueError(f"Unknown blob store backend: {settings.BLOB_STORE_BACKEND}")
+
+
+blob_store = build_blob_store()
@@ -0,0 +1,110 @@
+"""
+Offline bulk enrollment.
+
+Usage:
+    python -m app.bulk_enroll SOURCE [--report enroll-report.jsonl] [--chunk-size 100] [--workers 8]
+
+SOURCE is either a directory with one sub-directory of images per user
+(`<root>/<user_id>/*.jpg`), or a CSV manifest of `user_id,path` rows with
+paths relative to the manifest. Every processed user is appended to the
+JSON Lines report together with its rejected images; re-running with the
+same report skips users that were already handled.
+"""
+import argparse
+import csv
+import json
+import os
+from collections import Counter, OrderedDict
+from typing import Dict, List
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+
+def read_directory(root: str) -> Dict[str, List[str]]:
+    users: Dict[str, List[str]] = OrderedDict()
+    for user_id in sorted(os.listdir(root)):
+        user_dir = os.path.join(root, user_id)
+        if not os.path.isdir(user_dir):
+            continue
+        paths = [
+            os.path.join(user_dir, name) for name in sorted(os.listdir(user_dir))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+        if paths:
+            users[user_id] = paths
+    return users
+
+
+def read_manifest(path: str) -> Dict[str, List[str]]:
+    base = os.path.dirname(os.path.abspath(path))
+    users: Dict[str, List[str]] = OrderedDict()
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0] == "user_id":
+                continue  # Skip the header and blank lines
+            users.setdefault(row[0].strip(), []).append(os.path.join(base, row[1].strip()))
+    return users
+
+
+def read_report(path: str) -> set:
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    done.add(json.loads(line)["user_id"])
+    return done
+
+
+def main():
+    from .core.config import settings
+
+    parser = argparse.ArgumentParser(description="Enroll users in bulk from a directory tree or CSV manifest.")
+    parser.add_argument("source")
+    parser.add_argument("--report", default="enroll-report.jsonl")
+    parser.add_argument("--chunk-size", type=int, default=settings.ENROLL_BATCH_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=settings.ENROLL_BATCH_WORKERS or None)
+    args = parser.parse_args()
+
+    users = read_directory(args.source) if os.path.isdir(args.source) else read_manifest(args.source)
+    done = read_report(args.report)
+    todo = [(user_id, paths) for user_id, paths in users.items() if user_id not in done]
+    print(f"{len(users)} users found, {len(done)} already in the report, {len(todo)} to enroll")
+
+    # Imported here so `--help` works without loading the model
+    from . import services
+    from .db.database import SessionLocal
+
+    # enrolled, exists, rejected, or duplicate (DUPLICATE_POLICY=reject)
+    counts: Counter = Counter()
+    db = SessionLocal()
+    try:
+        with open(args.report, "a") as report_file:
+            for start in range(0, len(todo), args.chunk_size):
+                # Only one chunk of image bytes is held in memory at a time
+                chunk = []
+                for user_id, paths in todo[start:start + args.chunk_size]:
+                    images = []
+                    for path in paths:
+                        with open(path, "rb") as f:
+                            images.append(f.read())
+                    chunk.append((user_id, images))
+
+                for report in services.enroll_users_batch(
+                    db, chunk, user_agent="bulk_enroll",
+                    chunk_size=args.chunk_size, max_workers=args.workers
+                ):
+                    report["rejected_images"] = [
+                        {"path": users[report["user_id"]][rejected["index"]], "reason": rejected["reason"]}
+                        for rejected in report["rejected_images"]
+                    ]
+                    report_file.write(json.dumps(report) + "\n")
+                    counts[report["status"]] += 1
+                report_file.flush()
+                print(f"{min(start + args.chunk_size, len(todo))}/{len(todo)} users processed: {dict(counts)}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Offline threshold calibration from the access logs.
+
+Every logged verification attempt with an embedding is a probe claiming
+one user. Its score against that user's templates, computed the way
+/verify computes it (TEMPLATE_SCORING), is a genuine score; its scores
+against every other active user are impostor scores. Probes are streamed
+from the log in chunks, every user's templates are held as one flat
+matrix, and each chunk is scored against blocks of users with a single
+matrix product. Scores are counted into SCORE_BINS fixed-width histogram
+bins over [-1, 1] rather than kept, so memory stays flat however many
+pairs are compared.
+
+From the two histograms come the false accept rate (impostor scores >= t)
+and false reject rate (genuine scores < t) at every threshold t: the ROC
+(TAR = 1 - FRR against FAR) and DET (FRR against FAR) curves, the equal
+error rate, and the recommended threshold, the lowest whose FAR is at most
+the target, which gives the best FRR at that FAR.
+
+The claimed user ID is the only label, so impostors who tried someone
+else's ID count as genuine attempts and inflate the FRR. Templates added
+from a verification (TEMPLATE_REFRESH) hold that attempt's own embedding;
+they are left out of its genuine score, which would otherwise be 1.0.
+
+Usage:
+    python -m app.calibration [--target-far 0.001] [--since 2026-01-01] [--until 2026-02-01]
+        [--max-probes 100000] [--scoring max] [--histograms] [--output report.json]
+
+The same report is served on /api/calibration.
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import templates
+from .core.config import settings
+from .db import crud
+
+SCORE_BINS = 2000
+BIN_WIDTH = 2.0 / SCORE_BINS
+
+# Scores computed per block product, to bound memory
+BLOCK_SCORES = 16 * 1024 * 1024
+
+# A template at least this similar to a probe is the probe itself, added by TEMPLATE_REFRESH
+SELF_MATCH = 0.999
+
+# Attempts that claim a user ID; identifications are labelled by the system's own match
+PROBE_TYPES = ("verification_success", "verification_failed")
+
+# Spacing of the thresholds reported on the curve
+CURVE_STEP = 0.01
+
+
+def histogram(scores: np.ndarray) -> np.ndarray:
+    """Counts of scores per bin; bin i holds [-1 + i * BIN_WIDTH, -1 + (i + 1) * BIN_WIDTH)."""
+    bins = np.floor((np.asarray(scores).ravel() + 1.0) * (SCORE_BINS / 2)).astype(np.int64)
+    return np.bincount(np.clip(bins, 0, SCORE_BINS - 1), minlength=SCORE_BINS)
+
+
+class TemplateSet:
+    """Every active user's templates as one flat matrix of unit rows, each user's rows contiguous."""
+
+    def __init__(self, ids: List[str], vectors: np.ndarray, counts: np.ndarray, centroids: np.ndarray):
+        self.ids = ids
+        self.index: Dict[str, int] = {user_id: row for row, user_id in enumerate(ids)}
+        self.vectors = vectors
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.counts = counts
+        self.max_count = int(counts.max()) if len(counts) else 0
+        # Stored centroid of each user (User.embedding), as 'centroid' scoring uses
+        self.centroids = centroids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, db: Session, batch_size: int = 1000) -> "TemplateSet":
+        ids, matrices, centroids = [], [], []
+        for user_id, embedding, template_matrix in crud.get_active_user_templates(db, batch_size):
+            ids.append(user_id)
+            # Users enrolled before templates existed are scored against their centroid
+            matrices.append(templates.as_matrix(embedding if template_matrix is None else template_matrix))
+            centroids.append(templates.as_matrix(embedding)[0])
+        if not ids:
+            empty = np.empty((0, 0), dtype=np.float32)
+            return cls([], empty, np.empty(0, dtype=np.int64), empty)
+        counts = np.array([len(matrix) for matrix in matrices], dtype=np.int64)
+        return cls(ids, np.concatenate(matrices), counts, np.stack(centroids))
+
+    def padding(self, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of users [start, stop) relative to the first one, padded to max_count, and which are real."""
+        offsets, counts = self.offsets[start:stop] - self.offsets[start], self.counts[start:stop]
+        slots = np.arange(self.max_count)
+        valid = slots[None, :] < counts[:, None]
+        return np.where(valid, offsets[:, None] + slots[None, :], 0), valid
+
+
+def _reduce(scores: np.ndarray, valid: np.ndarray, strategy: str, top_k: int) -> np.ndarray:
+    """Per-template scores (..., K), with invalid slots, reduced per TEMPLATE_SCORING ('max' or 'topk_mean')."""
+    scores = np.where(valid, scores, -np.inf)
+    if strategy == "max":
+        return scores.max(axis=-1)
+    k = min(max(top_k, 1), scores.shape[-1])
+    top = -np.partition(-scores, k - 1, axis=-1)[..., :k]
+    used = np.minimum(valid.sum(axis=-1), k)
+    return np.where(np.isfinite(top), top, 0.0).sum(axis=-1) / np.maximum(used, 1)
+
+
+def block_scores(probes: np.ndarray, users: TemplateSet, start: int, stop: int,
+                 strategy: str, top_k: int) -> np.ndarray:
+    """Score of every probe against each user in [start, stop) (probes x users)."""
+    if strategy == "centroid":
+        return probes @ users.centroids[start:stop].T
+    first, last = users.offsets[start], users.offsets[stop]
+    flat = probes @ users.vectors[first:last].T
+    if strategy == "max":
+        return np.maximum.reduceat(flat, users.offsets[start:stop] - first, axis=1)
+    rows, valid = users.padding(start, stop)
+    return _reduce(flat[:, rows], valid[None, :, :], strategy, top_k)
+
+
+def genuine_scores(probes: np.ndarray, owners: np.ndarray, users: TemplateSet,
+                   strategy: str, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score of each probe against its own user, leaving out templates that
+    are the probe itself. Returns the scores and which probes have one
+    (a user whose every template is the probe has none). 'centroid' scores
+    the stored centroid, which never holds a verification's embedding.
+    """
+    if strategy == "centroid":
+        return np.einsum("pd,pd->p", probes, users.centroids[owners]), np.ones(len(probes), dtype=bool)
+    slots = np.arange(users.max_count)
+    valid = slots[None, :] < users.counts[owners][:, None]
+    rows = np.where(valid, users.offsets[owners][:, None] + slots[None, :], 0)
+    vectors = users.vectors[rows]  # probes x K x D
+    scores = np.einsum("pd,pkd->pk", probes, vectors)
+    valid &= scores < SELF_MATCH
+    scored = valid.any(axis=1)
+    return _reduce(scores, valid, strategy, top_k), scored
+
+
+def probe_chunks(db: Session, users: TemplateSet, since: Optional[datetime], until: Optional[datetime],
+                 max_probes: Optional[int], chunk_size: int, stats: dict) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """(unit probe embeddings, owner rows) in chunks; attempts on users no longer active are skipped."""
+    vectors, owners = [], []
+    for user_id, embedding in crud.iter_attempt_embeddings(db, PROBE_TYPES, since, until, max_probes):
+        owner = users.index.get(user_id)
+        if owner is None:
+            stats["skipped_probes"] += 1
+            continue
+        vectors.append(embedding)
+        owners.append(owner)
+        if len(vectors) == chunk_size:
+            yield templates.as_matrix(vectors), np.array(owners, dtype=np.int64)
+            vectors, owners = [], []
+    if vectors:
+        yield templates.as_matrix(vectors), np.array(owners, dtype=np.int64)
+
+
+def score_histograms(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     max_probes: Optional[int] = None, strategy: Optional[str] = None,
+                     top_k: Optional[int] = None, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """Genuine and impostor score histograms of the logged attempts, with probe and user counts."""
+    strategy = strategy or settings.TEMPLATE_SCORING
+    top_k = top_k or settings.TEMPLATE_TOP_K
+    if strategy not in templates.STRATEGIES:
+        raise ValueError(f"scoring must be one of {', '.join(templates.STRATEGIES)}")
+    users = TemplateSet.load(db)
+    genuine = np.zeros(SCORE_BINS, dtype=np.int64)
+    impostor = np.zeros(SCORE_BINS, dtype=np.int64)
+    stats = {"users": len(users), "probes": 0, "skipped_probes": 0}
+    if not len(users):
+        return genuine, impostor, stats
+    columns_per_user = 1 if strategy == "centroid" else max(1, int(np.ceil(users.offsets[-1] / len(users))))
+
+    for probes, owners in probe_chunks(db, users, since, until, max_probes, chunk_size, stats):
+        stats["probes"] += len(probes)
+        scores, scored = genuine_scores(probes, owners, users, strategy, top_k)
+        genuine += histogram(scores[scored])
+        stats["skipped_probes"] += int((~scored).sum())
+
+        step = max(1, BLOCK_SCORES // (len(probes) * columns_per_user))
+        for start in range(0, len(users), step):
+            stop = min(len(users), start + step)
+            scores = block_scores(probes, users, start, stop, strategy, top_k)
+            impostor += histogram(scores)
+            # Each probe's own user is in exactly one block; those pairs are not impostors
+            own = np.nonzero((owners >= start) & (owners < stop))[0]
+            if len(own):
+                impostor -= histogram(scores[own, owners[own] - start])
+    return genuine, impostor, stats
+
+
+def rates(genuine: np.ndarray, impostor: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(thresholds, FAR, FRR) at every bin edge."""
+    thresholds = -1.0 + np.arange(SCORE_BINS + 1) * BIN_WIDTH
+    accepted = np.concatenate([np.cumsum(impostor[::-1])[::-1], [0]])
+    rejected = np.concatenate([[0], np.cumsum(genuine)])
+    return thresholds, accepted / max(int(impostor.sum()), 1), rejected / max(int(genuine.sum()), 1)
+
+
+def report(genuine: np.ndarray, impostor: np.ndarray, target_far: float,
+           threshold: Optional[float] = None, histograms: bool = False) -> dict:
+    """FAR/FRR at the recommended and current thresholds, the equal error rate, and the curve."""
+    if not genuine.sum() or not impostor.sum():
+        raise ValueError("Not enough data: calibration needs verification attempts with embeddings and at least two users.")
+    threshold = settings.SIMILARITY_THRESHOLD if threshold is None else threshold
+    thresholds, far, frr = rates(genuine, impostor)
+    recommended = int(np.argmax(far <= target_far))
+    current = min(int(np.searchsorted(thresholds, threshold - 1e-9)), SCORE_BINS)
+    equal = int(np.argmin(np.abs(far - frr)))
+    step = max(1, int(round(CURVE_STEP / BIN_WIDTH)))
+
+    def point(index: int) -> dict:
+        return {
+            "threshold": round(float(thresholds[index]), 4), "far": float(far[index]),
+            "frr": float(frr[index]), "tar": float(1.0 - frr[index]),
+        }
+
+    result = {
+        "genuine_pairs": int(genuine.sum()),
+        "impostor_pairs": int(impostor.sum()),
+        "target_far": target_far,
+        "recommended": point(recommended),
+        "current": {**point(current), "threshold": threshold},
+        "eer": float((far[equal] + frr[equal]) / 2),
+        "eer_threshold": round(float(thresholds[equal]), 4),
+        "curve": [point(index) for index in range(0, SCORE_BINS + 1, step)],
+    }
+    if histograms:
+        result["bin_width"] = BIN_WIDTH
+        result["genuine_histogram"] = genuine.tolist()
+        result["impostor_histogram"] = impostor.tolist()
+    return result
+
+
+def calibrate(db: Session, target_far: Optional[float] = None, since: Optional[datetime] = None,
+              until: Optional[datetime] = None, max_probes: Optional[int] = None, strategy: Optional[str] = None,
+              histograms: bool = False) -> dict:
+    """Score the logged attempts and report FAR/FRR and the recommended threshold."""
+    started = time.perf_counter()
+    target_far = settings.CALIBRATION_TARGET_FAR if target_far is None else target_far
+    if not 0 <= target_far < 1:
+        raise ValueError("target_far must be in [0, 1)")
+    strategy = strategy or settings.TEMPLATE_SCORING
+    genuine, impostor, stats = score_histograms(db, since, until, max_probes, strategy)
+    return {
+        **stats,
+        "scoring": strategy,
+        **report(genuine, impostor, target_far, histograms=histograms),
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def main():
+    from .db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Calibrate SIMILARITY_THRESHOLD from the access logs.")
+    parser.add_argument("--target-far", type=float, default=settings.CALIBRATION_TARGET_FAR)
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only attempts from this time (ISO 8601)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Only attempts before this time")
+    parser.add_argument("--max-probes", type=int, help="Newest attempts to score (default: all)")
+    parser.add_argument("--scoring", choices=templates.STRATEGIES, help="Default: TEMPLATE_SCORING")
+    parser.add_argument("--histograms", action="store_true", help="Include the score histograms")
+    parser.add_argument("--output", help="Write the report as JSON to this file (default: stdout)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        result = calibrate(db, args.target_far, args.since, args.until, args.max_probes, args.scoring, args.histograms)
+    except ValueError as e:
+        parser.exit(1, f"{e}\n")
+    finally:
+        db.close()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(result, output, indent=2 if args.output else None)
+        output.write("\n")
+    finally:
+        if args.output:
+            output.close()
+    recommended, current = result["recommended"], result["current"]
+    print(f"Scored {result['probes']} attempts against {result['users']} users: {result['genuine_pairs']} genuine and "
+          f"{result['impostor_pairs']} impostor pairs in {result['elapsed_seconds']:.1f}s", file=sys.stderr)
+    print(f"Threshold {recommended['threshold']} for FAR <= {result['target_far']}: "
+          f"FAR {recommended['far']:.6f}, FRR {recommended['frr']:.4f} "
+          f"(current {current['threshold']}: FAR {current['far']:.6f}, FRR {current['frr']:.4f}; "
+          f"EER {result['eer']:.4f} at {result['eer_threshold']})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,14 +10,268 @@ class Settings(BaseSettings):
     # This will create a file named `database.db` in the root directory.
     DATABASE_URL: str = "sqlite:///./database.db"
 
+    # Optional URL for the async request handlers. By default it is derived
+    # from DATABASE_URL with the async driver (aiosqlite, asyncpg, aiomysql).
+    ASYNC_DATABASE_URL: str = ""
+
+    # Connection pool of each engine (sync and async). Connections beyond
+    # DB_POOL_SIZE + DB_MAX_OVERFLOW wait up to DB_POOL_TIMEOUT seconds;
+    # DB_POOL_RECYCLE replaces connections older than that many seconds.
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_QUERY_CACHE_SIZE: int = 500
+
+    # Create missing tables on app startup. Turn off where the schema is
+    # managed by migrations, so workers do not all inspect it at boot.
+    DB_CREATE_TABLES: bool = True
+
+    # Rows per batched INSERT/UPDATE round-trip on PostgreSQL.
+    DB_INSERT_PAGE_SIZE: int = 1000
+
+    # SQLite pragmas. WAL lets verifications read while the audit writer
+    # writes; synchronous=NORMAL is durable across crashes in WAL mode.
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+
     # Settings for the face recognition model provider.
     # 'CUDA' for GPU or 'CPU' for CPU.
     PROVIDER: str = "CPU"
 
+    # InsightFace model pack ('buffalo_l', 'buffalo_m', 'buffalo_s' or
+    # 'buffalo_sc') and the modules loaded from it. Embedding a face only
+    # needs detection and recognition, so the landmark and gender/age models
+    # are not loaded by default.
+    MODEL_PACK: str = "buffalo_l"
+    MODEL_MODULES: str = "detection,recognition"
+
+    # Square detector input size. Verification frames are usually close-up
+    # webcam shots, for which a smaller VERIFY_DET_SIZE (e.g. 320) is several
+    # times faster; 0 uses DET_SIZE. Compare configurations on your own
+    # images with `python -m benchmarks.model_configs`.
+    DET_SIZE: int = 640
+    VERIFY_DET_SIZE: int = 0
+
+    # Where model packs are downloaded to and loaded from.
+    MODEL_ROOT: str = "~/.insightface"
+
+    # Models load on app startup (or on first use outside the app) and run
+    # a warm-up inference at each detector size and batch size, so the
+    # first request does not pay for session initialization.
+    MODEL_WARMUP: bool = True
+
+    # ONNX Runtime sessions. ORT_GRAPH_OPTIMIZATION is 'disable', 'basic',
+    # 'extended' or 'all'. Thread counts of 0 let ONNX Runtime choose; with
+    # several uvicorn or inference workers, set intra-op threads to
+    # cores / workers. With ORT_CACHE_OPTIMIZED_MODELS, optimized models are
+    # serialized under ORT_OPTIMIZED_MODEL_DIR (default: MODEL_ROOT/optimized)
+    # and loaded from there on later starts, skipping graph optimization.
+    ORT_GRAPH_OPTIMIZATION: str = "all"
+    ORT_INTRA_OP_THREADS: int = 0
+    ORT_INTER_OP_THREADS: int = 0
+    ORT_CACHE_OPTIMIZED_MODELS: bool = True
+    ORT_OPTIMIZED_MODEL_DIR: str = ""
+
     # Comma-separated list of allowed origins for CORS, or '*' to allow all.
     # Example: "https://example.com,https://app.example.com"
     ALLOWED_ORIGINS: str = "*"
 
+    # Identification gallery index: 'flat' for an exact scan of every user,
+    # or 'ivf' for the approximate inverted-file index in `app/ann.py`.
+    GALLERY_INDEX: str = "flat"
+
+    # IVF tuning. More lists (ANN_NLIST) make each probe cheaper; probing more
+    # lists (ANN_NPROBE) raises recall at the cost of latency.
+    ANN_NLIST: int = 1024
+    ANN_NPROBE: int = 16
+    ANN_TRAIN_SIZE: int = 50000
+    ANN_KMEANS_ITERATIONS: int = 10
+
+    # Optional path of the IVF snapshot file. When set, workers restore the
+    # index from it on startup and write it back on shutdown.
+    ANN_SNAPSHOT_PATH: str = ""
+
+    # How embeddings are stored in the database: 'float32' (exact, 2 KB per
+    # 512-d vector), 'float16' (1 KB) or 'int8' (512 bytes, quantized).
+    EMBEDDING_STORAGE_DTYPE: str = "float32"
+
+    # Where uploaded images are stored. Only 'local' (filesystem, sharded by
+    # SHA-256) is built in; the database keeps just the hash reference.
+    BLOB_STORE_BACKEND: str = "local"
+    BLOB_STORE_PATH: str = "./blobs"
+
+    # What is kept of each captured frame. 'crop' stores the 112x112 aligned
+    # face the embedding was computed from (frames without a usable face keep
+    # only the thumbnail); 'frame' stores the uploaded bytes as before. Both
+    # add a thumbnail of the frame, at most THUMBNAIL_SIZE pixels on its
+    # longer side, which the image endpoints serve by default. Crops and
+    # thumbnails are encoded as IMAGE_FORMAT ('webp' or 'jpeg').
+    IMAGE_STORAGE: str = "crop"
+    IMAGE_FORMAT: str = "webp"
+    IMAGE_QUALITY: int = 90
+    THUMBNAIL_SIZE: int = 160
+    THUMBNAIL_QUALITY: int = 70
+
+    # Micro-batching of concurrent inference calls. Requests wait at most
+    # INFERENCE_BATCH_WAIT_MS for others to join a batch of up to
+    # INFERENCE_BATCH_SIZE frames; larger values favour throughput over p99.
+    # The frames of a batch are detected on INFERENCE_DETECTION_WORKERS
+    # threads (1 = serially on the scheduler thread); with several, consider
+    # lowering ORT_INTRA_OP_THREADS so they do not oversubscribe the cores.
+    INFERENCE_BATCHING: bool = True
+    INFERENCE_BATCH_SIZE: int = 8
+    INFERENCE_BATCH_WAIT_MS: float = 2.0
+    INFERENCE_DETECTION_WORKERS: int = 2
+
+    # Unix socket of a shared inference worker pool (`python -m app.workers`).
+    # When set, API processes send frames to the pool instead of loading the
+    # model, so they can be scaled independently of model memory. The pool
+    # generates a key on every start and keeps it next to the socket, in a
+    # directory only its user can read, so API processes must run as that
+    # user. Requests the pool does not answer within
+    # INFERENCE_POOL_TIMEOUT_SECONDS fail.
+    INFERENCE_POOL_ADDRESS: str = ""
+    INFERENCE_POOL_WORKERS: int = 0  # 0 = one per CPU core
+    INFERENCE_POOL_TIMEOUT_SECONDS: float = 30
+
+    # Bulk enrollment: users written per transaction, and threads used to
+    # decode and embed images in parallel (0 = one per CPU core).
+    ENROLL_BATCH_CHUNK_SIZE: int = 100
+    ENROLL_BATCH_WORKERS: int = 0
+
+    # Audit records (access logs, unknown access, verification captures) are
+    # written by a background thread in bulk, every AUDIT_BATCH_SIZE records
+    # or AUDIT_FLUSH_INTERVAL_MS. When the queue is full, requests wait up to
+    # AUDIT_ENQUEUE_TIMEOUT_MS and then write synchronously. A batch whose
+    # insert fails is retried with exponential backoff; after
+    # AUDIT_MAX_RETRIES failures its records are written one by one and
+    # the ones that still fail are quarantined.
+    AUDIT_ASYNC: bool = True
+    AUDIT_QUEUE_SIZE: int = 10000
+    AUDIT_BATCH_SIZE: int = 200
+    AUDIT_FLUSH_INTERVAL_MS: float = 500
+    AUDIT_ENQUEUE_TIMEOUT_MS: float = 100
+    AUDIT_MAX_RETRIES: int = 5
+
+    # Optional directory for the audit journal. When set, queued records are
+    # also appended to disk and replayed after a crash, and quarantined
+    # records are kept there in quarantine-*.jsonl files.
+    AUDIT_SPILL_DIR: str = ""
+
+    # Uploads larger than MAX_IMAGE_BYTES, or whose header declares more than
+    # MAX_IMAGE_PIXELS, are rejected before decoding. Large JPEGs are decoded
+    # at 1/2, 1/4 or 1/8 scale while the longer side stays at least
+    # IMAGE_DECODE_MIN_SIDE (detection runs at 640x640); 0 disables this.
+    MAX_IMAGE_BYTES: int = 10 * 1024 * 1024
+    MAX_IMAGE_PIXELS: int = 40_000_000
+    IMAGE_DECODE_MIN_SIDE: int = 1280
+
+    # Verification caches active users' templates per worker (LRU, entries
+    # expire after EMBEDDING_CACHE_TTL_SECONDS; size 0 disables). Point
+    # EMBEDDING_CACHE_GENERATION_PATH at a file shared by all workers on the
+    # host to propagate enrollments and deactivations between them
+    # immediately; each worker's identification gallery resyncs with the
+    # database when it sees the shared counter move.
+    EMBEDDING_CACHE_SIZE: int = 10000
+    EMBEDDING_CACHE_TTL_SECONDS: float = 300
+    EMBEDDING_CACHE_GENERATION_PATH: str = ""
+
+    # Bounded thread pool for decoding and inference in the async handlers.
+    # Requests beyond INFERENCE_EXECUTOR_WORKERS running plus
+    # INFERENCE_EXECUTOR_QUEUE waiting are rejected with 429 instead of
+    # queueing without limit (workers 0 = one per CPU core).
+    INFERENCE_EXECUTOR_WORKERS: int = 0
+    INFERENCE_EXECUTOR_QUEUE: int = 32
+
+    # Threads for the blocking writes of async handlers (image captures to
+    # the blob store, audit records when the writer falls back to a
+    # synchronous write).
+    STORAGE_EXECUTOR_WORKERS: int = 8
+
+    # Verification scores a live face against each user's template set (up
+    # to TEMPLATE_MAX_SIZE embeddings): 'centroid' scores the stored centroid
+    # of every enrollment image, as before templates existed, so the existing
+    # SIMILARITY_THRESHOLD still holds; 'max' the best template, and 'topk_mean'
+    # the mean of the best TEMPLATE_TOP_K. 'max' accepts more impostors at
+    # the same SIMILARITY_THRESHOLD, so recalibrate the threshold
+    # (`python -m app.calibration`) before switching.
+    TEMPLATE_SCORING: str = "centroid"
+    TEMPLATE_TOP_K: int = 3
+    TEMPLATE_MAX_SIZE: int = 10
+
+    # With TEMPLATE_REFRESH, successful verifications scoring at least
+    # TEMPLATE_REFRESH_MIN_SIMILARITY are added to the user's templates,
+    # unless they are at least TEMPLATE_REFRESH_MAX_REDUNDANCY similar to one
+    # already there. An impostor accepted once would then be enrolled too,
+    # so keep the minimum well above SIMILARITY_THRESHOLD.
+    TEMPLATE_REFRESH: bool = False
+    TEMPLATE_REFRESH_MIN_SIMILARITY: float = 0.6
+    TEMPLATE_REFRESH_MAX_REDUNDANCY: float = 0.9
+
+    # Streaming verification (/api/verify/stream): similarities of the last
+    # STREAM_WINDOW frames with a face are averaged, and the session accepts
+    # once at least STREAM_MIN_FRAMES are in and the mean reaches
+    # SIMILARITY_THRESHOLD, or rejects when a full window stays below it. It
+    # gives up after STREAM_MAX_FRAMES frames or STREAM_TIMEOUT_SECONDS.
+    STREAM_WINDOW: int = 5
+    STREAM_MIN_FRAMES: int = 3
+    STREAM_MAX_FRAMES: int = 50
+    STREAM_TIMEOUT_SECONDS: float = 15
+
+    # Duplicate-identity check at enrollment: existing users whose centroid
+    # is at least DUPLICATE_THRESHOLD similar to the new one are handled by
+    # DUPLICATE_POLICY: 'flag' (enroll and record the pair for review),
+    # 'link' (enroll and record it as the same person), 'reject' or 'off'
+    # (the default: the check costs a gallery search per enrollment).
+    DUPLICATE_POLICY: str = "off"
+    DUPLICATE_THRESHOLD: float = 0.6
+    DUPLICATE_MAX_MATCHES: int = 5
+
+    # Unknown faces are clustered as they are logged: an attempt with a face
+    # joins the nearest cluster at least UNKNOWN_CLUSTER_THRESHOLD similar to
+    # it, or starts a new one, so repeat intruders show up on
+    # /api/unknown-access/clusters. Rebuild with `python -m app.db.clusters`.
+    # Off by default: it adds a cluster update to every unknown attempt.
+    UNKNOWN_CLUSTERING: bool = False
+    UNKNOWN_CLUSTER_THRESHOLD: float = 0.5
+
+    # Threshold calibration (`python -m app.calibration`, /api/calibration)
+    # scores logged verification attempts against every user and recommends
+    # the lowest threshold whose false accept rate is at most
+    # CALIBRATION_TARGET_FAR. The API scores at most CALIBRATION_MAX_PROBES
+    # of the newest attempts.
+    CALIBRATION_TARGET_FAR: float = 0.001
+    CALIBRATION_MAX_PROBES: int = 100000
+
+    # Sharded deployment (`python -m app.sharding`): the router partitions
+    # users across SHARDS ('name=url,...') by a consistent hash of user_id,
+    # with SHARD_VIRTUAL_NODES points per shard on the hash ring. Shard
+    # requests time out after SHARD_TIMEOUT_SECONDS; when a shard is added,
+    # SHARD_REBALANCE_CONCURRENCY users at a time are moved to it.
+    # SHARD_TOKEN is a secret shared by the router and its shards: shards
+    # only mount the /api/shard endpoints (user export, import and purge)
+    # when it is set, and the router sends it with its calls to them.
+    # SHARD_ADMIN_TOKEN guards the router's ring changes and its
+    # /api/shards/{name}/... passthrough (X-Admin-Token header); they are
+    # disabled without it.
+    SHARDS: str = ""
+    SHARD_TOKEN: str = ""
+    SHARD_ADMIN_TOKEN: str = ""
+    SHARD_VIRTUAL_NODES: int = 128
+    SHARD_TIMEOUT_SECONDS: float = 60
+    SHARD_REBALANCE_CONCURRENCY: int = 8
+
+    # Per-stage timing spans, exported with request latencies as Prometheus
+    # histograms on /metrics. SERVER_TIMING also returns each request's spans
+    # in a Server-Timing header (visible in browser dev tools); leave it off
+    # on public deployments, since it reveals internal timings.
+    METRICS_ENABLED: bool = True
+    SERVER_TIMING: bool = False
+
     class Config:
         case_sensitive = True
 
@@ -0,0 +1,329 @@
+"""
+Incremental clustering of unknown faces, to spot repeat intruders.
+
+Every unknown access attempt with a face is assigned, in the same
+transaction as its row, to the nearest cluster in `unknown_clusters` at
+least UNKNOWN_CLUSTER_THRESHOLD similar to it, or starts a new cluster.
+Clusters keep a running mean centroid, the attempt count and the first and
+last time they were seen, so the faces that keep coming back can be listed
+without scanning the log.
+
+Each process caches the centroids in one float32 matrix, and a batch of
+attempts from the audit writer is assigned with a single matrix product.
+The cache picks up clusters written by other processes through their
+`updated_at`, and the clusters a batch joins are re-read under a row lock
+before their centroids are updated, so concurrent writers never overwrite
+each other's attempts; processes racing on the same new face may still
+each start a cluster for it. Rebuild the clusters from every stored embedding with:
+
+    python -m app.db.clusters recluster [--threshold 0.5] [--batch-size 1000]
+
+The rebuild streams the log twice in keyset batches (leader clustering,
+then reassignment of every attempt to its nearest final centroid), so its
+memory grows with the number of clusters, not of attempts.
+"""
+import argparse
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import case
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from . import models
+
+# Scores computed per block of centroids, to bound the memory of a batch
+BLOCK_SCORES = 16 * 1024 * 1024
+
+# Rows updated this long before the last sync are read again, so clusters
+# committed by other processes just after it are not missed
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def nearest(vectors: np.ndarray, centroids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Index and similarity of each vector's most similar centroid, a block of centroids at a time."""
+    best = np.zeros(len(vectors), dtype=np.int64)
+    scores = np.full(len(vectors), -np.inf, dtype=np.float32)
+    step = max(1, BLOCK_SCORES // max(len(vectors), 1))
+    for start in range(0, len(centroids), step):
+        block = vectors @ centroids[start:start + step].T
+        block_best = block.argmax(axis=1)
+        block_scores = block[np.arange(len(vectors)), block_best]
+        better = block_scores > scores
+        best[better] = block_best[better] + start
+        scores[better] = block_scores[better]
+    return best, scores
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Leader clustering of a batch of unit vectors. Each is labelled with its
+    nearest centroid if at least `threshold` similar. The first of the others
+    starts a new cluster (labelled len(centroids), then upwards), which every
+    remaining vector at least `threshold` similar to it joins, and so on.
+    Returns (labels, rows of the vectors that started new clusters).
+    """
+    labels = np.full(len(vectors), -1, dtype=np.int64)
+    if len(centroids):
+        best, scores = nearest(vectors, centroids)
+        hits = scores >= threshold
+        labels[hits] = best[hits]
+    pending = np.flatnonzero(labels < 0)
+    seeds: List[int] = []
+    if len(pending):
+        similar = vectors[pending] @ vectors[pending].T >= threshold
+        unlabelled = np.ones(len(pending), dtype=bool)
+        for index in range(len(pending)):
+            if not unlabelled[index]:
+                continue
+            members = similar[index] & unlabelled
+            labels[pending[members]] = len(centroids) + len(seeds)
+            unlabelled &= ~members
+            seeds.append(pending[index])
+    return labels, np.array(seeds, dtype=np.int64)
+
+
+class ClusterCache:
+    """Per-process copy of the cluster centroids and counts, synced from `unknown_clusters`."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget every cluster; the next sync reloads them all."""
+        self.ids: List[int] = []
+        self.rows: Dict[int, int] = {}
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.synced_at: Optional[datetime] = None
+
+    def put(self, cluster_id: int, centroid: np.ndarray, count: int):
+        row = self.rows.get(cluster_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.centroids):
+                # Grow geometrically, as the gallery does
+                grown = np.empty((max(1024, row * 2), len(centroid)), dtype=np.float32)
+                if row:
+                    grown[:row] = self.centroids[:row]
+                self.centroids = grown
+                self.counts = np.resize(self.counts, len(grown))
+            self.ids.append(cluster_id)
+            self.rows[cluster_id] = row
+        self.centroids[row] = centroid
+        self.counts[row] = count
+
+    def sync(self, db: Session):
+        """Load clusters created or updated (by any process) since the last sync."""
+        now = datetime.utcnow()
+        query = db.query(models.UnknownCluster.id, models.UnknownCluster.centroid, models.UnknownCluster.attempts)
+        if self.synced_at is not None:
+            query = query.filter(models.UnknownCluster.updated_at >= self.synced_at - SYNC_OVERLAP)
+        for cluster_id, centroid, attempts in query:
+            self.put(cluster_id, _unit_rows(centroid)[0], attempts)
+        self.synced_at = now
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.centroids[:len(self.ids)]
+
+
+# Shared by the logging functions of this process
+cluster_cache = ClusterCache()
+
+
+def assign_attempts(db: Session, records: List[dict]):
+    """
+    Set `cluster_id` on unknown access records that have an embedding,
+    updating and creating their clusters in the session (the caller commits).
+    """
+    if not settings.UNKNOWN_CLUSTERING:
+        return
+    faces = [record for record in records if record.get("embedding") is not None]
+    if not faces:
+        return
+    vectors = _unit_rows(np.stack([np.asarray(record["embedding"], dtype=np.float32).ravel() for record in faces]))
+    seen = [record.get("created_at") or datetime.utcnow() for record in faces]
+
+    with cluster_cache.lock:
+        cluster_cache.sync(db)
+        existing = len(cluster_cache.ids)
+        labels, _ = assign(vectors, cluster_cache.vectors, settings.UNKNOWN_CLUSTER_THRESHOLD)
+        # Other processes update the same clusters from their own caches, so
+        # the current centroids and counts are read under a row lock (in id
+        # order, so concurrent batches cannot deadlock) before adding to them
+        touched = sorted(cluster_cache.ids[label] for label in np.unique(labels) if label < existing)
+        current = {
+            row.id: row for row in db.query(
+                models.UnknownCluster.id, models.UnknownCluster.centroid, models.UnknownCluster.attempts
+            ).filter(models.UnknownCluster.id.in_(touched)).order_by(models.UnknownCluster.id).with_for_update()
+        } if touched else {}
+        created = []
+        stale = False
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            total = vectors[members].sum(axis=0)
+            first = min(seen[i] for i in members)
+            last = max(seen[i] for i in members)
+            cluster_id = None
+            if label < existing:
+                row = current.get(cluster_cache.ids[label])
+                if row is not None:
+                    cluster_id = row.id
+                    count = row.attempts + len(members)
+                    centroid = _unit_rows(_unit_rows(row.centroid)[0] * row.attempts + total)[0]
+                    db.query(models.UnknownCluster).filter(models.UnknownCluster.id == cluster_id).update({
+                        models.UnknownCluster.attempts: count,
+                        models.UnknownCluster.centroid: centroid,
+                        models.UnknownCluster.last_seen: case(
+                            (models.UnknownCluster.last_seen < last, last), else_=models.UnknownCluster.last_seen
+                        ),
+                        models.UnknownCluster.updated_at: datetime.utcnow(),
+                    }, synchronize_session=False)
+                    cluster_cache.put(cluster_id, centroid, count)
+                else:
+                    # Removed by a rebuild: start a new cluster, and reload the table on the next call
+                    stale = True
+            if cluster_id is None:
+                cluster = models.UnknownCluster(
+                    centroid=_unit_rows(total)[0], attempts=len(members), first_seen=first, last_seen=last
+                )
+                db.add(cluster)
+                created.append((cluster, members))
+            else:
+                for i in members:
+                    faces[i]["cluster_id"] = cluster_id
+        if created:
+            db.flush()
+            for cluster, members in created:
+                cluster_cache.put(cluster.id, cluster.centroid, cluster.attempts)
+                for i in members:
+                    faces[i]["cluster_id"] = cluster.id
+        if stale:
+            cluster_cache.reset()
+
+
+def _embedding_batches(engine: Engine, batch_size: int):
+    """(ids, unit embeddings, created_at) of unknown attempts with a face, in keyset batches."""
+    last_id = 0
+    while True:
+        with Session(engine) as db:
+            rows = db.query(
+                models.UnknownAccess.id, models.UnknownAccess.embedding, models.UnknownAccess.created_at
+            ).filter(
+                models.UnknownAccess.embedding.isnot(None), models.UnknownAccess.id > last_id
+            ).order_by(models.UnknownAccess.id).limit(batch_size).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [row.id for row in rows], _unit_rows(np.stack([row.embedding for row in rows])), [row.created_at for row in rows]
+
+
+def recluster(engine: Engine, threshold: Optional[float] = None, batch_size: int = 1000) -> int:
+    """
+    Rebuild `unknown_clusters` and every attempt's `cluster_id` from the
+    stored embeddings; returns the number of clusters. Attempts logged while
+    it runs join the new clusters in the second pass or start their own.
+    """
+    threshold = settings.UNKNOWN_CLUSTER_THRESHOLD if threshold is None else threshold
+
+    # Pass 1: leader clustering, keeping only the running sums
+    sums = np.empty((0, 0), dtype=np.float32)
+    count = 0
+    rows = 0
+    for _, vectors, _ in _embedding_batches(engine, batch_size):
+        labels, seeds = assign(vectors, _unit_rows(sums[:count]) if count else sums[:0], threshold)
+        if count + len(seeds) > len(sums):
+            grown = np.zeros((max(1024, 2 * (count + len(seeds))), vectors.shape[1]), dtype=np.float32)
+            if count:
+                grown[:count] = sums[:count]
+            sums = grown
+        count += len(seeds)
+        np.add.at(sums, labels, vectors)
+        rows += len(vectors)
+        print(f"pass 1: {rows} attempts, {count} clusters")
+    centroids = _unit_rows(sums[:count]) if count else np.empty((0, 0), dtype=np.float32)
+    del sums
+
+    # Replace the clusters, then move every attempt to its nearest final centroid
+    with Session(engine) as db:
+        db.query(models.UnknownCluster).delete(synchronize_session=False)
+        now = datetime.utcnow()
+        clusters = [
+            models.UnknownCluster(centroid=centroid, attempts=0, first_seen=now, last_seen=now)
+            for centroid in centroids
+        ]
+        db.add_all(clusters)
+        db.flush()
+        ids = np.array([cluster.id for cluster in clusters], dtype=np.int64)
+        db.commit()
+    cluster_cache.reset()
+    if not count:
+        return 0
+
+    totals = np.zeros_like(centroids)
+    counts = np.zeros(count, dtype=np.int64)
+    # Seen times as datetime64, reduced per cluster with ufunc.at
+    first_seen = np.full(count, np.datetime64(now, "us"))
+    last_seen = np.full(count, np.datetime64("1970-01-01", "us"))
+    rows = 0
+    for attempt_ids, vectors, created in _embedding_batches(engine, batch_size):
+        labels, _ = nearest(vectors, centroids)
+        np.add.at(totals, labels, vectors)
+        np.add.at(counts, labels, 1)
+        seen = np.array([when or now for when in created], dtype="datetime64[us]")
+        np.minimum.at(first_seen, labels, seen)
+        np.maximum.at(last_seen, labels, seen)
+        with Session(engine) as db:
+            db.bulk_update_mappings(models.UnknownAccess, [
+                {"id": attempt_id, "cluster_id": int(ids[label])} for attempt_id, label in zip(attempt_ids, labels.tolist())
+            ])
+            db.commit()
+        rows += len(attempt_ids)
+        print(f"pass 2: {rows} attempts assigned")
+
+    # Final statistics; clusters that lost every attempt to a neighbour are dropped
+    kept = np.flatnonzero(counts)
+    with Session(engine) as db:
+        db.bulk_update_mappings(models.UnknownCluster, [
+            {
+                "id": int(ids[label]), "centroid": _unit_rows(totals[label])[0], "attempts": int(counts[label]),
+                "first_seen": first_seen[label].item(), "last_seen": last_seen[label].item(),
+                "updated_at": datetime.utcnow(),
+            }
+            for label in kept.tolist()
+        ])
+        empty = ids[counts == 0].tolist()
+        if empty:
+            db.query(models.UnknownCluster).filter(models.UnknownCluster.id.in_(empty)).delete(synchronize_session=False)
+        db.commit()
+    return len(kept)
+
+
+def main():
+    from .database import engine
+    from .migrate import upgrade_schema
+
+    parser = argparse.ArgumentParser(description="Rebuild the clusters of unknown faces.")
+    parser.add_argument("command", choices=["recluster"])
+    parser.add_argument("--threshold", type=float, default=settings.UNKNOWN_CLUSTER_THRESHOLD)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    upgrade_schema(engine)
+    clusters = recluster(engine, args.threshold, args.batch_size)
+    print(f"unknown_clusters: {clusters} clusters")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,192 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import desc, func, tuple_
+import base64
 import numpy as np
 from datetime import datetime, timedelta
-from typing import List, Optional
-from . import models
+from typing import List, Optional, Tuple
+from . import clusters, models, rollups
+from ..metrics import timed
+
+# Columns returned by log listings and exports; embeddings and legacy base64
+# images are only read when explicitly asked for.
+ACCESS_LOG_COLUMNS = [
+    models.AccessLog.id, models.AccessLog.user_id, models.AccessLog.access_type,
+    models.AccessLog.success, models.AccessLog.similarity_score, models.AccessLog.ip_address,
+    models.AccessLog.user_agent, models.AccessLog.image_ref, models.AccessLog.thumbnail_ref,
+    models.AccessLog.created_at,
+]
+UNKNOWN_ACCESS_COLUMNS = [
+    models.UnknownAccess.id, models.UnknownAccess.attempted_user_id, models.UnknownAccess.ip_address,
+    models.UnknownAccess.user_agent, models.UnknownAccess.image_ref, models.UnknownAccess.thumbnail_ref,
+    models.UnknownAccess.cluster_id, models.UnknownAccess.created_at,
+]
+
+# Keyset pagination
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Opaque cursor pointing just past a row in (created_at, id) order."""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+def next_cursor(rows: list, limit: int) -> Optional[str]:
+    """Cursor for the page after `rows`, or None if this was the last page."""
+    if len(rows) < limit or not rows:
+        return None
+    return encode_cursor(rows[-1].created_at, rows[-1].id)
+
+def _keyset_page(query, model, cursor: Optional[str], skip: int, limit: int):
+    """Newest-first page, continuing after `cursor` (or OFFSET `skip` for old clients)."""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, row_id))
+    query = query.order_by(desc(model.created_at), desc(model.id))
+    if skip and not cursor:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 # User Management
+@timed("crud.get_user")
 def get_user(db: Session, user_id: str):
     """Retrieve a user by their unique ID."""
     return db.query(models.User).filter(models.User.id == user_id, models.User.is_active == True).first()
 
-def create_user(db: Session, user_id: str, embedding: np.ndarray):
+@timed("crud.create_user")
+def create_user(db: Session, user_id: str, embedding: np.ndarray, templates: Optional[np.ndarray] = None):
     """Create a new user entry in the database."""
-    db_user = models.User(id=user_id, embedding=embedding)
+    db_user = models.User(id=user_id, embedding=embedding, templates=templates)
     db.add(db_user)
+    delta = rollups.StatsDelta()
+    delta.enrolled(1)
+    rollups.apply(db, delta)
     db.commit()
     db.refresh(db_user)
     return db_user
 
+@timed("crud.get_existing_user_ids")
+def get_existing_user_ids(db: Session, user_ids: List[str]) -> set:
+    """Return which of the given IDs are already taken (active or not)."""
+    if not user_ids:
+        return set()
+    rows = db.query(models.User.id).filter(models.User.id.in_(user_ids)).all()
+    return {row.id for row in rows}
+
+@timed("crud.bulk_enroll")
+def bulk_enroll(db: Session, users: List[dict], images: List[dict], access_logs: List[dict],
+                duplicates: Optional[List[dict]] = None):
+    """Insert users, their enrollment images, access logs and duplicate records with bulk inserts in one transaction."""
+    try:
+        db.bulk_insert_mappings(models.User, users)
+        db.bulk_insert_mappings(models.UserImage, images)
+        db.bulk_insert_mappings(models.AccessLog, access_logs)
+        if duplicates:
+            db.bulk_insert_mappings(models.DuplicateIdentity, duplicates)
+        delta = rollups.StatsDelta()
+        delta.enrolled(len(users))
+        for log in access_logs:
+            delta.access_attempt(log["user_id"], log["success"], log.get("created_at"))
+        rollups.apply(db, delta)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+def get_active_user_embeddings(db: Session, batch_size: int = 1000, oldest_first: bool = False):
+    """Stream (user_id, embedding) pairs for all active users, optionally in enrollment order."""
+    query = db.query(models.User.id, models.User.embedding).filter(models.User.is_active == True)
+    if oldest_first:
+        query = query.order_by(models.User.created_at, models.User.id)
+    return query.yield_per(batch_size)
+
+def get_active_user_templates(db: Session, batch_size: int = 1000):
+    """Stream (user_id, embedding, templates) for all active users."""
+    return db.query(models.User.id, models.User.embedding, models.User.templates).filter(
+        models.User.is_active == True
+    ).yield_per(batch_size)
+
+def get_users_updated_since(db: Session, since: datetime, batch_size: int = 1000):
+    """Stream (user_id, embedding, is_active) for users created or changed since a point in time."""
+    return db.query(models.User.id, models.User.embedding, models.User.is_active).filter(
+        models.User.updated_at >= since
+    ).yield_per(batch_size)
+
+@timed("crud.update_user_templates")
+def update_user_templates(db: Session, user_id: str, templates: np.ndarray) -> bool:
+    """Replace an active user's template set."""
+    updated = db.query(models.User).filter(
+        models.User.id == user_id, models.User.is_active == True
+    ).update(
+        # Keep updated_at: the centroid, and so the identification gallery, is unchanged
+        {models.User.templates: templates, models.User.updated_at: models.User.updated_at},
+        synchronize_session=False
+    )
+    db.commit()
+    return bool(updated)
+
+@timed("crud.get_all_users")
 def get_all_users(db: Session, skip: int = 0, limit: int = 100):
     """Get all active users with pagination."""
     return db.query(models.User).filter(models.User.is_active == True).offset(skip).limit(limit).all()
 
+@timed("crud.deactivate_user")
 def deactivate_user(db: Session, user_id: str):
     """Deactivate a user (soft delete)."""
     user = get_user(db, user_id)
     if user:
         user.is_active = False
         user.updated_at = datetime.utcnow()
+        delta = rollups.StatsDelta()
+        delta.enrolled(-1)
+        rollups.apply(db, delta)
         db.commit()
         return user
     return None
 
+@timed("crud.count_active_users")
+def count_active_users(db: Session) -> int:
+    """Number of active users."""
+    return db.query(func.count(models.User.id)).filter(models.User.is_active == True).scalar()
+
+@timed("crud.get_active_user_ids")
+def get_active_user_ids(db: Session, after: Optional[str] = None, limit: int = 1000) -> List[str]:
+    """Active user IDs in ID order, after the given one (keyset pagination)."""
+    query = db.query(models.User.id).filter(models.User.is_active == True)
+    if after is not None:
+        query = query.filter(models.User.id > after)
+    return [row.id for row in query.order_by(models.User.id).limit(limit)]
+
+@timed("crud.purge_user")
+def purge_user(db: Session, user_id: str) -> bool:
+    """
+    Delete an active user and their images outright, once they have been
+    copied to another shard. Access logs stay behind as history.
+    """
+    deleted = db.query(models.User).filter(
+        models.User.id == user_id, models.User.is_active == True
+    ).delete(synchronize_session=False)
+    if not deleted:
+        db.rollback()
+        return False
+    db.query(models.UserImage).filter(models.UserImage.user_id == user_id).delete(synchronize_session=False)
+    delta = rollups.StatsDelta()
+    delta.enrolled(-1)
+    rollups.apply(db, delta)
+    db.commit()
+    return True
+
 # Image Management
-def store_user_image(db: Session, user_id: str, image_data: str, embedding: np.ndarray, image_type: str):
-    """Store a user's image with its embedding."""
+@timed("crud.store_user_image")
+def store_user_image(db: Session, user_id: str, image_ref: Optional[str], embedding: np.ndarray, image_type: str,
+                     thumbnail_ref: Optional[str] = None):
+    """Store a reference to a user's image with its embedding."""
     db_image = models.UserImage(
         user_id=user_id,
-        image_data=image_data,
+        image_ref=image_ref,
+        thumbnail_ref=thumbnail_ref,
         embedding=embedding,
         image_type=image_type
     )
@@ -46,6 +195,15 @@ def store_user_image(db: Session, user_id: str, image_data: str, embedding: np.n
     db.refresh(db_image)
     return db_image
 
+@timed("crud.get_user_image")
+def get_user_image(db: Session, user_id: str, image_id: int):
+    """Get a single image belonging to a user."""
+    return db.query(models.UserImage).filter(
+        models.UserImage.id == image_id,
+        models.UserImage.user_id == user_id
+    ).first()
+
+@timed("crud.get_user_images")
 def get_user_images(db: Session, user_id: str, image_type: Optional[str] = None):
     """Get all images for a specific user."""
     query = db.query(models.UserImage).filter(models.UserImage.user_id == user_id)
@@ -54,69 +212,171 @@ def get_user_images(db: Session, user_id: str, image_type: Optional[str] = None)
     return query.order_by(desc(models.UserImage.created_at)).all()
 
 # Access Logging
+@timed("crud.log_access_attempt")
 def log_access_attempt(db: Session, user_id: str, access_type: str, success: bool, 
-                      image_data: Optional[str] = None, embedding: Optional[np.ndarray] = None,
+                      image_ref: Optional[str] = None, embedding: Optional[np.ndarray] = None,
                       similarity_score: Optional[float] = None, ip_address: Optional[str] = None,
-                      user_agent: Optional[str] = None):
+                      user_agent: Optional[str] = None, thumbnail_ref: Optional[str] = None):
     """Log an access attempt."""
     db_log = models.AccessLog(
         user_id=user_id,
         access_type=access_type,
         success=success,
-        image_data=image_data,
+        image_ref=image_ref,
+        thumbnail_ref=thumbnail_ref,
         embedding=embedding,
         similarity_score=similarity_score,
         ip_address=ip_address,
         user_agent=user_agent
     )
     db.add(db_log)
+    delta = rollups.StatsDelta()
+    delta.access_attempt(user_id, success)
+    rollups.apply(db, delta)
     db.commit()
     db.refresh(db_log)
     return db_log
 
-def get_access_logs(db: Session, user_id: Optional[str] = None, skip: int = 0, limit: int = 100):
-    """Get access logs with optional user filtering."""
-    query = db.query(models.AccessLog)
+@timed("crud.bulk_insert_audit_records")
+def bulk_insert_audit_records(db: Session, access_logs: List[dict], unknown_access: List[dict], user_images: List[dict]):
+    """Write queued access logs, unknown access records and image captures in one transaction."""
+    try:
+        if access_logs:
+            db.bulk_insert_mappings(models.AccessLog, access_logs)
+        if unknown_access:
+            clusters.assign_attempts(db, unknown_access)
+            db.bulk_insert_mappings(models.UnknownAccess, unknown_access)
+        if user_images:
+            db.bulk_insert_mappings(models.UserImage, user_images)
+        delta = rollups.StatsDelta()
+        for log in access_logs:
+            delta.access_attempt(log["user_id"], log["success"], log.get("created_at"))
+        for record in unknown_access:
+            delta.unknown_attempt(record.get("created_at"))
+        rollups.apply(db, delta)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+@timed("crud.get_access_logs")
+def get_access_logs(db: Session, user_id: Optional[str] = None, skip: int = 0, limit: int = 100,
+                    cursor: Optional[str] = None):
+    """Get a page of access logs (newest first) with optional user filtering."""
+    query = db.query(*ACCESS_LOG_COLUMNS)
     if user_id:
         query = query.filter(models.AccessLog.user_id == user_id)
-    return query.order_by(desc(models.AccessLog.created_at)).offset(skip).limit(limit).all()
+    return _keyset_page(query, models.AccessLog, cursor, skip, limit)
 
-def get_recent_access_logs(db: Session, hours: int = 24):
-    """Get access logs from the last N hours."""
+@timed("crud.get_recent_access_logs")
+def get_recent_access_logs(db: Session, hours: int = 24, skip: int = 0, limit: int = 100,
+                           cursor: Optional[str] = None):
+    """Get a page of access logs from the last N hours (newest first)."""
     since = datetime.utcnow() - timedelta(hours=hours)
-    return db.query(models.AccessLog).filter(
-        models.AccessLog.created_at >= since
-    ).order_by(desc(models.AccessLog.created_at)).all()
+    query = db.query(*ACCESS_LOG_COLUMNS).filter(models.AccessLog.created_at >= since)
+    return _keyset_page(query, models.AccessLog, cursor, skip, limit)
+
+def iter_access_logs(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     user_id: Optional[str] = None, include_embeddings: bool = False, batch_size: int = 1000):
+    """Stream access logs oldest first through a server-side cursor, `batch_size` rows at a time."""
+    columns = ACCESS_LOG_COLUMNS + ([models.AccessLog.embedding] if include_embeddings else [])
+    query = db.query(*columns)
+    if user_id:
+        query = query.filter(models.AccessLog.user_id == user_id)
+    if since:
+        query = query.filter(models.AccessLog.created_at >= since)
+    if until:
+        query = query.filter(models.AccessLog.created_at < until)
+    return query.order_by(models.AccessLog.created_at, models.AccessLog.id).yield_per(batch_size)
+
+def iter_attempt_embeddings(db: Session, access_types: Tuple[str, ...], since: Optional[datetime] = None,
+                            until: Optional[datetime] = None, limit: Optional[int] = None, batch_size: int = 1000):
+    """Stream (user_id, embedding) of logged attempts of the given types that have an embedding, newest first."""
+    query = db.query(models.AccessLog.user_id, models.AccessLog.embedding).filter(
+        models.AccessLog.access_type.in_(access_types), models.AccessLog.embedding.isnot(None)
+    )
+    if since:
+        query = query.filter(models.AccessLog.created_at >= since)
+    if until:
+        query = query.filter(models.AccessLog.created_at < until)
+    query = query.order_by(desc(models.AccessLog.created_at), desc(models.AccessLog.id))
+    if limit:
+        query = query.limit(limit)
+    return query.yield_per(batch_size)
 
 # Unknown Access Tracking
-def log_unknown_access(db: Session, image_data: str, embedding: Optional[np.ndarray] = None,
+@timed("crud.log_unknown_access")
+def log_unknown_access(db: Session, image_ref: Optional[str], embedding: Optional[np.ndarray] = None,
                       attempted_user_id: Optional[str] = None, ip_address: Optional[str] = None,
-                      user_agent: Optional[str] = None):
-    """Log an access attempt by unknown user."""
-    db_unknown = models.UnknownAccess(
-        image_data=image_data,
+                      user_agent: Optional[str] = None, thumbnail_ref: Optional[str] = None):
+    """Log an access attempt by unknown user, adding its face to the nearest unknown face cluster."""
+    record = dict(
+        image_ref=image_ref,
+        thumbnail_ref=thumbnail_ref,
         embedding=embedding,
         attempted_user_id=attempted_user_id,
         ip_address=ip_address,
         user_agent=user_agent
     )
+    clusters.assign_attempts(db, [record])
+    db_unknown = models.UnknownAccess(**record)
     db.add(db_unknown)
+    delta = rollups.StatsDelta()
+    delta.unknown_attempt()
+    rollups.apply(db, delta)
     db.commit()
     db.refresh(db_unknown)
     return db_unknown
 
-def get_unknown_access_logs(db: Session, skip: int = 0, limit: int = 100):
-    """Get unknown access attempts."""
-    return db.query(models.UnknownAccess).order_by(desc(models.UnknownAccess.created_at)).offset(skip).limit(limit).all()
+@timed("crud.get_unknown_access")
+def get_unknown_access(db: Session, attempt_id: int):
+    """Get a single unknown access attempt."""
+    return db.query(models.UnknownAccess).filter(models.UnknownAccess.id == attempt_id).first()
+
+@timed("crud.get_unknown_access_logs")
+def get_unknown_access_logs(db: Session, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    """Get a page of unknown access attempts (newest first)."""
+    return _keyset_page(db.query(*UNKNOWN_ACCESS_COLUMNS), models.UnknownAccess, cursor, skip, limit)
+
+def iter_unknown_access(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                        include_embeddings: bool = False, batch_size: int = 1000):
+    """Stream unknown access attempts oldest first through a server-side cursor."""
+    columns = UNKNOWN_ACCESS_COLUMNS + ([models.UnknownAccess.embedding] if include_embeddings else [])
+    query = db.query(*columns)
+    if since:
+        query = query.filter(models.UnknownAccess.created_at >= since)
+    if until:
+        query = query.filter(models.UnknownAccess.created_at < until)
+    return query.order_by(models.UnknownAccess.created_at, models.UnknownAccess.id).yield_per(batch_size)
+
+@timed("crud.get_unknown_clusters")
+def get_unknown_clusters(db: Session, min_attempts: int = 2, since: Optional[datetime] = None,
+                         skip: int = 0, limit: int = 50):
+    """Unknown face clusters with the most attempts first, optionally only those seen since a time."""
+    query = db.query(models.UnknownCluster).filter(models.UnknownCluster.attempts >= min_attempts)
+    if since:
+        query = query.filter(models.UnknownCluster.last_seen >= since)
+    return query.order_by(desc(models.UnknownCluster.attempts), models.UnknownCluster.id).offset(skip).limit(limit).all()
+
+@timed("crud.get_unknown_cluster")
+def get_unknown_cluster(db: Session, cluster_id: int):
+    return db.query(models.UnknownCluster).filter(models.UnknownCluster.id == cluster_id).first()
+
+@timed("crud.get_cluster_attempts")
+def get_cluster_attempts(db: Session, cluster_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    """Get a page of one cluster's unknown access attempts (newest first)."""
+    query = db.query(*UNKNOWN_ACCESS_COLUMNS).filter(models.UnknownAccess.cluster_id == cluster_id)
+    return _keyset_page(query, models.UnknownAccess, cursor, skip, limit)
 
 # Analytics Functions
-def get_user_stats(db: Session, user_id: str):
-    """Get statistics for a specific user."""
-    total_attempts = db.query(models.AccessLog).filter(models.AccessLog.user_id == user_id).count()
-    successful_attempts = db.query(models.AccessLog).filter(
-        models.AccessLog.user_id == user_id, 
-        models.AccessLog.success == True
-    ).count()
+# Counters come from the access_stats rollups kept up to date by the logging
+# functions above (rebuild with `python -m app.db.migrate stats`).
+@timed("crud.get_user_stats")
+def get_user_stats(db: Session, user_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Get statistics for a specific user, optionally within [since, until)."""
+    counters = rollups.totals(db, user_id, since, until)
+    total_attempts = counters["total_attempts"]
+    successful_attempts = counters["successful_attempts"]
     failed_attempts = total_attempts - successful_attempts
     
     return {
@@ -127,12 +387,15 @@ def get_user_stats(db: Session, user_id: str):
         "success_rate": (successful_attempts / total_attempts * 100) if total_attempts > 0 else 0
     }
 
-def get_system_stats(db: Session):
-    """Get overall system statistics."""
-    total_users = db.query(models.User).filter(models.User.is_active == True).count()
-    total_access_attempts = db.query(models.AccessLog).count()
-    successful_attempts = db.query(models.AccessLog).filter(models.AccessLog.success == True).count()
-    unknown_attempts = db.query(models.UnknownAccess).count()
+@timed("crud.get_system_stats")
+def get_system_stats(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Get overall system statistics; attempt counts can be limited to [since, until)."""
+    all_time = rollups.totals(db)
+    counters = rollups.totals(db, since=since, until=until) if since or until else all_time
+    total_users = all_time["enrolled_users"]
+    total_access_attempts = counters["total_attempts"]
+    successful_attempts = counters["successful_attempts"]
+    unknown_attempts = counters["unknown_attempts"]
     
     return {
         "total_users": total_users,
@@ -141,4 +404,55 @@ def get_system_stats(db: Session):
         "failed_attempts": total_access_attempts - successful_attempts,
         "unknown_attempts": unknown_attempts,
         "success_rate": (successful_attempts / total_access_attempts * 100) if total_access_attempts > 0 else 0
-    }
\ No newline at end of file
+    }
+
+@timed("crud.get_stats_timeseries")
+def get_stats_timeseries(db: Session, granularity: str = "hour", user_id: Optional[str] = None,
+                         since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Get per-hour or per-day counter buckets, system-wide or for one user."""
+    if granularity not in (rollups.HOUR, rollups.DAY):
+        raise ValueError("granularity must be 'hour' or 'day'")
+    return rollups.series(db, granularity, user_id or rollups.GLOBAL, since, until)
+
+# Duplicate identities
+@timed("crud.get_duplicate_pairs")
+def get_duplicate_pairs(db: Session, pairs: List[Tuple[str, str]], chunk_size: int = 500) -> set:
+    """Which of the given (user_id, duplicate_of) pairs are recorded, in either order."""
+    candidates = list({pair for user_id, other in pairs for pair in ((user_id, other), (other, user_id))})
+    known = set()
+    pair_column = tuple_(models.DuplicateIdentity.user_id, models.DuplicateIdentity.duplicate_of)
+    for start in range(0, len(candidates), chunk_size):
+        rows = db.query(models.DuplicateIdentity.user_id, models.DuplicateIdentity.duplicate_of).filter(
+            pair_column.in_(candidates[start:start + chunk_size])
+        )
+        known.update((row.user_id, row.duplicate_of) for row in rows)
+    return known
+
+@timed("crud.record_duplicates")
+def record_duplicates(db: Session, duplicates: List[dict]) -> int:
+    """Insert duplicate records, skipping pairs already recorded (or repeated) in either order."""
+    known = get_duplicate_pairs(db, [(record["user_id"], record["duplicate_of"]) for record in duplicates])
+    fresh = []
+    for record in duplicates:
+        pair = (record["user_id"], record["duplicate_of"])
+        if pair in known or pair[::-1] in known:
+            continue
+        known.add(pair)
+        fresh.append(record)
+    if fresh:
+        db.bulk_insert_mappings(models.DuplicateIdentity, fresh)
+        db.commit()
+    return len(fresh)
+
+@timed("crud.get_duplicates")
+def get_duplicates(db: Session, user_id: Optional[str] = None, status: Optional[str] = None,
+                   skip: int = 0, limit: int = 100):
+    """Get duplicate records (newest first), optionally involving one user or with one status."""
+    query = db.query(models.DuplicateIdentity)
+    if user_id:
+        query = query.filter(
+            (models.DuplicateIdentity.user_id == user_id) | (models.DuplicateIdentity.duplicate_of == user_id)
+        )
+    if status:
+        query = query.filter(models.DuplicateIdentity.status == status)
+    return query.order_by(desc(models.DuplicateIdentity.created_at), desc(models.DuplicateIdentity.id)).offset(skip).limit(limit).all()
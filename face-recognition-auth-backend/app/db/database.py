@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
@@ -7,11 +10,99 @@ from app.core.config import settings
 # connect_args parameter to allow multi-threaded access in some setups.
 is_sqlite = isinstance(settings.DATABASE_URL, str) and settings.DATABASE_URL.startswith("sqlite")
 
-# Create the SQLAlchemy engine. Only pass connect_args for SQLite.
-if is_sqlite:
-    engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(settings.DATABASE_URL)
+def _is_memory_sqlite(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def engine_options(url: str) -> dict:
+    """Keyword arguments for `create_engine` / `create_async_engine`, from Settings."""
+    parsed = make_url(url)
+    options = {"query_cache_size": settings.DB_QUERY_CACHE_SIZE}
+    if parsed.get_backend_name() == "sqlite":
+        if parsed.get_driver_name() == "pysqlite":
+            options["connect_args"] = {"check_same_thread": False}
+        if _is_memory_sqlite(parsed):
+            # In-memory databases live in a single connection; pool sizing does not apply
+            return options
+    options.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+    if parsed.get_backend_name() == "postgresql":
+        # Rows per multi-VALUES INSERT for bulk writes (audit batches, bulk enrollment)
+        options["insertmanyvalues_page_size"] = settings.DB_INSERT_PAGE_SIZE
+        if parsed.get_driver_name() == "psycopg2":
+            # Also batch executemany UPDATEs (migrations) instead of one round-trip per row
+            options["executemany_mode"] = "values_plus_batch"
+            options["executemany_batch_page_size"] = settings.DB_INSERT_PAGE_SIZE
+    return options
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the single writer; busy_timeout waits for the lock instead of failing."""
+    cursor = dbapi_connection.cursor()
+    if settings.SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+class PoolMetrics:
+    """Checkout counters for an engine's connection pool."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        capacity = None
+        if hasattr(pool, "size") and hasattr(pool, "_max_overflow"):
+            capacity = pool.size() + max(pool._max_overflow, 0)
+        with self._lock:
+            return {
+                "pool": type(pool).__name__,
+                "status": pool.status(),
+                "capacity": capacity,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "utilization": self.in_use / capacity if capacity else None,
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+            }
+
+def configure_engine(engine: Engine) -> PoolMetrics:
+    """Attach SQLite pragmas and pool metrics to a (sync or async's underlying) engine."""
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return PoolMetrics(engine)
+
+# Create the SQLAlchemy engine with pool and driver options from Settings.
+engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
+pool_metrics = configure_engine(engine)
 
 # Create a SessionLocal class. Each instance of this class will be a database session.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -25,4 +116,33 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Async drivers for the same database, used by the async request handlers.
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+def async_database_url(url: str) -> str:
+    """The async-driver equivalent of a synchronous database URL."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}'; set ASYNC_DATABASE_URL.")
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+ASYNC_URL = settings.ASYNC_DATABASE_URL or async_database_url(settings.DATABASE_URL)
+async_engine = create_async_engine(ASYNC_URL, **engine_options(ASYNC_URL))
+async_pool_metrics = configure_engine(async_engine.sync_engine)
+
+# Objects stay usable after commit: async sessions cannot lazy-load expired attributes.
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# Dependency to get an async DB session in async API endpoints. The crud
+# functions are reused through `await db.run_sync(crud.fn, ...)`, which runs
+# them on the async connection without blocking the event loop.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def database_stats() -> dict:
+    """Pool utilization of the sync and async engines."""
+    return {"sync_engine": pool_metrics.stats(), "async_engine": async_pool_metrics.stats()}
@@ -0,0 +1,391 @@
+"""
+One-off data migrations for existing databases.
+
+Usage:
+    python -m app.db.migrate schema
+    python -m app.db.migrate embeddings [--batch-size 500] [--dtype float32]
+    python -m app.db.migrate images [--batch-size 500]
+    python -m app.db.migrate crops [--batch-size 500] [--delete-originals]
+    python -m app.db.migrate stats [--batch-size 500]
+    python -m app.db.migrate templates [--batch-size 500]
+"""
+import argparse
+from typing import List
+from sqlalchemy import inspect, text, LargeBinary, Table
+from sqlalchemy.engine import Engine
+
+from app.core.config import settings
+from .database import engine as default_engine
+from .models import Base, EmbeddingBlob
+
+EMBEDDING_TABLES = ["users", "user_images", "access_logs", "unknown_access"]
+IMAGE_TABLES = ["user_images", "access_logs", "unknown_access"]
+
+
+def _rebuild_sqlite_table(engine: Engine, table: Table, existing: dict):
+    """SQLite cannot alter column constraints, so recreate the table and copy the rows over."""
+    shared = ", ".join(name for name in existing if name in table.columns)
+    with engine.begin() as conn:
+        for index in inspect(conn).get_indexes(table.name):
+            conn.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+        conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_old"))
+        table.create(bind=conn)
+        conn.execute(text(f"INSERT INTO {table.name} ({shared}) SELECT {shared} FROM {table.name}_old"))
+        conn.execute(text(f"DROP TABLE {table.name}_old"))
+
+
+def upgrade_schema(engine: Engine = default_engine):
+    """
+    Bring existing tables in line with the models.
+
+    Creates missing tables, adds missing columns (as nullable), creates
+    missing indexes, and drops NOT NULL from columns the models now allow to
+    be null.
+    """
+    Base.metadata.create_all(bind=engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"]: column for column in inspect(engine).get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        relaxed = [
+            column for column in table.columns
+            if column.name in existing and column.nullable and not existing[column.name]["nullable"]
+        ]
+        if not missing and not relaxed:
+            continue
+
+        if engine.dialect.name == "sqlite" and relaxed:
+            _rebuild_sqlite_table(engine, table, existing)
+            print(f"{table.name}: rebuilt")
+            continue
+
+        with engine.begin() as conn:
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            for column in relaxed:
+                conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL"))
+        missing_names = {column.name for column in missing}
+        print(f"{table.name}: added {sorted(missing_names)}, relaxed {[column.name for column in relaxed]}")
+
+    # Indexes of new columns, and indexes added to existing tables
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                print(f"{table.name}: created index {index.name}")
+
+
+def pending_migrations(engine: Engine = default_engine) -> List[str]:
+    """
+    Migrations the database needs before this version can use it: 'schema'
+    when tables, columns or indexes are missing (or a column is NOT NULL
+    that the models allow to be null), and 'embeddings' when an embedding
+    column is still text outside SQLite.
+    """
+    pending = []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            pending.append("schema")
+            break
+        existing = {column["name"]: column for column in inspector.get_columns(table.name)}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        if (
+            any(column.name not in existing for column in table.columns)
+            or any(column.nullable and not existing[column.name]["nullable"]
+                   for column in table.columns if column.name in existing)
+            or any(index.name not in indexes for index in table.indexes)
+        ):
+            pending.append("schema")
+            break
+    if engine.dialect.name != "sqlite":
+        for table in EMBEDDING_TABLES:
+            if not inspector.has_table(table):
+                continue
+            columns = {column["name"]: column["type"] for column in inspector.get_columns(table)}
+            if "embedding_bin" in columns or not isinstance(columns.get("embedding"), LargeBinary):
+                pending.append("embeddings")
+                break
+    return pending
+
+
+def check_schema(engine: Engine = default_engine):
+    """Raise with the commands to run if the database needs migrations first."""
+    pending = pending_migrations(engine)
+    if pending:
+        commands = " and ".join(f"'python -m app.db.migrate {name}'" for name in pending)
+        raise RuntimeError(f"The database schema is out of date; run {commands} before starting the app.")
+
+
+def _convert_in_batches(engine: Engine, table: str, select_where: str, update_sql: str,
+                        convert, batch_size: int, label: str) -> int:
+    """
+    Stream `(id, value)` rows matching `select_where` in keyset order and
+    write `convert(value)` back with one executemany and commit per batch.
+    Rows for which `convert` returns None are left untouched.
+    """
+    count = 0
+    last_id = None
+    while True:
+        with engine.begin() as conn:
+            query = (
+                f"SELECT id, {label} FROM {table} WHERE {select_where}"
+                f"{' AND id > :last_id' if last_id is not None else ''} "
+                f"ORDER BY id LIMIT :limit"
+            )
+            rows = conn.execute(text(query), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            params = []
+            for row_id, value in rows:
+                converted = convert(value)
+                if converted is not None:
+                    params.append({"id": row_id, "value": converted})
+            if params:
+                conn.execute(text(update_sql), params)
+        count += len(params)
+        last_id = rows[-1][0]
+        print(f"{table}: converted {count} rows")
+    return count
+
+
+def migrate_embeddings(engine: Engine = default_engine, batch_size: int = 500,
+                       dtype: str = settings.EMBEDDING_STORAGE_DTYPE) -> dict:
+    """
+    Convert JSON text embeddings to the binary `EmbeddingBlob` format.
+
+    SQLite stores values by their own type, so rows are rewritten in place.
+    Other databases get a temporary `embedding_bin` column that is filled and
+    then swapped in for the old text column. Both paths commit per batch and
+    skip rows that are already converted, so an interrupted run resumes.
+    """
+    encoder = EmbeddingBlob(dtype)
+    convert = lambda value: encoder.encode(EmbeddingBlob.decode(value))
+    converted = {}
+
+    for table in EMBEDDING_TABLES:
+        if not inspect(engine).has_table(table):
+            continue
+
+        if engine.dialect.name == "sqlite":
+            converted[table] = _convert_in_batches(
+                engine, table, "typeof(embedding) = 'text'",
+                f"UPDATE {table} SET embedding = :value WHERE id = :id",
+                convert, batch_size, "embedding"
+            )
+            continue
+
+        columns = {column["name"]: column["type"] for column in inspect(engine).get_columns(table)}
+        if "embedding_bin" not in columns and isinstance(columns.get("embedding"), LargeBinary):
+            converted[table] = 0
+            continue  # Already migrated
+
+        if "embedding_bin" not in columns:
+            binary_type = LargeBinary().compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN embedding_bin {binary_type}"))
+
+        converted[table] = _convert_in_batches(
+            engine, table, "embedding IS NOT NULL AND embedding_bin IS NULL",
+            f"UPDATE {table} SET embedding_bin = :value WHERE id = :id",
+            convert, batch_size, "embedding"
+        )
+
+        # Swap the binary column in place of the text one
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN embedding"))
+            conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN embedding_bin TO embedding"))
+            if table == "users":
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN embedding SET NOT NULL"))
+
+    return converted
+
+
+def migrate_images(engine: Engine = default_engine, batch_size: int = 500) -> dict:
+    """Move legacy base64 `image_data` into the blob store, keeping only the hash reference."""
+    from app.blobstore import blob_store, decode_data_url
+
+    def convert(value):
+        try:
+            return blob_store.put(decode_data_url(value))
+        except ValueError:
+            return None  # Not valid base64, leave the row as it is
+
+    upgrade_schema(engine)
+    converted = {}
+    for table in IMAGE_TABLES:
+        converted[table] = _convert_in_batches(
+            engine, table, "image_data IS NOT NULL",
+            f"UPDATE {table} SET image_ref = :value, image_data = NULL WHERE id = :id",
+            convert, batch_size, "image_data"
+        )
+    return converted
+
+
+def shrink_images(engine: Engine = default_engine, batch_size: int = 500, delete_originals: bool = False) -> dict:
+    """
+    Replace stored frames with what IMAGE_STORAGE keeps today: the aligned
+    face crop plus a thumbnail (or, with IMAGE_STORAGE=frame, the frame plus
+    a thumbnail). Faces are detected again with the configured model; frames
+    without exactly one face keep the full frame, and rows whose image is
+    missing or cannot be decoded are left as they are.
+    Commits per batch and skips rows that already have a thumbnail, so an
+    interrupted run resumes. With `delete_originals`, replaced frames that
+    no row refers to any more are removed from the blob store afterwards.
+    """
+    from app import services
+    from app.blobstore import blob_store, decode_data_url
+
+    def shrink(image_ref, image_data):
+        try:
+            img_bytes = blob_store.get(image_ref) if image_ref else decode_data_url(image_data)
+        except (KeyError, ValueError):
+            return None
+        img = services.decode_image_bytes(img_bytes)
+        if img is None:
+            return None
+        face = services.get_face(img)
+        new_ref, thumbnail_ref = services.store_capture(img_bytes, img, None if face is None else face[1])
+        if new_ref is None:
+            # No face to crop: keep the original frame rather than dropping it
+            new_ref = image_ref or services.store_image(img_bytes)
+        return new_ref, thumbnail_ref
+
+    upgrade_schema(engine)
+    # A frame shared by several rows (an image record and its access log) is processed once
+    shrunk = {}
+    replaced = set()
+    converted = {}
+    for table in IMAGE_TABLES:
+        count = 0
+        last_id = 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(text(
+                    f"SELECT id, image_ref, image_data FROM {table} WHERE thumbnail_ref IS NULL"
+                    f" AND (image_ref IS NOT NULL OR image_data IS NOT NULL) AND id > :last_id ORDER BY id LIMIT :limit"
+                ), {"last_id": last_id, "limit": batch_size}).fetchall()
+                if not rows:
+                    break
+                params = []
+                for row_id, image_ref, image_data in rows:
+                    refs = shrunk.get(image_ref) if image_ref else None
+                    if refs is None:
+                        refs = shrink(image_ref, image_data)
+                        if refs is None:
+                            continue
+                        if image_ref:
+                            shrunk[image_ref] = refs
+                    if image_ref and refs[0] != image_ref:
+                        replaced.add(image_ref)
+                    params.append({"id": row_id, "image_ref": refs[0], "thumbnail_ref": refs[1]})
+                if params:
+                    conn.execute(text(
+                        f"UPDATE {table} SET image_ref = :image_ref, thumbnail_ref = :thumbnail_ref, image_data = NULL"
+                        f" WHERE id = :id"
+                    ), params)
+            count += len(params)
+            last_id = rows[-1][0]
+            print(f"{table}: shrunk {count} rows")
+        converted[table] = count
+
+    if delete_originals:
+        deleted = 0
+        with engine.connect() as conn:
+            for ref in replaced:
+                referenced = any(
+                    conn.execute(text(
+                        f"SELECT 1 FROM {table} WHERE image_ref = :ref OR thumbnail_ref = :ref LIMIT 1"
+                    ), {"ref": ref}).first()
+                    for table in IMAGE_TABLES
+                )
+                if not referenced and blob_store.delete(ref):
+                    deleted += 1
+        print(f"blobs: deleted {deleted} replaced frames")
+    return converted
+
+
+def rebuild_stats(engine: Engine = default_engine, batch_size: int = 500):
+    """Recompute the access_stats rollups from access_logs, unknown_access and users."""
+    from sqlalchemy.orm import Session
+    from . import rollups
+
+    upgrade_schema(engine)
+    with Session(engine) as db:
+        processed = rollups.backfill(db, batch_size=batch_size)
+    print(f"access_stats: rebuilt from {processed} rows")
+
+
+def build_templates(engine: Engine = default_engine, batch_size: int = 500) -> int:
+    """
+    Give users enrolled before template sets existed templates built from
+    their enrollment images. Users without stored enrollment embeddings keep
+    scoring against their centroid. Commits per batch, so reruns resume.
+    """
+    from sqlalchemy.orm import Session
+    from app import templates
+    from .models import User, UserImage
+
+    upgrade_schema(engine)
+    count = 0
+    last_id = None
+    while True:
+        with Session(engine) as db:
+            query = db.query(User.id).filter(User.templates.is_(None))
+            if last_id is not None:
+                query = query.filter(User.id > last_id)
+            user_ids = [row.id for row in query.order_by(User.id).limit(batch_size)]
+            if not user_ids:
+                break
+            embeddings = {}
+            rows = db.query(UserImage.user_id, UserImage.embedding).filter(
+                UserImage.user_id.in_(user_ids),
+                UserImage.image_type == "enrollment",
+                UserImage.embedding.isnot(None),
+            ).order_by(UserImage.id)
+            for user_id, embedding in rows:
+                embeddings.setdefault(user_id, []).append(embedding)
+            for user_id, user_embeddings in embeddings.items():
+                db.query(User).filter(User.id == user_id).update(
+                    {User.templates: templates.build(user_embeddings, settings.TEMPLATE_MAX_SIZE),
+                     User.updated_at: User.updated_at},
+                    synchronize_session=False
+                )
+            db.commit()
+        count += len(embeddings)
+        last_id = user_ids[-1]
+        print(f"users: built templates for {count} users")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run data migrations on the configured database.")
+    parser.add_argument("migration", choices=["schema", "embeddings", "images", "crops", "stats", "templates"])
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dtype", default=settings.EMBEDDING_STORAGE_DTYPE, choices=list(EmbeddingBlob.DTYPES))
+    parser.add_argument("--delete-originals", action="store_true",
+                        help="crops: remove replaced frames from the blob store")
+    args = parser.parse_args()
+
+    if args.migration == "schema":
+        upgrade_schema()
+        return
+    if args.migration == "stats":
+        rebuild_stats(batch_size=args.batch_size)
+        return
+    if args.migration == "templates":
+        build_templates(batch_size=args.batch_size)
+        return
+    if args.migration == "embeddings":
+        result = migrate_embeddings(batch_size=args.batch_size, dtype=args.dtype)
+    elif args.migration == "crops":
+        result = shrink_images(batch_size=args.batch_size, delete_originals=args.delete_originals)
+    else:
+        result = migrate_images(batch_size=args.batch_size)
+    for table, count in result.items():
+        print(f"{table}: {count} rows converted")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,121 @@
 import json
+import struct
 import numpy as np
 from datetime import datetime
-from sqlalchemy import Column, String, Text, TypeDecorator, DateTime, Boolean, Float, Integer
+from sqlalchemy import Column, String, Text, TypeDecorator, DateTime, Boolean, Float, Integer, LargeBinary, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
+from app.core.config import settings
 
 Base = declarative_base()
 
-class NumpyArrayEncoder(TypeDecorator):
-    """Custom type to store numpy arrays as JSON in the database."""
-    impl = Text
+class EmbeddingBlob(TypeDecorator):
+    """
+    Custom type to store numpy embeddings as compact little-endian bytes.
+
+    Each value is an 8-byte header (magic, version, dtype code, float32 scale)
+    followed by the raw vector, so float32 rows decode zero-copy with
+    `np.frombuffer`. float16 halves the size; int8 quantizes with a per-vector
+    scale. Legacy JSON text written by the old encoder is still readable.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    MAGIC = b"NE"
+    VERSION = 1
+    HEADER = struct.Struct("<2sBBf")
+    DTYPES = {"float32": (1, "<f4"), "float16": (2, "<f2"), "int8": (3, "i1")}
+    CODES = {code: numpy_dtype for code, numpy_dtype in DTYPES.values()}
+
+    def __init__(self, dtype: str = "float32", *args, **kwargs):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported embedding storage dtype: {dtype}")
+        self.dtype = dtype
+        super().__init__(*args, **kwargs)
+
+    def encode(self, value: np.ndarray) -> bytes:
+        vector = np.asarray(value, dtype=np.float32).ravel()
+        code, numpy_dtype = self.DTYPES[self.dtype]
+        scale = 1.0
+        if self.dtype == "int8":
+            peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+            scale = peak / 127 if peak > 0 else 1.0
+            vector = np.round(vector / scale)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, code, scale)
+        return header + vector.astype(numpy_dtype).tobytes()
+
+    @classmethod
+    def decode(cls, value) -> np.ndarray:
+        if isinstance(value, str):
+            # Row written by the old JSON text encoder
+            return np.array(json.loads(value), dtype=np.float32)
+        magic, version, code, scale = cls.HEADER.unpack_from(value)
+        if magic != cls.MAGIC or version != cls.VERSION or code not in cls.CODES:
+            raise ValueError("Unrecognized embedding encoding.")
+        vector = np.frombuffer(value, dtype=cls.CODES[code], offset=cls.HEADER.size)
+        if vector.dtype == np.float32:
+            return vector
+        if vector.dtype == np.int8:
+            return vector.astype(np.float32) * np.float32(scale)
+        return vector.astype(np.float32)
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            return json.dumps(value.tolist())
+            return self.encode(value)
         return None
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            return np.array(json.loads(value))
+            return self.decode(value)
         return None
 
+class TemplateBlob(EmbeddingBlob):
+    """
+    A user's template set: a K x D matrix of unit embeddings in one value.
+
+    The header carries the shape; int8 rows are followed by one float32
+    scale each, ahead of the data. float32 matrices decode zero-copy.
+    """
+    cache_ok = True
+
+    MAGIC = b"NT"
+    HEADER = struct.Struct("<2sBBHH")
+
+    def encode(self, value: np.ndarray) -> bytes:
+        matrix = np.atleast_2d(np.asarray(value, dtype=np.float32))
+        rows, dim = matrix.shape
+        code, numpy_dtype = self.DTYPES[self.dtype]
+        scales = b""
+        if self.dtype == "int8":
+            peaks = np.max(np.abs(matrix), axis=1) if dim else np.zeros(rows, dtype=np.float32)
+            row_scales = np.where(peaks > 0, peaks / 127, 1.0).astype("<f4")
+            matrix = np.round(matrix / row_scales[:, None])
+            scales = row_scales.tobytes()
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, code, rows, dim)
+        return header + scales + matrix.astype(numpy_dtype).tobytes()
+
+    @classmethod
+    def decode(cls, value) -> np.ndarray:
+        magic, version, code, rows, dim = cls.HEADER.unpack_from(value)
+        if magic != cls.MAGIC or version != cls.VERSION or code not in cls.CODES:
+            raise ValueError("Unrecognized template encoding.")
+        offset = cls.HEADER.size
+        scales = None
+        if cls.CODES[code] == "i1":
+            scales = np.frombuffer(value, dtype="<f4", count=rows, offset=offset)
+            offset += scales.nbytes
+        matrix = np.frombuffer(value, dtype=cls.CODES[code], count=rows * dim, offset=offset).reshape(rows, dim)
+        if matrix.dtype == np.float32:
+            return matrix
+        if scales is not None:
+            return matrix.astype(np.float32) * scales[:, None]
+        return matrix.astype(np.float32)
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(String, primary_key=True, index=True)
-    embedding = Column(NumpyArrayEncoder, nullable=False)
+    embedding = Column(EmbeddingBlob(settings.EMBEDDING_STORAGE_DTYPE), nullable=False)  # Centroid, used for identification
+    templates = Column(TemplateBlob(settings.EMBEDDING_STORAGE_DTYPE), nullable=True)  # K x D embeddings scored by verification
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = Column(Boolean, default=True)
@@ -34,19 +125,28 @@ class UserImage(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String, nullable=False, index=True)
-    image_data = Column(Text, nullable=False)  # Base64 encoded image
-    embedding = Column(NumpyArrayEncoder, nullable=True)  # Individual image embedding
+    image_ref = Column(String(64), nullable=True, index=True)  # SHA-256 of the image in the blob store
+    image_data = Column(Text, nullable=True)  # Legacy base64 image, superseded by image_ref
+    thumbnail_ref = Column(String(64), nullable=True, index=True)  # Small preview of the frame in the blob store
+    embedding = Column(EmbeddingBlob(settings.EMBEDDING_STORAGE_DTYPE), nullable=True)  # Individual image embedding
     image_type = Column(String, nullable=False)  # 'enrollment' or 'verification'
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class AccessLog(Base):
     __tablename__ = "access_logs"
+    __table_args__ = (
+        # Keyset pagination and time-window exports walk (created_at, id)
+        Index("ix_access_logs_created_at_id", "created_at", "id"),
+        Index("ix_access_logs_user_id_created_at_id", "user_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String, nullable=False, index=True)
     access_type = Column(String, nullable=False)  # 'enrollment', 'verification_success', 'verification_failed'
-    image_data = Column(Text, nullable=True)  # Base64 encoded image
-    embedding = Column(NumpyArrayEncoder, nullable=True)  # Face embedding from attempt
+    image_ref = Column(String(64), nullable=True, index=True)  # SHA-256 of the image in the blob store
+    image_data = Column(Text, nullable=True)  # Legacy base64 image, superseded by image_ref
+    thumbnail_ref = Column(String(64), nullable=True, index=True)  # Small preview of the frame in the blob store
+    embedding = Column(EmbeddingBlob(settings.EMBEDDING_STORAGE_DTYPE), nullable=True)  # Face embedding from attempt
     similarity_score = Column(Float, nullable=True)  # Similarity score for verification attempts
     success = Column(Boolean, nullable=False)
     ip_address = Column(String, nullable=True)
@@ -55,11 +155,55 @@ class AccessLog(Base):
 
 class UnknownAccess(Base):
     __tablename__ = "unknown_access"
+    __table_args__ = (
+        Index("ix_unknown_access_created_at_id", "created_at", "id"),
+        Index("ix_unknown_access_cluster_id_created_at_id", "cluster_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    image_data = Column(Text, nullable=False)  # Base64 encoded image
-    embedding = Column(NumpyArrayEncoder, nullable=True)  # Face embedding
+    image_ref = Column(String(64), nullable=True, index=True)  # SHA-256 of the image in the blob store
+    image_data = Column(Text, nullable=True)  # Legacy base64 image, superseded by image_ref
+    thumbnail_ref = Column(String(64), nullable=True, index=True)  # Small preview of the frame in the blob store
+    embedding = Column(EmbeddingBlob(settings.EMBEDDING_STORAGE_DTYPE), nullable=True)  # Face embedding
     attempted_user_id = Column(String, nullable=True)  # User ID they tried to use
+    cluster_id = Column(Integer, nullable=True)  # Unknown face cluster (see app/db/clusters.py)
     ip_address = Column(String, nullable=True)
     user_agent = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class AccessStats(Base):
+    __tablename__ = "access_stats"
+    __table_args__ = (UniqueConstraint("user_id", "granularity", "bucket_start", name="uq_access_stats_bucket"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False, default="")  # '' for system-wide counters
+    granularity = Column(String(8), nullable=False)  # 'hour', 'day' or 'all'
+    bucket_start = Column(DateTime, nullable=False)  # 1970-01-01 for the 'all' bucket
+    total_attempts = Column(Integer, nullable=False, default=0)
+    successful_attempts = Column(Integer, nullable=False, default=0)
+    unknown_attempts = Column(Integer, nullable=False, default=0)
+    enrolled_users = Column(Integer, nullable=False, default=0)  # Net active users enrolled in the bucket
+
+class DuplicateIdentity(Base):
+    __tablename__ = "duplicate_identities"
+    __table_args__ = (UniqueConstraint("user_id", "duplicate_of", name="uq_duplicate_identities_pair"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False, index=True)  # The later enrollment
+    duplicate_of = Column(String, nullable=False, index=True)  # The existing user with the same face
+    similarity = Column(Float, nullable=False)  # Cosine similarity of the two centroids
+    status = Column(String(8), nullable=False)  # 'flagged' (needs review) or 'linked' (same person)
+    source = Column(String(16), nullable=False)  # 'enrollment' or 'audit'
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class UnknownCluster(Base):
+    __tablename__ = "unknown_clusters"
+    # Never reuse the IDs of deleted clusters, which other processes may still have cached
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    centroid = Column(EmbeddingBlob("float32"), nullable=False)  # Unit-length mean of the attempts' embeddings
+    attempts = Column(Integer, nullable=False, default=0, index=True)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
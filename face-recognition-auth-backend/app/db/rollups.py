@@ -0,0 +1,189 @@
+"""
+Incrementally maintained access counters.
+
+Every logged attempt bumps counters in `access_stats` for its user and for
+the global scope (user_id ''), in hourly, daily and all-time buckets, in the
+same transaction as the log row itself. The stats endpoints then read one
+all-time row instead of counting `access_logs`, and time windows sum a
+handful of hour or day buckets.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models
+
+GLOBAL = ""
+HOUR = "hour"
+DAY = "day"
+ALL_TIME = "all"
+ALL_TIME_START = datetime(1970, 1, 1)
+COUNTERS = ("total_attempts", "successful_attempts", "unknown_attempts", "enrolled_users")
+
+BucketKey = Tuple[str, str, datetime]
+
+
+def _buckets(user_id: str, when: datetime) -> List[BucketKey]:
+    hour = when.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    return [(user_id, HOUR, hour), (user_id, DAY, day), (user_id, ALL_TIME, ALL_TIME_START)]
+
+
+class StatsDelta:
+    """Counter increments collected in memory before being written with one upsert."""
+
+    def __init__(self):
+        self.counts: Dict[BucketKey, Counter] = defaultdict(Counter)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def access_attempt(self, user_id: str, success: bool, when: Optional[datetime] = None):
+        when = when or datetime.utcnow()
+        for scope in (user_id, GLOBAL):
+            for key in _buckets(scope, when):
+                self.counts[key]["total_attempts"] += 1
+                if success:
+                    self.counts[key]["successful_attempts"] += 1
+
+    def unknown_attempt(self, when: Optional[datetime] = None):
+        for key in _buckets(GLOBAL, when or datetime.utcnow()):
+            self.counts[key]["unknown_attempts"] += 1
+
+    def enrolled(self, delta: int = 1, when: Optional[datetime] = None):
+        for key in _buckets(GLOBAL, when or datetime.utcnow()):
+            self.counts[key]["enrolled_users"] += delta
+
+    def rows(self) -> List[dict]:
+        # Sorted so concurrent writers lock rows in the same order
+        return [
+            {"user_id": user_id, "granularity": granularity, "bucket_start": bucket_start,
+             **{name: counts[name] for name in COUNTERS}}
+            for (user_id, granularity, bucket_start), counts in sorted(self.counts.items())
+        ]
+
+
+def apply(db: Session, delta: StatsDelta):
+    """Add the collected increments to `access_stats` (no commit; runs in the caller's transaction)."""
+    rows = delta.rows()
+    if not rows:
+        return
+    table = models.AccessStats.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        _apply_portable(db, rows)
+        return
+
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.granularity, table.c.bucket_start],
+        set_={name: table.c[name] + statement.excluded[name] for name in COUNTERS},
+    )
+    db.execute(statement, rows)
+
+
+def _apply_portable(db: Session, rows: List[dict]):
+    """Read-modify-write fallback for databases without ON CONFLICT support."""
+    for row in rows:
+        bucket = db.query(models.AccessStats).filter(
+            models.AccessStats.user_id == row["user_id"],
+            models.AccessStats.granularity == row["granularity"],
+            models.AccessStats.bucket_start == row["bucket_start"],
+        ).with_for_update().first()
+        if bucket is None:
+            db.add(models.AccessStats(**row))
+        else:
+            for name in COUNTERS:
+                setattr(bucket, name, getattr(bucket, name) + row[name])
+
+
+def _floor_hour(when: datetime) -> datetime:
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def totals(db: Session, user_id: str = GLOBAL, since: Optional[datetime] = None,
+           until: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Counter totals for a scope, all-time or within [since, until).
+
+    Windows are resolved to whole hours; when both ends fall on midnight the
+    day buckets are summed instead.
+    """
+    query = db.query(*[func.coalesce(func.sum(getattr(models.AccessStats, name)), 0) for name in COUNTERS])
+    query = query.filter(models.AccessStats.user_id == user_id)
+    if since is None and until is None:
+        query = query.filter(
+            models.AccessStats.granularity == ALL_TIME,
+            models.AccessStats.bucket_start == ALL_TIME_START,
+        )
+    else:
+        start = _floor_hour(since) if since else None
+        end = _floor_hour(until) if until else None
+        midnight = all(t is None or t.hour == 0 for t in (start, end))
+        query = query.filter(models.AccessStats.granularity == (DAY if midnight else HOUR))
+        if start is not None:
+            query = query.filter(models.AccessStats.bucket_start >= start)
+        if end is not None:
+            query = query.filter(models.AccessStats.bucket_start < end)
+    return dict(zip(COUNTERS, (int(value) for value in query.one())))
+
+
+def series(db: Session, granularity: str = HOUR, user_id: str = GLOBAL,
+           since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Bucket rows for a scope in time order."""
+    query = db.query(models.AccessStats).filter(
+        models.AccessStats.user_id == user_id,
+        models.AccessStats.granularity == granularity,
+    )
+    if since is not None:
+        query = query.filter(models.AccessStats.bucket_start >= since)
+    if until is not None:
+        query = query.filter(models.AccessStats.bucket_start < until)
+    return query.order_by(models.AccessStats.bucket_start).all()
+
+
+def backfill(db: Session, batch_size: int = 5000, max_pending_buckets: int = 50000) -> int:
+    """
+    Rebuild `access_stats` from the raw tables.
+
+    Rows are streamed and aggregated in memory, and the counters are written
+    whenever `max_pending_buckets` distinct buckets have accumulated, so
+    memory stays bounded on very large logs. Everything happens in one
+    transaction; run it while logging is quiet, since attempts recorded
+    during the rebuild may be counted twice.
+    """
+    db.query(models.AccessStats).delete()
+    delta = StatsDelta()
+    processed = 0
+
+    def flush():
+        nonlocal delta
+        apply(db, delta)
+        delta = StatsDelta()
+
+    sources: Iterable = (
+        ("access", db.query(models.AccessLog.user_id, models.AccessLog.success, models.AccessLog.created_at)),
+        ("unknown", db.query(models.UnknownAccess.created_at)),
+        ("user", db.query(models.User.created_at).filter(models.User.is_active == True)),
+    )
+    for kind, query in sources:
+        for row in query.yield_per(batch_size):
+            if kind == "access":
+                delta.access_attempt(row.user_id, bool(row.success), row.created_at or ALL_TIME_START)
+            elif kind == "unknown":
+                delta.unknown_attempt(row.created_at or ALL_TIME_START)
+            else:
+                delta.enrolled(1, row.created_at or ALL_TIME_START)
+            processed += 1
+            if len(delta) >= max_pending_buckets:
+                flush()
+    flush()
+    db.commit()
+    return processed
@@ -0,0 +1,218 @@
+"""
+Duplicate-identity detection: the same face enrolled under several user IDs.
+
+At enrollment the new user's centroid is searched in the identification
+gallery (one matrix-vector product, or an IVF probe), and existing users
+at least DUPLICATE_THRESHOLD similar are handled by DUPLICATE_POLICY:
+
+- 'flag': enroll, and record the pair as 'flagged' for review.
+- 'link': enroll, and record the pair as 'linked' (the same person).
+- 'reject': fail the enrollment.
+- 'off': no check.
+
+Run `python -m app.duplicates audit` to find near-duplicate clusters among
+the users already enrolled. Users are blocked by spherical k-means (as in
+the IVF index) and each is only compared with the users of its `nprobe`
+nearest blocks, so with ~sqrt(N) blocks the work grows as N^1.5 instead
+of N^2. Pairs above the threshold are joined into clusters.
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from .ann import spherical_kmeans
+from .core.config import settings
+from .db import crud
+from .gallery import EmbeddingMatrix, gallery, normalize
+
+POLICIES = ("off", "flag", "link", "reject")
+
+# Record status for each policy that enrolls the user anyway
+STATUSES = {"flag": "flagged", "link": "linked"}
+
+# Scores computed per block product, to bound the memory of the audit
+BLOCK_SCORES = 16 * 1024 * 1024
+
+if settings.DUPLICATE_POLICY not in POLICIES:
+    raise ValueError(f"DUPLICATE_POLICY must be one of {', '.join(POLICIES)}")
+
+
+def find_matches(embedding: np.ndarray, threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+    """Enrolled users at least `threshold` similar to the embedding, best first."""
+    threshold = settings.DUPLICATE_THRESHOLD if threshold is None else threshold
+    candidates = gallery.search(embedding, top_k=settings.DUPLICATE_MAX_MATCHES)
+    return [(user_id, score) for user_id, score in candidates if score >= threshold]
+
+
+def records(user_id: str, matches: List[Tuple[str, float]], status: str, source: str) -> List[dict]:
+    """`DuplicateIdentity` rows for a user and its matches."""
+    return [
+        {"user_id": user_id, "duplicate_of": other, "similarity": float(score), "status": status, "source": source}
+        for other, score in matches
+    ]
+
+
+def probe_blocks(vectors: np.ndarray, centroids: np.ndarray, nprobe: int, chunk_size: int = 65536) -> np.ndarray:
+    """The `nprobe` most similar centroids of every row, nearest first (N x nprobe)."""
+    probes = np.empty((vectors.shape[0], nprobe), dtype=np.int64)
+    for start in range(0, vectors.shape[0], chunk_size):
+        scores = vectors[start:start + chunk_size] @ centroids.T
+        if nprobe < scores.shape[1]:
+            best = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+        order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+        probes[start:start + chunk_size] = np.take_along_axis(best, order, axis=1)
+    return probes
+
+
+def near_duplicate_pairs(vectors: np.ndarray, threshold: float, nlist: Optional[int] = None, nprobe: int = 3,
+                         train_size: int = 50000, iterations: int = 10,
+                         seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every pair of rows found at least `threshold` similar, as arrays
+    (first, second, similarity) with first < second. Approximate: a pair
+    whose rows share none of each other's `nprobe` nearest blocks is missed.
+    """
+    count = vectors.shape[0]
+    nlist = min(nlist or max(1, int(np.sqrt(count))), max(count, 1))
+    if nlist > 1:
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(count, min(count, train_size), replace=False)]
+        centroids = spherical_kmeans(sample, nlist, iterations, seed)
+        probes = probe_blocks(vectors, centroids, min(nprobe, len(centroids)))
+    else:
+        probes = np.zeros((count, 1), dtype=np.int64)
+    blocks = int(probes.max()) + 1 if count else 0
+
+    # Each row lives in its nearest block and is compared with the rows living
+    # in every block it probes
+    home = probes[:, 0]
+    members = np.argsort(home, kind="stable")
+    member_bounds = np.searchsorted(home[members], np.arange(blocks + 1))
+    probe_rows = np.repeat(np.arange(count), probes.shape[1])
+    probe_order = np.argsort(probes.ravel(), kind="stable")
+    queries = probe_rows[probe_order]
+    query_bounds = np.searchsorted(probes.ravel()[probe_order], np.arange(blocks + 1))
+
+    firsts, seconds, similarities = [], [], []
+    for block in range(blocks):
+        block_members = members[member_bounds[block]:member_bounds[block + 1]]
+        block_queries = queries[query_bounds[block]:query_bounds[block + 1]]
+        if not len(block_members) or not len(block_queries):
+            continue
+        matrix = vectors[block_members]
+        step = max(1, BLOCK_SCORES // len(block_members))
+        for start in range(0, len(block_queries), step):
+            rows = block_queries[start:start + step]
+            scores = vectors[rows] @ matrix.T
+            hit_rows, hit_members = np.nonzero(scores >= threshold)
+            first = np.minimum(rows[hit_rows], block_members[hit_members])
+            second = np.maximum(rows[hit_rows], block_members[hit_members])
+            distinct = first != second
+            firsts.append(first[distinct])
+            seconds.append(second[distinct])
+            similarities.append(scores[hit_rows, hit_members][distinct])
+
+    if not firsts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    first, second, similarity = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(similarities)
+    # A pair is seen once from each side when both rows probe the other's block
+    _, unique = np.unique(first * count + second, return_index=True)
+    return first[unique], second[unique], similarity[unique]
+
+
+def clusters(count: int, first: np.ndarray, second: np.ndarray) -> List[List[int]]:
+    """Connected components (of two or more rows) of the pair graph."""
+    parent = np.arange(count)
+
+    def root(row: int) -> int:
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for a, b in zip(first.tolist(), second.tolist()):
+        root_a, root_b = root(a), root(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    groups: Dict[int, List[int]] = {}
+    for row in np.unique(np.concatenate([first, second])).tolist():
+        groups.setdefault(root(row), []).append(row)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def audit(db: Session, threshold: Optional[float] = None, nlist: Optional[int] = None,
+          nprobe: int = 3) -> Tuple[int, List[dict]]:
+    """
+    Near-duplicate clusters among active users. Returns the number of users
+    scanned and the clusters, largest first; in each pair `user_id` is the
+    later enrollment and `duplicate_of` the earlier one.
+    """
+    threshold = settings.DUPLICATE_THRESHOLD if threshold is None else threshold
+    entries = EmbeddingMatrix()
+    for user_id, embedding in crud.get_active_user_embeddings(db, oldest_first=True):
+        entries.add(user_id, normalize(embedding))
+    ids = entries.ids
+    first, second, similarity = near_duplicate_pairs(
+        entries.vectors, threshold, nlist=nlist, nprobe=nprobe,
+        train_size=settings.ANN_TRAIN_SIZE, iterations=settings.ANN_KMEANS_ITERATIONS,
+    )
+
+    pairs_by_row: Dict[int, List[dict]] = {}
+    for a, b, score in zip(first.tolist(), second.tolist(), similarity.tolist()):
+        pairs_by_row.setdefault(a, []).append({"user_id": ids[b], "duplicate_of": ids[a], "similarity": round(score, 4)})
+    result = []
+    for rows in clusters(len(ids), first, second):
+        pairs = [pair for row in rows for pair in pairs_by_row.get(row, [])]
+        result.append({
+            "users": [ids[row] for row in rows],
+            "max_similarity": max(pair["similarity"] for pair in pairs),
+            "pairs": pairs,
+        })
+    return len(ids), result
+
+
+def main():
+    from .db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Find users enrolled more than once under different IDs.")
+    parser.add_argument("command", choices=["audit"])
+    parser.add_argument("--threshold", type=float, default=settings.DUPLICATE_THRESHOLD)
+    parser.add_argument("--nlist", type=int, help="Blocks (default: sqrt of the user count)")
+    parser.add_argument("--nprobe", type=int, default=3, help="Nearest blocks each user is compared with")
+    parser.add_argument("--output", help="Write the clusters as JSON lines to this file (default: stdout)")
+    parser.add_argument("--record", action="store_true", help="Record new pairs as flagged duplicates")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        scanned, found = audit(db, args.threshold, args.nlist, args.nprobe)
+        elapsed = time.perf_counter() - started
+        output = open(args.output, "w") if args.output else sys.stdout
+        try:
+            for cluster in found:
+                output.write(json.dumps(cluster) + "\n")
+        finally:
+            if args.output:
+                output.close()
+        recorded = 0
+        if args.record:
+            recorded = crud.record_duplicates(db, [
+                {**pair, "status": "flagged", "source": "audit"} for cluster in found for pair in cluster["pairs"]
+            ])
+    finally:
+        db.close()
+    pairs = sum(len(cluster["pairs"]) for cluster in found)
+    print(f"Found {len(found)} clusters ({pairs} pairs) among {scanned} users in {elapsed:.1f}s"
+          + (f"; recorded {recorded} new pairs" if args.record else ""), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Bounded LRU + TTL cache of active users' template matrices.
+
+Verification looks the claimed user up here first, so repeat logins skip the
+database round-trip and the template decode. Entries expire after
+`ttl_seconds`, which bounds staleness even without invalidation.
+
+Cross-worker invalidation: with `generation_path` set, every worker maps the
+same 8-byte counter file. Enrolling, importing, deactivating or purging a
+user bumps the counter, and each worker drops its whole cache the next time it
+sees the counter move. The identification gallery follows the same counter to
+know when to resync with the database (see `services.sync_gallery`).
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from .core.config import settings
+
+_COUNTER = struct.Struct("<Q")
+
+
+class GenerationCounter:
+    """A counter in a small memory-mapped file shared by every process on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _COUNTER.size:
+                os.ftruncate(fd, _COUNTER.size)
+            self._map = mmap.mmap(fd, _COUNTER.size)
+        finally:
+            os.close(fd)
+        self._lock_file = open(path, "rb")
+
+    def read(self) -> int:
+        return _COUNTER.unpack_from(self._map)[0]
+
+    def bump(self) -> int:
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            value = self.read() + 1
+            _COUNTER.pack_into(self._map, 0, value)
+            return value
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """Thread-safe user_id -> float32 template matrix (K x D unit rows) cache."""
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 300,
+                 generation_path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = GenerationCounter(generation_path) if generation_path else None
+        self._seen_generation = self._generation.read() if self._generation else 0
+        # Bumped on every invalidation seen by this process, local or remote
+        self._epoch = 0
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.remote_clears = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _sync(self) -> int:
+        """Drop everything if another worker invalidated since the last look; returns the epoch."""
+        if self._generation is not None:
+            generation = self._generation.read()
+            if generation != self._seen_generation:
+                self._entries.clear()
+                self._seen_generation = generation
+                self._epoch += 1
+                self.remote_clears += 1
+        return self._epoch
+
+    def get(self, user_id: str) -> Optional[np.ndarray]:
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            vector, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return vector
+
+    def lookup(self, user_id: str) -> Tuple[Optional[np.ndarray], int]:
+        """Cached templates (or None) and the epoch to pass to `store` after loading a miss."""
+        vector = self.get(user_id)
+        with self._lock:
+            return vector, self._sync()
+
+    def get_or_load(self, user_id: str, loader: Callable[[], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """Cached templates, or the result of `loader()` (cached unless None) on a miss."""
+        if not self.enabled:
+            return loader()
+        vector, epoch = self.lookup(user_id)
+        if vector is not None:
+            return vector
+        vector = loader()
+        if vector is not None:
+            self.store(user_id, vector, epoch)
+        return vector
+
+    def store(self, user_id: str, vector: np.ndarray, epoch: int):
+        """Cache freshly loaded templates unless an invalidation happened since `lookup`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            # An invalidation may have landed while the loader was reading the
+            # database; the value could then be stale, so do not cache it.
+            if self._sync() != epoch:
+                return
+            vector.setflags(write=False)  # Shared by every caller
+            self._entries[user_id] = (vector, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: str, broadcast: bool = True):
+        """Drop a user here and, with `broadcast`, in every worker sharing the counter."""
+        with self._lock:
+            self._sync()
+            self._entries.pop(user_id, None)
+            self._epoch += 1
+            self.invalidations += 1
+            if broadcast and self._generation is not None:
+                generation = self._generation.bump()
+                if generation != self._seen_generation + 1:
+                    # Another worker bumped in between; honour its invalidation too
+                    self._entries.clear()
+                    self.remote_clears += 1
+                # Our own bump does not require clearing: the user is already gone here
+                self._seen_generation = generation
+
+    def generation(self) -> int:
+        """Current value of the shared counter (always 0 without `generation_path`)."""
+        return self._generation.read() if self._generation is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "remote_clears": self.remote_clears,
+        }
+
+
+embedding_cache = EmbeddingCache(
+    max_size=settings.EMBEDDING_CACHE_SIZE,
+    ttl_seconds=settings.EMBEDDING_CACHE_TTL_SECONDS,
+    generation_path=settings.EMBEDDING_CACHE_GENERATION_PATH or None,
+)
@@ -0,0 +1,106 @@
+"""
+Bounded executor for the CPU-bound part of async requests.
+
+Image decoding, inference and gallery searches run on a dedicated thread
+pool instead of the event loop or Starlette's shared threadpool. Admission
+is checked once per request: when `max_workers` requests are running and
+`max_pending` more are waiting, new ones are rejected with `Overloaded`
+(429) straight away. A slow burst then fails fast instead of building an
+unbounded backlog that ties up database connections and memory.
+
+Blocking writes of admitted requests (image captures, audit records) run on
+a second, smaller pool, `storage_executor`, rather than on the default
+executor behind `asyncio.to_thread`, so a slow disk or database cannot grow
+the number of threads without limit.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from .core.config import settings
+
+
+class Overloaded(Exception):
+    """Raised when the executor has no room for another request."""
+
+
+class InferenceExecutor:
+    """Thread pool with per-request admission control."""
+
+    def __init__(self, max_workers: Optional[int] = None, max_pending: int = 32, name: str = "inference"):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.name = name
+        self.max_in_flight = self.max_workers + max(0, max_pending)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.peak_in_flight = 0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    @contextmanager
+    def admit(self):
+        """Reserve a slot for one request's CPU work, or raise Overloaded."""
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise Overloaded("Server is busy, retry shortly.")
+            self._in_flight += 1
+            self.admitted += 1
+            self.peak_in_flight = max(self.peak_in_flight, self._in_flight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Run a blocking call on the pool and await its result, in the caller's context."""
+        loop = asyncio.get_running_loop()
+        # Like asyncio.to_thread, so context variables (the request's timing spans) carry over
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._pool(), functools.partial(context.run, fn, *args, **kwargs))
+
+    @staticmethod
+    async def wait(future: Future):
+        """Await a concurrent future (e.g. from the inference scheduler) without holding a thread."""
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+inference_executor = InferenceExecutor(
+    max_workers=settings.INFERENCE_EXECUTOR_WORKERS or None,
+    max_pending=settings.INFERENCE_EXECUTOR_QUEUE,
+)
+
+# Only `run` is used: admission already happened on inference_executor
+storage_executor = InferenceExecutor(max_workers=settings.STORAGE_EXECUTOR_WORKERS, name="storage")
@@ -0,0 +1,72 @@
+"""
+Streaming NDJSON / CSV export of log tables.
+
+Rows come from a server-side cursor (`yield_per`) in a session owned by the
+generator, and are serialized a chunk at a time, so memory stays constant
+however large the exported window is.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return [round(float(x), 6) for x in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _ndjson(rows: Iterable, chunk_rows: int) -> Iterator[str]:
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({key: _value(value) for key, value in row._mapping.items()}))
+        if len(lines) >= chunk_rows:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _csv(rows: Iterable, chunk_rows: int) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    pending = 0
+    for row in rows:
+        if not header_written:
+            writer.writerow(row._fields)
+            header_written = True
+        writer.writerow([
+            json.dumps(value) if isinstance(value, list) else value
+            for value in (_value(value) for value in row)
+        ])
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if pending:
+        yield buffer.getvalue()
+
+
+def stream(query: Callable, fmt: str, chunk_rows: int = 500, **filters) -> Iterator[str]:
+    """Serialize the rows of `query(db, **filters)` in `fmt`, using a session of its own."""
+    from .db.database import SessionLocal
+
+    serialize = _ndjson if fmt == "ndjson" else _csv
+    db = SessionLocal()
+    try:
+        yield from serialize(query(db, **filters), chunk_rows)
+    finally:
+        db.close()
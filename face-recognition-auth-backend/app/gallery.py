@@ -0,0 +1,239 @@
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional, Set, Tuple
+
+from .db import crud
+from .core.config import settings
+
+
+# Users changed shortly before a sync (by workers with a slightly different
+# clock, or in transactions still open) may not have been visible to it, so
+# the next sync replays changes from a bit earlier.
+SYNC_MARGIN = timedelta(seconds=60)
+
+
+def normalize(embedding: np.ndarray) -> np.ndarray:
+    """Return the embedding as a flat, unit-length float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingMatrix:
+    """
+    Dense, growable float32 matrix of unit vectors keyed by user_id.
+
+    Not thread-safe on its own; callers hold their own lock.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self._initial_capacity = initial_capacity
+        self._matrix: Optional[np.ndarray] = None
+        self.ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """View of the occupied rows."""
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix[:len(self.ids)]
+
+    def _reserve(self, dim: int, rows: int):
+        """Make sure the backing matrix can hold `rows` vectors of size `dim`."""
+        if self._matrix is None:
+            capacity = max(self._initial_capacity, rows)
+            self._matrix = np.empty((capacity, dim), dtype=np.float32)
+        elif self._matrix.shape[1] != dim:
+            raise ValueError(f"Embedding dimension {dim} does not match gallery dimension {self._matrix.shape[1]}.")
+        elif rows > self._matrix.shape[0]:
+            # Grow geometrically so repeated enrollments stay amortized O(1).
+            capacity = max(rows, self._matrix.shape[0] * 2)
+            grown = np.empty((capacity, dim), dtype=np.float32)
+            grown[:len(self.ids)] = self._matrix[:len(self.ids)]
+            self._matrix = grown
+
+    def add(self, user_id: str, vector: np.ndarray):
+        """Add or replace an already normalized vector."""
+        row = self._rows.get(user_id)
+        if row is None:
+            row = len(self.ids)
+            self._reserve(vector.shape[0], row + 1)
+            self.ids.append(user_id)
+            self._rows[user_id] = row
+        self._matrix[row] = vector
+
+    def extend(self, ids: List[str], vectors: np.ndarray):
+        """Bulk-append new ids with their normalized vectors."""
+        if len(ids) == 0:
+            return
+        start = len(self.ids)
+        self._reserve(vectors.shape[1], start + len(ids))
+        self._matrix[start:start + len(ids)] = vectors
+        for offset, user_id in enumerate(ids):
+            self._rows[user_id] = start + offset
+        self.ids.extend(ids)
+
+    def remove(self, user_id: str) -> bool:
+        """Remove a user, moving the last row into the freed slot to keep the matrix dense."""
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return False
+        last = len(self.ids) - 1
+        if row != last:
+            moved_id = self.ids[last]
+            self._matrix[row] = self._matrix[last]
+            self.ids[row] = moved_id
+            self._rows[moved_id] = row
+        self.ids.pop()
+        return True
+
+    def top_k(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """Return the `k` best (user_id, score) pairs for a normalized query, best first."""
+        count = len(self.ids)
+        if count == 0 or k <= 0:
+            return []
+        scores = self._matrix[:count] @ query
+        k = min(k, count)
+        if k < count:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(count)
+        best = best[np.argsort(-scores[best])]
+        return [(self.ids[i], float(scores[i])) for i in best]
+
+
+def active_user_ids(db: Session, page_size: int = 10000) -> Set[str]:
+    """Every active user ID, read in keyset pages."""
+    user_ids: Set[str] = set()
+    after = None
+    while True:
+        page = crud.get_active_user_ids(db, after, page_size)
+        user_ids.update(page)
+        if len(page) < page_size:
+            return user_ids
+        after = page[-1]
+
+
+class EmbeddingGallery:
+    """
+    Process-wide gallery of every active user's normalized embedding.
+
+    All vectors live in one contiguous float32 matrix so a 1:N search is a
+    single matrix-vector product followed by a partial sort, instead of one
+    ORM load per user.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self._lock = threading.RLock()
+        self._initial_capacity = initial_capacity
+        self._entries = EmbeddingMatrix(initial_capacity)
+        self._loaded = False
+        self.synced_at: Optional[datetime] = None
+        # Value of the shared invalidation counter at the last load or sync
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self, db: Session, batch_size: int = 1000):
+        """(Re)build the gallery from all active users in the database."""
+        with self._lock:
+            synced_at = datetime.utcnow()
+            self._entries = EmbeddingMatrix(self._initial_capacity)
+            for user_id, embedding in crud.get_active_user_embeddings(db, batch_size=batch_size):
+                self._entries.add(user_id, normalize(embedding))
+            self.synced_at = synced_at
+            self._loaded = True
+
+    def ensure_loaded(self, db: Session):
+        """Load the gallery from the database on first use."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load(db)
+
+    def ensure_current(self, db: Session, generation: int):
+        """Load on first use, or resync once the shared invalidation counter has moved."""
+        if self._loaded and generation == self.generation:
+            return
+        with self._lock:
+            if not self._loaded:
+                self.load(db)
+            elif generation != self.generation:
+                self.sync(db)
+            self.generation = generation
+
+    def sync(self, db: Session, since: Optional[datetime] = None):
+        """
+        Catch up with changes made by other processes: replay users created,
+        changed or deactivated since `since` (default: shortly before the last
+        sync), and drop users deleted outright, which leave no row to replay.
+        """
+        with self._lock:
+            synced_at = datetime.utcnow()
+            for user_id, embedding, is_active in crud.get_users_updated_since(db, since or self.synced_at - SYNC_MARGIN):
+                if is_active:
+                    self._entries.add(user_id, normalize(embedding))
+                else:
+                    self._entries.remove(user_id)
+            if len(self._entries) > crud.count_active_users(db):
+                active = active_user_ids(db)
+                for user_id in [user_id for user_id in self._entries.ids if user_id not in active]:
+                    self._entries.remove(user_id)
+            self.synced_at = synced_at
+
+    def add(self, user_id: str, embedding: np.ndarray):
+        """Add or replace a user's embedding."""
+        with self._lock:
+            # Before the first load the database is the source of truth,
+            # so there is nothing to keep in sync yet.
+            if self._loaded:
+                self._entries.add(user_id, normalize(embedding))
+
+    def remove(self, user_id: str) -> bool:
+        """Remove a user from the gallery."""
+        with self._lock:
+            return self._entries.remove(user_id)
+
+    def search(self, embedding: np.ndarray, top_k: int = 5) -> List[Tuple[str, float]]:
+        """Return the `top_k` most similar users as (user_id, cosine similarity), best first."""
+        query = normalize(embedding)
+        with self._lock:
+            return self._entries.top_k(query, top_k)
+
+
+def build_gallery():
+    """Create the gallery implementation selected by `settings.GALLERY_INDEX`."""
+    if settings.GALLERY_INDEX == "ivf":
+        from .ann import IVFIndex
+        return IVFIndex(
+            nlist=settings.ANN_NLIST,
+            nprobe=settings.ANN_NPROBE,
+            train_size=settings.ANN_TRAIN_SIZE,
+            kmeans_iterations=settings.ANN_KMEANS_ITERATIONS,
+            snapshot_path=settings.ANN_SNAPSHOT_PATH or None,
+        )
+    return EmbeddingGallery()
+
+
+# Shared gallery for this worker process. It is loaded lazily on the first
+# identification and kept in sync by enrollment and deactivation; changes
+# made by other workers are picked up through the embedding cache's shared
+# counter (see `services.sync_gallery`).
+gallery = build_gallery()
@@ -0,0 +1,156 @@
+"""
+Cheap checks and fast decoding for uploaded images.
+
+Dimensions are read from the file header without decoding, so payloads that
+are not images, or that would decode to an enormous bitmap, are rejected
+before any pixel work. JPEGs larger than needed for detection are decoded
+directly at reduced scale by libjpeg (`IMREAD_REDUCED_COLOR_*`), which
+skips most of the IDCT work and never materializes the full-size frame.
+Stored captures (aligned crops, thumbnails) are re-encoded as small WebP
+or JPEG files.
+"""
+import struct
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .blobstore import sniff_media_type
+from .core.config import settings
+
+# SOF markers carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) share the range but do not
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Formats stored captures can be encoded as
+FORMATS = {
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+}
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # Fill byte
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2  # Standalone markers have no length
+            continue
+        if marker == 0xD9:
+            return None
+        (length,) = struct.unpack_from(">H", data, offset + 2)
+        if marker in _JPEG_SOF:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack_from("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    return None
+
+
+def read_image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from the image header, or None if it cannot be read."""
+    try:
+        media_type = sniff_media_type(data[:16])
+        if media_type == "image/jpeg":
+            return _jpeg_size(data)
+        if media_type == "image/png" and len(data) >= 24:
+            return struct.unpack_from(">II", data, 16)
+        if media_type == "image/gif" and len(data) >= 10:
+            return struct.unpack_from("<HH", data, 6)
+        if media_type == "image/bmp" and len(data) >= 26:
+            width, height = struct.unpack_from("<ii", data, 18)
+            return abs(width), abs(height)
+        if media_type == "image/webp":
+            return _webp_size(data)
+    except struct.error:
+        return None
+    return None
+
+
+def check_image_payload(data: bytes) -> Tuple[str, Tuple[int, int]]:
+    """
+    Reject payloads that are too large, not a supported image, or declare too
+    many pixels. Returns the media type and (width, height).
+    """
+    if not data:
+        raise ValueError("Empty image payload.")
+    if len(data) > settings.MAX_IMAGE_BYTES:
+        raise ValueError(f"Image exceeds the {settings.MAX_IMAGE_BYTES} byte limit.")
+    media_type = sniff_media_type(data[:16])
+    if media_type == "application/octet-stream":
+        raise ValueError("Unsupported image format.")
+    size = read_image_size(data)
+    if size is None or min(size) <= 0:
+        raise ValueError("Could not read the image dimensions.")
+    if size[0] * size[1] > settings.MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image exceeds the {settings.MAX_IMAGE_PIXELS} pixel limit.")
+    return media_type, size
+
+
+def check_base64_length(base64_string: str):
+    """Reject an encoded payload by its length alone, before decoding it."""
+    if len(base64_string) * 3 // 4 > settings.MAX_IMAGE_BYTES + 3:
+        raise ValueError(f"Image exceeds the {settings.MAX_IMAGE_BYTES} byte limit.")
+
+
+def decode_flag(media_type: str, size: Tuple[int, int], min_side: Optional[int] = None) -> int:
+    """Largest JPEG reduction that keeps the longer side at least `min_side`."""
+    min_side = settings.IMAGE_DECODE_MIN_SIDE if min_side is None else min_side
+    if media_type != "image/jpeg" or min_side <= 0:
+        return cv2.IMREAD_COLOR
+    longest = max(size)
+    for factor, flag in _REDUCED_FLAGS:
+        if longest // factor >= min_side:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode(data: bytes, min_side: Optional[int] = None) -> Optional[np.ndarray]:
+    """Decode image bytes to a BGR array, at reduced scale where the header allows it."""
+    img_np = np.frombuffer(data, dtype=np.uint8)
+    if img_np.size == 0:
+        return None
+    size = read_image_size(data)
+    flag = decode_flag(sniff_media_type(data[:16]), size, min_side) if size else cv2.IMREAD_COLOR
+    return cv2.imdecode(img_np, flag)
+
+
+def encode(image: np.ndarray, fmt: str, quality: int) -> bytes:
+    """Encode a BGR array as 'webp' or 'jpeg' at the given quality (1-100)."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Image format must be one of {', '.join(FORMATS)}")
+    extension, flag = FORMATS[fmt]
+    ok, buffer = cv2.imencode(extension, image, [flag, int(quality)])
+    if not ok:
+        raise ValueError(f"Could not encode the image as {fmt}.")
+    return buffer.tobytes()
+
+
+def thumbnail(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Downscale so the longer side is at most `max_side` (smaller images are returned as is)."""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,392 @@
+"""
+Micro-batching scheduler for face embedding inference.
+
+Concurrent requests hand their decoded frames to one scheduler thread,
+which collects up to `max_batch_size` jobs (waiting at most `max_wait_ms`
+after the first one), runs detection per frame on a small thread pool, and
+then runs the ArcFace recognition model once on the stacked batch of aligned
+face crops.
+
+Only the detection and recognition models are ever loaded and run; frames
+may ask for their own detector input size (smaller for close-up
+verification shots). Sessions use the ONNX Runtime options from Settings
+and can keep their optimized graphs on disk between starts.
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import onnxruntime as ort
+from insightface.utils import face_align
+
+from .core.config import settings
+from .metrics import stage_seconds
+
+logger = logging.getLogger(__name__)
+
+DetSize = Optional[Tuple[int, int]]
+# (normalized embedding, aligned BGR face crop)
+Face = Tuple[np.ndarray, np.ndarray]
+
+
+def square_det_size(size: int) -> DetSize:
+    """Square detector input size from a setting; 0 means the analyzer's default."""
+    return (size, size) if size > 0 else None
+
+
+# ONNX Runtime graph optimization levels, by setting value
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Model manifest kept next to the optimized models: file name -> task (or null)
+TASKS_FILE = "tasks.json"
+
+
+def session_options(level: Optional[str] = None, optimized_model_path: Optional[str] = None) -> ort.SessionOptions:
+    """ONNX Runtime session options from Settings."""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[level or settings.ORT_GRAPH_OPTIMIZATION]
+    if settings.ORT_INTRA_OP_THREADS > 0:
+        options.intra_op_num_threads = settings.ORT_INTRA_OP_THREADS
+    if settings.ORT_INTER_OP_THREADS > 0:
+        # Inter-op threads only run independent graph branches in parallel mode
+        options.inter_op_num_threads = settings.ORT_INTER_OP_THREADS
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    options.log_severity_level = 3
+    if optimized_model_path:
+        options.optimized_model_filepath = optimized_model_path
+    return options
+
+
+def _providers() -> List[str]:
+    return [settings.PROVIDER + "ExecutionProvider"]
+
+
+def _open_session(source: str, cache_dir: Optional[str]) -> ort.InferenceSession:
+    """
+    Session for a model file. With a cache directory, the graph is optimized
+    once, saved there, and later loaded as is, skipping the optimization
+    passes on every worker start.
+    """
+    if cache_dir:
+        cached = os.path.join(cache_dir, os.path.basename(source))
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(source):
+            return ort.InferenceSession(cached, session_options("disable"), providers=_providers())
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = f"{cached}.{os.getpid()}.tmp"
+        try:
+            session = ort.InferenceSession(source, session_options(optimized_model_path=partial), providers=_providers())
+            # Renamed into place, so workers starting together never load a half-written file
+            os.replace(partial, cached)
+            return session
+        except Exception as e:
+            # Some execution providers compile nodes that cannot be serialized
+            logger.warning("Not caching the optimized model of %s: %s", source, e)
+            if os.path.exists(partial):
+                os.remove(partial)
+    return ort.InferenceSession(source, session_options(), providers=_providers())
+
+
+def _model_task(session: ort.InferenceSession) -> Optional[str]:
+    """The task of a pack model, by the routing rules of insightface's `ModelRouter`."""
+    inputs = session.get_inputs()
+    shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return "detection"
+    side = shape[2] if len(shape) == 4 else None
+    # 192 x 192 inputs are the landmark models, 96 x 96 the gender/age one
+    if len(inputs) == 1 and isinstance(side, int) and side == shape[3] and side >= 112 and side % 16 == 0 and side != 192:
+        return "recognition"
+    return None
+
+
+def _read_tasks(cache_dir: Optional[str]) -> dict:
+    if cache_dir and os.path.exists(os.path.join(cache_dir, TASKS_FILE)):
+        with open(os.path.join(cache_dir, TASKS_FILE)) as f:
+            return json.load(f)
+    return {}
+
+
+def _write_tasks(cache_dir: Optional[str], tasks: dict):
+    if cache_dir:
+        partial = os.path.join(cache_dir, f"{TASKS_FILE}.{os.getpid()}.tmp")
+        with open(partial, "w") as f:
+            json.dump(tasks, f, indent=2, sort_keys=True)
+        os.replace(partial, os.path.join(cache_dir, TASKS_FILE))
+
+
+class FaceModels:
+    """
+    The detection and recognition models of a pack: the part of
+    insightface's `FaceAnalysis` that `embed_batch` uses, built with our
+    own ONNX Runtime session options.
+    """
+
+    def __init__(self, models: dict):
+        if "detection" not in models or "recognition" not in models:
+            raise RuntimeError(f"Model pack is missing a detection or recognition model (found {sorted(models)})")
+        self.models = models
+        self.det_model = models["detection"]
+
+    def prepare(self, ctx_id: int, det_thresh: float = 0.5, det_size: Tuple[int, int] = (640, 640)):
+        self.det_size = det_size
+        for task, model in self.models.items():
+            if task == "detection":
+                model.prepare(ctx_id, input_size=det_size, det_thresh=det_thresh)
+            else:
+                model.prepare(ctx_id)
+
+
+def load_face_analyzer(model_pack: Optional[str] = None, modules: Optional[Sequence[str]] = None,
+                       det_size: Optional[int] = None) -> FaceModels:
+    """
+    Load and prepare the pack's detection and recognition models (~180MB
+    for buffalo_l), downloading the pack on first use.
+
+    `FaceAnalysis` opens a session for every model in the pack and then
+    drops the unwanted ones. With ORT_CACHE_OPTIMIZED_MODELS, the task of
+    each file is remembered next to the optimized copies, so later starts
+    open only the needed models, from those copies.
+    """
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.retinaface import RetinaFace
+    from insightface.utils import ensure_available
+
+    model_pack = model_pack or settings.MODEL_PACK
+    modules = set(modules or [name.strip() for name in settings.MODEL_MODULES.split(",") if name.strip()])
+    size = det_size or settings.DET_SIZE
+    model_dir = ensure_available("models", model_pack, root=settings.MODEL_ROOT)
+    cache_dir = None
+    if settings.ORT_CACHE_OPTIMIZED_MODELS:
+        # Optimized graphs depend on the provider and level they were built for
+        cache_root = settings.ORT_OPTIMIZED_MODEL_DIR or os.path.join(os.path.expanduser(settings.MODEL_ROOT), "optimized")
+        cache_dir = os.path.join(cache_root, model_pack, f"{settings.PROVIDER.lower()}-{settings.ORT_GRAPH_OPTIMIZATION}")
+
+    tasks = _read_tasks(cache_dir)
+    models = {}
+    for source in sorted(glob.glob(os.path.join(model_dir, "*.onnx"))):
+        name = os.path.basename(source)
+        if name in tasks and (tasks[name] not in modules or tasks[name] in models):
+            continue  # Known not to be needed; do not even open it
+        if name not in tasks and cache_dir:
+            # Identify it without optimizing (and caching) a model that may be dropped
+            probe = ort.InferenceSession(source, session_options("disable"), providers=["CPUExecutionProvider"])
+            tasks[name] = _model_task(probe)
+            del probe
+            if tasks[name] not in modules or tasks[name] in models:
+                continue
+        session = _open_session(source, cache_dir)
+        task = tasks[name] = _model_task(session)
+        if task in models or task not in modules:
+            continue
+        # The original file is passed as model_file: ArcFaceONNX reads its first
+        # nodes to pick the input normalization, which optimization may rename.
+        models[task] = (RetinaFace if task == "detection" else ArcFaceONNX)(model_file=source, session=session)
+    _write_tasks(cache_dir, tasks)
+
+    analyzer = FaceModels(models)
+    analyzer.prepare(ctx_id=0, det_size=(size, size))
+    return analyzer
+
+
+def warm_up(analyzer, det_sizes: Sequence[DetSize], batch_sizes: Sequence[int]):
+    """
+    Run every detector input size and recognition batch size once. ONNX
+    Runtime allocates buffers and picks kernels per input shape on first
+    use, which would otherwise land on the first requests.
+    """
+    for size in dict.fromkeys(det_sizes):
+        side = size or analyzer.det_size
+        blank = np.zeros((side[1], side[0], 3), dtype=np.uint8)
+        analyzer.det_model.detect(blank, input_size=size, max_num=0, metric="default")
+    recognizer = analyzer.models["recognition"]
+    crop = np.zeros((recognizer.input_size[1], recognizer.input_size[0], 3), dtype=np.uint8)
+    for batch_size in sorted(set(batch_sizes)):
+        recognizer.get_feat([crop] * batch_size)
+
+
+def embed_batch(analyzer, images: List[np.ndarray],
+                det_sizes: Optional[Sequence[DetSize]] = None) -> List[Optional[np.ndarray]]:
+    """Detect faces frame by frame, then embed every single-face crop in one recognition call."""
+    return [None if face is None else face[0] for face in embed_faces(analyzer, images, det_sizes)]
+
+
+def embed_faces(analyzer, images: List[np.ndarray], det_sizes: Optional[Sequence[DetSize]] = None,
+                executor: Optional[Executor] = None) -> List[Optional[Face]]:
+    """
+    `embed_batch` that also returns the aligned crop each embedding was
+    computed from. With an executor, frames are detected in parallel.
+    """
+    recognizer = analyzer.models["recognition"]
+    crop_size = recognizer.input_size[0]
+    det_sizes = det_sizes or [None] * len(images)
+
+    def detect(image: np.ndarray, size: DetSize):
+        return analyzer.det_model.detect(image, input_size=size, max_num=0, metric="default")
+
+    if executor is not None and len(images) > 1:
+        detections = list(executor.map(detect, images, det_sizes))
+    else:
+        detections = [detect(image, size) for image, size in zip(images, det_sizes)]
+    crops = []
+    owners = []
+    for i, (image, (bboxes, kpss)) in enumerate(zip(images, detections)):
+        # Same rule as `get_embedding`: exactly one face or no embedding
+        if bboxes.shape[0] == 1 and kpss is not None:
+            crops.append(face_align.norm_crop(image, landmark=kpss[0], image_size=crop_size))
+            owners.append(i)
+
+    results: List[Optional[Face]] = [None] * len(images)
+    if crops:
+        embeddings = recognizer.get_feat(crops).astype(np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, 1e-12)
+        for owner, embedding, crop in zip(owners, embeddings, crops):
+            results[owner] = (embedding, crop)
+    return results
+
+
+class InferenceScheduler:
+    """
+    Batch concurrent `embed()` calls onto a shared `FaceAnalysis` instance.
+
+    Detection has no batched form, so the frames of a batch are detected on
+    `detection_workers` threads (ONNX Runtime releases the GIL while running).
+    """
+
+    def __init__(self, analyzer, max_batch_size: int = 8, max_wait_ms: float = 2.0, max_queue_size: int = 0,
+                 detection_workers: int = 2):
+        self.analyzer = analyzer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.detection_workers = detection_workers
+        self._queue: "queue.Queue[Tuple[np.ndarray, DetSize, Future, float]]" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._detector: Optional[ThreadPoolExecutor] = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+
+        # Metrics
+        self._stats_lock = threading.Lock()
+        self.jobs = 0
+        self.batches = 0
+        self.batch_sizes: Counter = Counter()
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.total_inference = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                if self.detection_workers > 1 and self._detector is None:
+                    self._detector = ThreadPoolExecutor(self.detection_workers, thread_name_prefix="inference-detect")
+                self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the scheduler thread and fail the jobs still queued."""
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._fail_pending()
+        if self._detector is not None:
+            self._detector.shutdown(wait=False)
+            self._detector = None
+
+    def _fail_pending(self):
+        while True:
+            try:
+                _, _, future, _ = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            future.set_exception(RuntimeError("Inference scheduler stopped"))
+
+    def submit(self, image: np.ndarray, det_size: DetSize = None) -> Future:
+        """Queue a frame for embedding; the future resolves to the face (embedding, crop) or None."""
+        if self._thread is None:
+            self.start()
+        future: Future = Future()
+        self._queue.put((image, det_size, future, time.perf_counter()))
+        if self._stopping and self._thread is None:
+            # Queued after `stop` drained the queue; nothing would pick it up
+            self._fail_pending()
+        depth = self._queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return future
+
+    def embed(self, image: np.ndarray, det_size: DetSize = None) -> Optional[Face]:
+        """Blocking helper: the single face in the image, or None."""
+        return self.submit(image, det_size).result()
+
+    def _collect(self) -> List[Tuple[np.ndarray, DetSize, Future, float]]:
+        """Wait for one job, then gather more until the batch is full or the wait budget runs out."""
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                results = embed_faces(
+                    self.analyzer, [image for image, _, _, _ in batch], [size for _, size, _, _ in batch],
+                    self._detector,
+                )
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            stage_seconds.observe(finished - started, "inference_batch")
+
+            with self._stats_lock:
+                self.jobs += len(batch)
+                self.batches += 1
+                self.batch_sizes[len(batch)] += 1
+                self.total_wait += sum(started - queued_at for _, _, _, queued_at in batch)
+                self.total_inference += finished - started
+            for (_, _, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "jobs": self.jobs,
+                "batches": self.batches,
+                "mean_batch_size": self.jobs / self.batches if self.batches else 0.0,
+                "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "mean_queue_wait_ms": self.total_wait / self.jobs * 1000 if self.jobs else 0.0,
+                "mean_batch_inference_ms": self.total_inference / self.batches * 1000 if self.batches else 0.0,
+            }
@@ -1,17 +1,45 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .db import models
-from .db.database import engine
-from .api import router as api_router
+from .db import migrate, models
+from .db.database import async_engine, engine
+from .api import router as api_router, shard_router
 from .core.config import settings
+from .gallery import gallery
+from . import services
+from .audit import audit_writer
+from .executor import inference_executor, storage_executor
+from . import metrics
 
-# Create all database tables
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.DB_CREATE_TABLES:
+        # Create all database tables
+        await asyncio.to_thread(models.Base.metadata.create_all, bind=engine)
+    # Fail fast on a database that still needs `python -m app.db.migrate`
+    await asyncio.to_thread(migrate.check_schema, engine)
+    # Replays any audit journal left behind by a crash
+    audit_writer.start()
+    # Load and warm up the model before accepting requests
+    await asyncio.to_thread(services.start_inference)
+    yield
+    audit_writer.stop()
+    # Persist the IVF index so the next worker can restore instead of rebuilding
+    if settings.GALLERY_INDEX == "ivf" and settings.ANN_SNAPSHOT_PATH and gallery.loaded:
+        gallery.save(settings.ANN_SNAPSHOT_PATH)
+    services.stop_inference()
+    inference_executor.shutdown()
+    storage_executor.shutdown()
+    await async_engine.dispose()
 
 app = FastAPI(
     title="Face Recognition Authentication API",
     description="A passwordless authentication system using FastAPI and ArcFace.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # --- ADD THE CORS MIDDLEWARE ---
@@ -38,9 +66,20 @@ app.add_middleware(
 # --- END OF CORS CONFIGURATION ---
 
 
+# Stage spans, request latency histograms and the optional Server-Timing header
+app.add_middleware(metrics.TimingMiddleware)
+
 # Include the API router with a prefix
 app.include_router(api_router, prefix="/api")
+# Endpoints for the shard router, only on shards of a sharded deployment
+if settings.SHARD_TOKEN:
+    app.include_router(shard_router, prefix="/api")
 
 @app.get("/", tags=["Root"])
 def read_root():
-    return {"message": "Welcome to the Face Recognition API"}
\ No newline at end of file
+    return {"message": "Welcome to the Face Recognition API"}
+
+@app.get("/metrics", tags=["Root"], response_class=PlainTextResponse)
+def read_metrics():
+    """Prometheus metrics of this worker process."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,249 @@
+"""
+Per-stage timing spans and Prometheus metrics.
+
+`span("decode")` times a block of a request and records it twice: in the
+`face_auth_stage_seconds` histogram, and in the current request's span
+list, which `TimingMiddleware` returns as a `Server-Timing` header when
+SERVER_TIMING is on. The span list lives in a context variable, so spans
+recorded on the inference executor, in `asyncio.to_thread` or inside
+`AsyncSession.run_sync` are attributed to the request that started them.
+
+`render()` produces the Prometheus text format for `/metrics`: the stage
+and request histograms, plus gauges read at scrape time from the stats of
+the inference scheduler, executor, connection pools, embedding cache and
+audit writer. Metrics are per process; with several workers, scrape each
+one or aggregate in Prometheus.
+"""
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .core.config import settings
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (name, seconds) of every span recorded for the current request, or None outside one
+_request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_spans", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """A labelled Prometheus histogram with fixed buckets."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> (per-bucket counts, sum, count)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        for labelvalues, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _labels(self.labelnames + ("le",), labelvalues + (repr(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames + ("le",), labelvalues + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "face_auth_stage_seconds", "Time spent in each stage of enrollment, verification and identification.", ("stage",)
+)
+request_seconds = Histogram(
+    "face_auth_request_seconds", "HTTP request latency by route and status.", ("method", "route", "status")
+)
+
+
+@contextmanager
+def span(name: str):
+    """Time a block as stage `name`."""
+    if not settings.METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, name)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+def timed(name: Optional[str] = None):
+    """Decorator recording every call of a function (sync or async) as a span."""
+    def decorate(fn: Callable):
+        stage = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def server_timing(spans: List[Tuple[str, float]]) -> str:
+    """`Server-Timing` header value; repeated stages (e.g. one embed per image) are summed."""
+    totals: Dict[str, List[float]] = {}
+    for name, seconds in spans:
+        entry = totals.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+    parts = []
+    for name, (seconds, count) in totals.items():
+        metric = name.replace(".", "-")
+        parts.append(f'{metric};dur={seconds * 1000:.2f}' + (f';desc="x{count}"' if count > 1 else ""))
+    return ", ".join(parts)
+
+
+class TimingMiddleware:
+    """ASGI middleware: request latency histogram, span collection and the Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        spans: List[Tuple[str, float]] = []
+        token = _request_spans.set(spans)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if settings.SERVER_TIMING:
+                    total = ("total", time.perf_counter() - started)
+                    header = server_timing(spans + [total]).encode("latin-1")
+                    message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_spans.reset(token)
+            request_seconds.observe(time.perf_counter() - started, scope["method"], route_label(scope), str(status[0]))
+
+
+def route_label(scope) -> str:
+    """
+    The matched route template, e.g. /api/users/{user_id}. Templates keep
+    the label set bounded, unlike raw paths with one series per user ID.
+    """
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    # Routes of an included router know their path without the include prefix
+    try:
+        concrete = route.path_format.format(**scope.get("path_params", {}))
+    except (AttributeError, KeyError, IndexError):
+        return template
+    path = scope.get("path", "")
+    if path.endswith(concrete):
+        return path[:len(path) - len(concrete)] + template
+    return template
+
+
+def _gauges(name: str, documentation: str, samples: List[Tuple[Dict[str, str], Optional[float]]],
+            kind: str = "gauge") -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        if value is not None:
+            lines.append(f"{name}{_labels(labels.keys(), labels.values())} {float(value)}")
+    return lines
+
+
+def _component_metrics() -> List[str]:
+    from . import services
+    from .audit import audit_writer
+    from .db.database import database_stats
+    from .embedding_cache import embedding_cache
+    from .executor import inference_executor
+
+    lines = []
+    if services.scheduler is not None:
+        inference = services.scheduler.stats()
+        lines += _gauges("face_auth_inference_queue_depth", "Frames waiting for an inference batch.",
+                         [({}, inference.get("queue_depth"))])
+        lines += _gauges("face_auth_inference_batches_total", "Inference batches run.",
+                         [({}, inference.get("batches"))], "counter")
+
+    executor = inference_executor.stats()
+    lines += _gauges("face_auth_executor_in_flight", "Requests holding an inference executor slot.",
+                     [({}, executor["in_flight"])])
+    lines += _gauges("face_auth_executor_capacity", "Inference executor slots (running plus queued).",
+                     [({}, executor["max_in_flight"])])
+    lines += _gauges("face_auth_executor_rejected_total", "Requests rejected with 429 by admission control.",
+                     [({}, executor["rejected"])], "counter")
+
+    pools = database_stats()
+    lines += _gauges("face_auth_db_connections_in_use", "Checked-out database connections.",
+                     [({"engine": engine}, pool["in_use"]) for engine, pool in pools.items()])
+    lines += _gauges("face_auth_db_connections_capacity", "Connection pool size plus overflow.",
+                     [({"engine": engine}, pool["capacity"]) for engine, pool in pools.items()])
+    lines += _gauges("face_auth_db_checkouts_total", "Database connection checkouts.",
+                     [({"engine": engine}, pool["checkouts"]) for engine, pool in pools.items()], "counter")
+
+    cache = embedding_cache.stats()
+    lines += _gauges("face_auth_embedding_cache_hits_total", "Template cache hits.", [({}, cache["hits"])], "counter")
+    lines += _gauges("face_auth_embedding_cache_misses_total", "Template cache misses.", [({}, cache["misses"])], "counter")
+    lines += _gauges("face_auth_embedding_cache_hit_rate", "Template cache hit rate since start.", [({}, cache["hit_rate"])])
+    lines += _gauges("face_auth_embedding_cache_size", "Users in the template cache.", [({}, cache["size"])])
+
+    audit = audit_writer.stats()
+    lines += _gauges("face_auth_audit_queue_depth", "Audit records waiting to be written.",
+                     [({}, audit.get("queue_depth"))])
+    return lines
+
+
+def render() -> str:
+    lines = stage_seconds.render() + request_seconds.render() + _component_metrics()
+    return "\n".join(lines) + "\n"
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 
 # Schema for the enrollment request body
@@ -7,22 +7,90 @@ class EnrollRequest(BaseModel):
     user_id: str
     images: List[str]  # List of base64-encoded image data URLs
 
+# Schema for the bulk enrollment request body
+class BatchEnrollRequest(BaseModel):
+    users: List[EnrollRequest]
+
 # Schema for the verification request body
 class VerifyRequest(BaseModel):
     user_id: str
     image: str  # A single base64-encoded image data URL
 
+# Schema for the identification (1:N) request body
+class IdentifyRequest(BaseModel):
+    image: str  # A single base64-encoded image data URL
+    top_k: int = 5
+
+# A face embedded by one shard for a sharded identification
+class ShardFace(BaseModel):
+    embedding: List[float]
+    crop: Optional[str] = None  # Base64 aligned face crop, encoded as IMAGE_FORMAT
+
+# Search of one shard's gallery for a face embedded by another shard
+class ShardSearchRequest(BaseModel):
+    embedding: List[float]
+    top_k: int = 5
+
+# An identification decided by the shard router, recorded on one shard
+class IdentifyRecordRequest(BaseModel):
+    image: str  # A single base64-encoded image data URL
+    user_id: Optional[str] = None  # None for an unknown face
+    similarity: Optional[float] = None
+    embedding: Optional[List[float]] = None  # None when no face was found
+    crop: Optional[str] = None
+
 # Standard success response
 class SuccessResponse(BaseModel):
     ok: bool
     user_id: str
 
+# An enrolled user with the same face as a new enrollment
+class DuplicateMatch(BaseModel):
+    user_id: str
+    similarity: float
+
+# Enrollment response, with any duplicates found under DUPLICATE_POLICY 'flag' or 'link'
+class EnrollResponse(SuccessResponse):
+    duplicates: List[DuplicateMatch] = []
+
+# Why a single image was rejected during bulk enrollment
+class RejectedImage(BaseModel):
+    index: int
+    reason: str
+
+# Per-user outcome of bulk enrollment
+class BatchEnrollResult(BaseModel):
+    user_id: str
+    status: str  # 'enrolled', 'exists', 'rejected' or 'duplicate'
+    accepted_images: int
+    rejected_images: List[RejectedImage] = []
+    duplicates: List[DuplicateMatch] = []
+
+# Schema for the bulk enrollment response
+class BatchEnrollResponse(BaseModel):
+    ok: bool
+    enrolled: int
+    results: List[BatchEnrollResult]
+
 # Schema for the verification response
 class VerifyResponse(BaseModel):
     ok: bool
     match: bool
     similarity: Optional[float] = None
 
+# A single gallery match returned by identification
+class IdentifyCandidate(BaseModel):
+    user_id: str
+    similarity: float
+
+# Schema for the identification response
+class IdentifyResponse(BaseModel):
+    ok: bool
+    match: bool
+    user_id: Optional[str] = None
+    similarity: Optional[float] = None
+    candidates: List[IdentifyCandidate] = []
+
 # User information schema
 class UserInfo(BaseModel):
     id: str
@@ -61,11 +129,59 @@ class UnknownAccessInfo(BaseModel):
     id: int
     attempted_user_id: Optional[str] = None
     ip_address: Optional[str] = None
+    cluster_id: Optional[int] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
+# Unknown face seen in several attempts
+class UnknownClusterInfo(BaseModel):
+    id: int
+    attempts: int
+    first_seen: datetime
+    last_seen: datetime
+
+    class Config:
+        from_attributes = True
+
+# Recorded duplicate identity
+class DuplicateInfo(BaseModel):
+    id: int
+    user_id: str
+    duplicate_of: str
+    similarity: float
+    status: str
+    source: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+# A user image moved between shards
+class ImageTransfer(BaseModel):
+    image_type: str
+    image_ref: Optional[str] = None
+    image_data: Optional[str] = None
+    thumbnail_ref: Optional[str] = None
+    embedding: Optional[List[float]] = None
+    created_at: datetime
+
+# A user with their images and image blobs (base64 by reference), moved between shards
+class UserTransfer(BaseModel):
+    id: str
+    embedding: List[float]
+    templates: Optional[List[List[float]]] = None
+    created_at: datetime
+    updated_at: datetime
+    images: List[ImageTransfer] = []
+    blobs: Dict[str, str] = {}
+
+# A shard added to the router's ring (see app/sharding.py)
+class ShardSpec(BaseModel):
+    name: str
+    url: str
+
 # Statistics schemas
 class UserStats(BaseModel):
     user_id: str
@@ -82,10 +198,91 @@ class SystemStats(BaseModel):
     unknown_attempts: int
     success_rate: float
 
-# Image data response (for viewing stored images)
-class ImageDataResponse(BaseModel):
-    id: int
-    user_id: str
-    image_data: str  # Base64 encoded
-    image_type: str
-    created_at: datetime
\ No newline at end of file
+class StatsBucket(BaseModel):
+    bucket_start: datetime
+    granularity: str
+    total_attempts: int
+    successful_attempts: int
+    unknown_attempts: int
+    enrolled_users: int
+
+    class Config:
+        from_attributes = True
+
+# FAR/FRR of one threshold; the curve of these points is the ROC (tar vs far) and DET (frr vs far)
+class CalibrationPoint(BaseModel):
+    threshold: float
+    far: float
+    frr: float
+    tar: float
+
+class CalibrationReport(BaseModel):
+    users: int
+    probes: int
+    skipped_probes: int
+    scoring: str
+    genuine_pairs: int
+    impostor_pairs: int
+    target_far: float
+    recommended: CalibrationPoint
+    current: CalibrationPoint
+    eer: float
+    eer_threshold: float
+    curve: List[CalibrationPoint]
+    elapsed_seconds: float
+
+class InferenceStats(BaseModel):
+    enabled: bool
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    jobs: int = 0
+    batches: int = 0
+    mean_batch_size: float = 0.0
+    batch_size_histogram: Dict[str, int] = {}
+    mean_queue_wait_ms: float = 0.0
+    mean_batch_inference_ms: float = 0.0
+
+class AuditStats(BaseModel):
+    enabled: bool
+    queue_depth: int
+    enqueued: int
+    written: int
+    flushes: int
+    failures: int
+    pending_retry: int
+    sync_fallbacks: int
+    mean_flush_ms: float
+
+class EmbeddingCacheStats(BaseModel):
+    enabled: bool
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    hit_rate: float
+    evictions: int
+    expirations: int
+    invalidations: int
+    remote_clears: int
+
+class ExecutorStats(BaseModel):
+    max_workers: int
+    max_in_flight: int
+    in_flight: int
+    peak_in_flight: int
+    admitted: int
+    rejected: int
+
+class PoolStats(BaseModel):
+    pool: str
+    status: str
+    capacity: Optional[int] = None
+    in_use: int
+    peak_in_use: int
+    utilization: Optional[float] = None
+    checkouts: int
+    connects: int
+
+class DatabaseStats(BaseModel):
+    sync_engine: PoolStats
+    async_engine: PoolStats
\ No newline at end of file
@@ -1,39 +1,166 @@
+import asyncio
 import base64
-import cv2
-import insightface
+import os
+import threading
+from datetime import datetime
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional, Tuple
+from typing import Iterator, List, Optional, Tuple, Union
 
 # MODIFIED IMPORT: We now import 'crud' directly.
 from .db import crud
+from . import duplicates, imaging, templates
 from .core.config import settings
+from .gallery import gallery, normalize
+from .embedding_cache import embedding_cache
+from .blobstore import blob_store, decode_data_url
+from .inference import Face, InferenceScheduler, embed_faces, load_face_analyzer, square_det_size
+from .inference import warm_up as warm_up_model
+from .workers import InferencePoolClient
+from .audit import audit_writer
+from .executor import inference_executor, storage_executor
+from .metrics import span, timed
 
-# Initialize the FaceAnalysis model from insightface
-# This is a heavy object, so we initialize it once and reuse it.
-face_analyzer = insightface.app.FaceAnalysis(
-    providers=[settings.PROVIDER + 'ExecutionProvider']
-)
-face_analyzer.prepare(ctx_id=0, det_size=(640, 640))
+# Inference backend, set up by `start_inference` (on app startup, or lazily
+# on first use from CLIs): the local model and its batching scheduler, or a
+# client of the shared worker pool. Importing this module loads nothing.
+face_analyzer = None
+scheduler = None
+inference_pool = None
+_inference_lock = threading.Lock()
+
+# Detector input size for verification frames (None = the model's default)
+VERIFY_DET_SIZE = square_det_size(settings.VERIFY_DET_SIZE)
+
+if settings.TEMPLATE_SCORING not in templates.STRATEGIES:
+    raise ValueError(f"TEMPLATE_SCORING must be one of {', '.join(templates.STRATEGIES)}")
+if settings.IMAGE_STORAGE not in ("crop", "frame"):
+    raise ValueError("IMAGE_STORAGE must be 'crop' or 'frame'")
+if settings.IMAGE_FORMAT not in imaging.FORMATS:
+    raise ValueError(f"IMAGE_FORMAT must be one of {', '.join(imaging.FORMATS)}")
+
+def inference_ready() -> bool:
+    return face_analyzer is not None or inference_pool is not None
+
+def start_inference(warm_up: Optional[bool] = None):
+    """Load the model (or connect to the worker pool) and start the batching scheduler; idempotent."""
+    global face_analyzer, scheduler, inference_pool
+    warm_up = settings.MODEL_WARMUP if warm_up is None else warm_up
+    with _inference_lock:
+        if inference_ready():
+            return
+        if settings.INFERENCE_POOL_ADDRESS:
+            # Inference runs in the shared worker pool; this process never loads the model
+            inference_pool = InferencePoolClient(
+                settings.INFERENCE_POOL_ADDRESS, settings.INFERENCE_POOL_TIMEOUT_SECONDS
+            )
+            return
+        analyzer = load_face_analyzer()
+        if warm_up:
+            warm_up_model(analyzer, [None, VERIFY_DET_SIZE], [1, settings.INFERENCE_BATCH_SIZE])
+        # Batches concurrent embedding requests onto the shared model
+        if settings.INFERENCE_BATCHING:
+            scheduler = InferenceScheduler(
+                analyzer,
+                max_batch_size=settings.INFERENCE_BATCH_SIZE,
+                max_wait_ms=settings.INFERENCE_BATCH_WAIT_MS,
+                detection_workers=settings.INFERENCE_DETECTION_WORKERS,
+            )
+            scheduler.start()
+        face_analyzer = analyzer
+
+def stop_inference():
+    """Stop the scheduler and release the model."""
+    global face_analyzer, scheduler, inference_pool
+    with _inference_lock:
+        if scheduler is not None:
+            scheduler.stop()
+        face_analyzer = scheduler = inference_pool = None
+
+def read_image_payload(image: Union[str, bytes]) -> bytes:
+    """
+    Get the raw bytes of an uploaded image (raw bytes or a base64 string),
+    raising ValueError for oversized or non-image payloads before any decoding.
+    """
+    if isinstance(image, str):
+        imaging.check_base64_length(image)
+        image = decode_data_url(image)
+    imaging.check_image_payload(image)
+    return image
+
+def decode_image_bytes(img_bytes: bytes) -> Optional[np.ndarray]:
+    """Decode raw image bytes to a NumPy array (image), downscaling large JPEGs on decode."""
+    return imaging.decode(img_bytes)
 
 def decode_image(base64_string: str) -> np.ndarray:
     """Decode a base64 string to a NumPy array (image)."""
-    # The string might be a data URL, so we strip the header.
-    if "," in base64_string:
-        base64_string = base64_string.split(',')[1]
-    
-    img_bytes = base64.b64decode(base64_string)
-    img_np = np.frombuffer(img_bytes, dtype=np.uint8)
-    img = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
-    return img
-
-def get_embedding(image: np.ndarray) -> Optional[np.ndarray]:
-    """Get the face embedding from a single image."""
-    faces = face_analyzer.get(image)
-    if faces and len(faces) == 1:
-        # Return the normalized embedding for the detected face
-        return faces[0].normed_embedding
-    return None
+    return decode_image_bytes(decode_data_url(base64_string))
+
+@timed("store_image")
+def store_image(img_bytes: bytes) -> str:
+    """Save image bytes in the blob store and return their reference."""
+    return blob_store.put(img_bytes)
+
+def store_capture(img_bytes: Optional[bytes], image: Optional[np.ndarray],
+                  crop: Optional[np.ndarray]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Store a captured frame per IMAGE_STORAGE. Returns (image_ref, thumbnail_ref):
+    the aligned face crop (or the uploaded bytes in 'frame' mode) and a
+    thumbnail of the decoded frame; either is None when there is nothing to store.
+    """
+    if settings.IMAGE_STORAGE == "frame":
+        image_ref = store_image(img_bytes) if img_bytes else None
+    elif crop is not None:
+        with span("store_image"):
+            image_ref = blob_store.put(imaging.encode(crop, settings.IMAGE_FORMAT, settings.IMAGE_QUALITY))
+    else:
+        image_ref = None
+    if image is None:
+        return image_ref, None
+    with span("store_thumbnail"):
+        preview = imaging.thumbnail(image, settings.THUMBNAIL_SIZE)
+        thumbnail_ref = blob_store.put(imaging.encode(preview, settings.IMAGE_FORMAT, settings.THUMBNAIL_QUALITY))
+    return image_ref, thumbnail_ref
+
+def get_face(image: np.ndarray, det_size: Optional[Tuple[int, int]] = None) -> Optional[Face]:
+    """The single face in an image as (normalized embedding, aligned crop); None unless exactly one face."""
+    if not inference_ready():
+        start_inference()
+    if inference_pool is not None:
+        return inference_pool.embed(image, det_size)
+    if scheduler is not None:
+        return scheduler.embed(image, det_size)
+    # Detection and recognition only, as in the batched paths
+    return embed_faces(face_analyzer, [image], [det_size])[0]
+
+def get_embedding(image: np.ndarray, det_size: Optional[Tuple[int, int]] = None) -> Optional[np.ndarray]:
+    """Get the normalized face embedding from a single image (None unless exactly one face)."""
+    face = get_face(image, det_size)
+    return None if face is None else face[0]
+
+def _stored_templates(user) -> Optional[np.ndarray]:
+    """A user's template matrix; users enrolled before templates existed have their centroid."""
+    if user is None:
+        return None
+    if user.templates is not None:
+        return user.templates
+    return templates.as_matrix(user.embedding)
+
+def _user_templates(user) -> Optional[np.ndarray]:
+    """
+    What verification scores against: the template matrix, or with 'centroid'
+    scoring the stored centroid of every enrollment image (a one-row matrix).
+    """
+    if user is not None and settings.TEMPLATE_SCORING == "centroid":
+        return templates.as_matrix(user.embedding)
+    return _stored_templates(user)
+
+def get_user_templates(database: Session, user_id: str) -> Optional[np.ndarray]:
+    """Template matrix of an active user, from the per-worker cache when possible."""
+    return embedding_cache.get_or_load(user_id, lambda: _user_templates(crud.get_user(database, user_id)))
 
 def calculate_centroid_embedding(embeddings: List[np.ndarray]) -> np.ndarray:
     """Calculate the average (centroid) of multiple embeddings."""
@@ -49,103 +176,503 @@ def cosine_similarity(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
     embedding2 = np.array(embedding2)
     return np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
 
-def enroll_user(database: Session, user_id: str, images: List[str], ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> bool:
-    """Enroll a user by processing multiple images and storing the centroid embedding."""
-    if crud.get_user(database, user_id):
+def _prepare_image(image: Union[str, bytes]) -> Tuple[bytes, Optional[np.ndarray]]:
+    """Validate and decode one uploaded image (runs on the inference executor)."""
+    with span("read_payload"):
+        img_bytes = read_image_payload(image)
+    with span("decode"):
+        return img_bytes, decode_image_bytes(img_bytes)
+
+def _read_upload(image: Union[str, bytes]) -> Tuple[Optional[bytes], Optional[np.ndarray], Optional[str]]:
+    """`_prepare_image` that reports a rejected payload instead of raising: (bytes, image, rejection reason)."""
+    try:
+        img_bytes, img = _prepare_image(image)
+    except ValueError as e:
+        return None, None, str(e)
+    return img_bytes, img, None if img is not None else "could not decode image"
+
+async def embed_face_async(image: np.ndarray, det_size: Optional[Tuple[int, int]] = None) -> Optional[Face]:
+    """`get_face` for async handlers; scheduler jobs are awaited without holding a thread."""
+    if not inference_ready():
+        await asyncio.to_thread(start_inference)
+    with span("embed"):
+        if scheduler is not None:
+            return await inference_executor.wait(scheduler.submit(image, det_size))
+        return await inference_executor.run(get_face, image, det_size)
+
+async def get_user_templates_async(database: AsyncSession, user_id: str) -> Optional[np.ndarray]:
+    """`get_user_templates` for async handlers."""
+    matrix, epoch = embedding_cache.lookup(user_id)
+    if matrix is not None:
+        return matrix
+    matrix = _user_templates(await database.run_sync(crud.get_user, user_id))
+    if matrix is not None:
+        embedding_cache.store(user_id, matrix, epoch)
+    return matrix
+
+async def refresh_user_templates(database: AsyncSession, user_id: str, stored: np.ndarray,
+                                 embedding: np.ndarray) -> bool:
+    """Add a confidently verified embedding to the user's templates, if it adds something new."""
+    if settings.TEMPLATE_SCORING == "centroid":
+        # `stored` is the cached centroid, not the templates
+        stored = _stored_templates(await database.run_sync(crud.get_user, user_id))
+        if stored is None:
+            return False
+    updated = templates.refresh(
+        stored, embedding, settings.TEMPLATE_MAX_SIZE, settings.TEMPLATE_REFRESH_MAX_REDUNDANCY
+    )
+    if updated is None:
+        return False
+    # Concurrent refreshes of one user race; the last write wins and the
+    # other embedding is simply offered again by a later verification.
+    if not await database.run_sync(crud.update_user_templates, user_id, updated):
+        return False
+    embedding_cache.invalidate(user_id, broadcast=False)
+    return True
+
+async def _audit(write, *args, **kwargs):
+    """Run an audit_writer call off the event loop (it can fall back to a blocking write)."""
+    with span("audit"):
+        await storage_executor.run(write, None, *args, **kwargs)
+
+async def find_duplicates(embedding: np.ndarray) -> List[Tuple[str, float]]:
+    """Enrolled users with the same face as a new centroid, per DUPLICATE_POLICY."""
+    if settings.DUPLICATE_POLICY == "off":
+        return []
+    if _gallery_stale():
+        with span("gallery_load"):
+            await asyncio.to_thread(_ensure_gallery_current)
+    with span("duplicate_search"):
+        return await inference_executor.run(duplicates.find_matches, embedding)
+
+async def enroll_user(database: AsyncSession, user_id: str, images: List[Union[str, bytes]], ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> List[Tuple[str, float]]:
+    """
+    Enroll a user by processing multiple images (base64 strings or raw bytes), storing their templates and centroid.
+    Returns the existing users found to have the same face (see `app.duplicates`).
+    """
+    if await database.run_sync(crud.get_user, user_id):
         raise ValueError("User ID already exists.")
 
-    embeddings = []
-    valid_images = []
-    
-    # Process each image and extract embeddings
-    for img_b64 in images:
-        img = decode_image(img_b64)
-        if img is None:
-            continue # Skip if image decoding failed
-        embedding = get_embedding(img)
-        if embedding is not None:
-            embeddings.append(embedding)
-            valid_images.append(img_b64)
-            # Store individual enrollment images
-            crud.store_user_image(database, user_id, img_b64, embedding, "enrollment")
-
-    if not embeddings:
+    # Images are decoded side by side, and their embeddings share inference
+    # batches. Rejected images are skipped, as in `enroll_users_batch`.
+    prepared = await asyncio.gather(*[inference_executor.run(_read_upload, image) for image in images])
+    decoded = [(img_bytes, img) for img_bytes, img, _ in prepared if img is not None]
+    faces = await asyncio.gather(*[embed_face_async(img) for _, img in decoded])
+
+    accepted = [(img_bytes, img, face) for (img_bytes, img), face in zip(decoded, faces) if face is not None]
+
+    if not accepted:
         # Log failed enrollment attempt
-        crud.log_access_attempt(
-            database, user_id, "enrollment", False, 
-            image_data=images[0] if images else None,
-            ip_address=ip_address, user_agent=user_agent
+        readable = [(img_bytes, img) for img_bytes, img, _ in prepared if img_bytes is not None]
+        image_ref, thumbnail_ref = await storage_executor.run(store_capture, *readable[0], None) if readable else (None, None)
+        await _audit(
+            audit_writer.log_access_attempt, user_id, "enrollment", False,
+            image_ref=image_ref, thumbnail_ref=thumbnail_ref, ip_address=ip_address, user_agent=user_agent
         )
-        raise ValueError("No valid faces found in the provided images.")
+        rejected = [f"image {index}: {reason.rstrip('.')}" for index, (_, _, reason) in enumerate(prepared) if reason]
+        detail = f" Rejected {'; '.join(rejected)}." if rejected else ""
+        raise ValueError(f"No valid faces found in the provided images.{detail}")
 
+    embeddings = [embedding for _, _, (embedding, _) in accepted]
     centroid_embedding = calculate_centroid_embedding(embeddings)
-    
-    # Create user with centroid embedding
-    crud.create_user(database, user_id, centroid_embedding)
+
+    matches = await find_duplicates(centroid_embedding)
+    if matches and settings.DUPLICATE_POLICY == "reject":
+        await _audit(
+            audit_writer.log_access_attempt, user_id, "enrollment", False,
+            ip_address=ip_address, user_agent=user_agent
+        )
+        duplicate_of, similarity = matches[0]
+        raise ValueError(f"This face is already enrolled as user '{duplicate_of}' (similarity {similarity:.2f}).")
+
+    template_matrix = templates.build(embeddings, settings.TEMPLATE_MAX_SIZE)
+    captures = await storage_executor.run(
+        lambda: [store_capture(img_bytes, img, crop) for img_bytes, img, (_, crop) in accepted]
+    )
+
+    # Create the user and store the individual enrollment images in one transaction
+    try:
+        await database.run_sync(
+            crud.bulk_enroll,
+            [{"id": user_id, "embedding": centroid_embedding, "templates": template_matrix}],
+            [
+                {
+                    "user_id": user_id, "image_ref": image_ref, "thumbnail_ref": thumbnail_ref,
+                    "embedding": embedding, "image_type": "enrollment"
+                }
+                for (image_ref, thumbnail_ref), embedding in zip(captures, embeddings)
+            ],
+            [],
+            duplicates.records(user_id, matches, duplicates.STATUSES.get(settings.DUPLICATE_POLICY), "enrollment")
+        )
+    except IntegrityError:
+        # A concurrent request enrolled the same ID first
+        raise ValueError("User ID already exists.")
+    # Broadcast, so other workers resync their galleries with the new user
+    embedding_cache.invalidate(user_id)
+    gallery.add(user_id, centroid_embedding)
     
     # Log successful enrollment
-    crud.log_access_attempt(
-        database, user_id, "enrollment", True,
+    await _audit(
+        audit_writer.log_access_attempt, user_id, "enrollment", True,
         ip_address=ip_address, user_agent=user_agent
     )
     
-    return True
+    return matches
 
-def verify_user(database: Session, user_id: str, image: str, ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> Tuple[bool, float]:
-    """Verify a user's face against their stored embedding."""
-    user = crud.get_user(database, user_id)
-    
-    live_img = decode_image(image)
-    if live_img is None:
-        # Log failed attempt due to image decoding error
-        if user:
-            crud.log_access_attempt(
-                database, user_id, "verification_failed", False,
-                image_data=image, ip_address=ip_address, user_agent=user_agent
-            )
-        else:
-            crud.log_unknown_access(
-                database, image, attempted_user_id=user_id,
-                ip_address=ip_address, user_agent=user_agent
-            )
-        raise ValueError("Could not decode the provided live image.")
-        
-    live_embedding = get_embedding(live_img)
-
-    if live_embedding is None:
-        # Log failed attempt due to no face detected
-        if user:
-            crud.log_access_attempt(
-                database, user_id, "verification_failed", False,
-                image_data=image, ip_address=ip_address, user_agent=user_agent
+def _process_enrollment_image(image: Union[str, bytes]) -> Tuple[Optional[dict], Optional[str]]:
+    """Decode, embed and store one enrollment image. Returns (image record, rejection reason)."""
+    try:
+        img_bytes = read_image_payload(image)
+    except ValueError as e:
+        return None, str(e) or "invalid base64 data"
+    img = decode_image_bytes(img_bytes)
+    if img is None:
+        return None, "could not decode image"
+    face = get_face(img)
+    if face is None:
+        return None, "no single face detected"
+    embedding, crop = face
+    image_ref, thumbnail_ref = store_capture(img_bytes, img, crop)
+    return {"image_ref": image_ref, "thumbnail_ref": thumbnail_ref, "embedding": embedding}, None
+
+def enroll_users_batch(database: Session, users: List[Tuple[str, List[Union[str, bytes]]]],
+                       ip_address: Optional[str] = None, user_agent: Optional[str] = None,
+                       chunk_size: Optional[int] = None, max_workers: Optional[int] = None) -> Iterator[dict]:
+    """
+    Enroll many users at once, yielding one report per user.
+
+    Images are decoded and embedded in parallel (OpenCV and ONNX Runtime
+    release the GIL, and concurrent embeddings share inference batches), and
+    each chunk of users is written with bulk inserts in a single transaction.
+    Users whose ID is already taken are reported as 'exists', which makes
+    re-running an interrupted import safe. Faces already enrolled, or
+    enrolled earlier in the same chunk, are handled by DUPLICATE_POLICY.
+    """
+    chunk_size = chunk_size or settings.ENROLL_BATCH_CHUNK_SIZE
+    max_workers = max_workers or settings.ENROLL_BATCH_WORKERS or os.cpu_count() or 1
+    check_duplicates = settings.DUPLICATE_POLICY != "off"
+    if check_duplicates:
+        sync_gallery(database)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            taken = crud.get_existing_user_ids(database, [user_id for user_id, _ in chunk])
+            reports = []
+            pending = []
+            for user_id, images in chunk:
+                report = {"user_id": user_id, "status": "exists", "accepted_images": 0, "rejected_images": []}
+                reports.append(report)
+                if user_id in taken:
+                    continue
+                taken.add(user_id)  # Later duplicates in the same batch are reported as existing
+                pending.append((report, [executor.submit(_process_enrollment_image, image) for image in images]))
+
+            new_users, new_images, new_logs, new_duplicates = [], [], [], []
+            # Centroids enrolled so far in this chunk, which the gallery does not hold yet
+            chunk_ids, chunk_centroids = [], []
+            for report, futures in pending:
+                user_id = report["user_id"]
+                embeddings, images = [], []
+                for index, future in enumerate(futures):
+                    record, reason = future.result()
+                    if reason:
+                        report["rejected_images"].append({"index": index, "reason": reason})
+                        continue
+                    embeddings.append(record["embedding"])
+                    images.append({"user_id": user_id, "image_type": "enrollment", **record})
+                report["accepted_images"] = len(embeddings)
+                success = bool(embeddings)
+                report["status"] = "enrolled" if success else "rejected"
+                if success:
+                    centroid = calculate_centroid_embedding(embeddings)
+                    matches = []
+                    if check_duplicates:
+                        matches = duplicates.find_matches(centroid)
+                        if chunk_centroids:
+                            scores = np.stack(chunk_centroids) @ normalize(centroid)
+                            matches += [(chunk_ids[i], float(scores[i])) for i in np.flatnonzero(scores >= settings.DUPLICATE_THRESHOLD)]
+                            matches = sorted(matches, key=lambda match: -match[1])[:settings.DUPLICATE_MAX_MATCHES]
+                        report["duplicates"] = [{"user_id": other, "similarity": round(score, 4)} for other, score in matches]
+                    if matches and settings.DUPLICATE_POLICY == "reject":
+                        report["status"] = "duplicate"
+                        success = False
+                    else:
+                        report["embedding"] = centroid
+                        new_users.append({
+                            "id": user_id, "embedding": centroid,
+                            "templates": templates.build(embeddings, settings.TEMPLATE_MAX_SIZE)
+                        })
+                        new_images.extend(images)
+                        new_duplicates.extend(duplicates.records(
+                            user_id, matches, duplicates.STATUSES.get(settings.DUPLICATE_POLICY), "enrollment"
+                        ))
+                        chunk_ids.append(user_id)
+                        chunk_centroids.append(normalize(centroid))
+                new_logs.append({
+                    "user_id": user_id, "access_type": "enrollment", "success": success,
+                    "ip_address": ip_address, "user_agent": user_agent
+                })
+
+            crud.bulk_enroll(database, new_users, new_images, new_logs, new_duplicates)
+            for report in reports:
+                embedding = report.pop("embedding", None)
+                if embedding is not None:
+                    embedding_cache.invalidate(report["user_id"])
+                    gallery.add(report["user_id"], embedding)
+                yield report
+
+async def verify_user(database: AsyncSession, user_id: str, image: Union[str, bytes], ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> Tuple[bool, float]:
+    """Verify a user's face (base64 string or raw bytes) against their stored templates."""
+    img_bytes, live_img, rejected = await inference_executor.run(_read_upload, image)
+    stored_templates = await get_user_templates_async(database, user_id)
+    face = await embed_face_async(live_img, VERIFY_DET_SIZE) if live_img is not None else None
+
+    # Stored once and shared by the image record and the access log
+    image_ref, thumbnail_ref = await storage_executor.run(
+        store_capture, img_bytes, live_img, None if face is None else face[1]
+    )
+
+    if face is None:
+        # Log failed attempt due to an image decoding error or no face detected
+        if stored_templates is not None:
+            await _audit(
+                audit_writer.log_access_attempt, user_id, "verification_failed", False,
+                image_ref=image_ref, thumbnail_ref=thumbnail_ref, ip_address=ip_address, user_agent=user_agent
             )
         else:
-            crud.log_unknown_access(
-                database, image, attempted_user_id=user_id,
-                ip_address=ip_address, user_agent=user_agent
+            await _audit(
+                audit_writer.log_unknown_access, image_ref, attempted_user_id=user_id,
+                ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
             )
+        if img_bytes is None:
+            raise ValueError(rejected)
+        if live_img is None:
+            raise ValueError("Could not decode the provided live image.")
         raise ValueError("No face detected in the live image.")
+    live_embedding = face[0]
 
-    if not user:
+    if stored_templates is None:
         # Log unknown access attempt
-        crud.log_unknown_access(
-            database, image, live_embedding, user_id,
-            ip_address=ip_address, user_agent=user_agent
+        await _audit(
+            audit_writer.log_unknown_access, image_ref, live_embedding, user_id,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
         )
         raise ValueError("User ID not found.")
 
-    stored_embedding = user.embedding
-    similarity = cosine_similarity(live_embedding, stored_embedding)
+    with span("score"):
+        similarity = templates.score(
+            stored_templates, normalize(live_embedding), settings.TEMPLATE_SCORING, settings.TEMPLATE_TOP_K
+        )
     is_match = similarity >= settings.SIMILARITY_THRESHOLD
+    if is_match and settings.TEMPLATE_REFRESH and similarity >= settings.TEMPLATE_REFRESH_MIN_SIMILARITY:
+        await refresh_user_templates(database, user_id, stored_templates, live_embedding)
 
     # Store verification image and log access attempt
-    crud.store_user_image(database, user_id, image, live_embedding, "verification")
+    await _audit(
+        audit_writer.store_user_image, user_id, image_ref, live_embedding, "verification", thumbnail_ref=thumbnail_ref
+    )
     
     access_type = "verification_success" if is_match else "verification_failed"
-    crud.log_access_attempt(
-        database, user_id, access_type, is_match,
-        image_data=image, embedding=live_embedding, similarity_score=float(similarity),
-        ip_address=ip_address, user_agent=user_agent
+    await _audit(
+        audit_writer.log_access_attempt, user_id, access_type, is_match,
+        image_ref=image_ref, embedding=live_embedding, similarity_score=float(similarity),
+        ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+    )
+
+    return is_match, float(similarity)
+
+def sync_gallery(database: Session):
+    """
+    Load the gallery on first use, and resync it once another worker has
+    enrolled, imported, deactivated or purged a user (the embedding cache's
+    shared counter moved).
+    """
+    # Read the counter first, so a change made during the sync is seen next time
+    gallery.ensure_current(database, embedding_cache.generation())
+
+def _gallery_stale() -> bool:
+    return not gallery.loaded or gallery.generation != embedding_cache.generation()
+
+def _ensure_gallery_current():
+    from .db.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        sync_gallery(db)
+    finally:
+        db.close()
+
+async def _identification_face(image: Union[str, bytes]) -> Tuple[Optional[bytes], Optional[np.ndarray], Optional[Face], Optional[str]]:
+    """Decode and embed a frame for 1:N search, loading the gallery on first use; also returns the rejection reason."""
+    img_bytes, live_img, rejected = await inference_executor.run(_read_upload, image)
+    if _gallery_stale():
+        with span("gallery_load"):
+            await asyncio.to_thread(_ensure_gallery_current)
+    face = await embed_face_async(live_img) if live_img is not None else None
+    return img_bytes, live_img, face, rejected
+
+async def identify_user(image: Union[str, bytes], top_k: int = 5, ip_address: Optional[str] = None, user_agent: Optional[str] = None) -> Tuple[Optional[str], float, List[Tuple[str, float]]]:
+    """Find who is in the image by searching every enrolled user (1:N)."""
+    img_bytes, live_img, face, rejected = await _identification_face(image)
+    image_ref, thumbnail_ref = await storage_executor.run(
+        store_capture, img_bytes, live_img, None if face is None else face[1]
     )
 
-    return is_match, float(similarity)
\ No newline at end of file
+    if face is None:
+        await _audit(
+            audit_writer.log_unknown_access, image_ref,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+        )
+        if img_bytes is None:
+            raise ValueError(rejected)
+        if live_img is None:
+            raise ValueError("Could not decode the provided live image.")
+        raise ValueError("No face detected in the live image.")
+    live_embedding = face[0]
+
+    with span("gallery_search"):
+        candidates = await inference_executor.run(gallery.search, live_embedding, top_k=max(top_k, 1))
+    if not candidates or candidates[0][1] < settings.SIMILARITY_THRESHOLD:
+        # Nobody is close enough: record it like any other unknown face
+        await _audit(
+            audit_writer.log_unknown_access, image_ref, live_embedding,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+        )
+        best_score = candidates[0][1] if candidates else 0.0
+        return None, best_score, candidates
+
+    user_id, similarity = candidates[0]
+    await _audit(
+        audit_writer.log_access_attempt, user_id, "identification_success", True,
+        image_ref=image_ref, embedding=live_embedding, similarity_score=similarity,
+        ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+    )
+    return user_id, similarity, candidates
+
+async def embed_identification(image: Union[str, bytes]) -> Tuple[np.ndarray, bytes]:
+    """
+    Embed a frame once for a sharded identification: the shard router sends
+    the embedding to every shard's `search_gallery`, and the embedding and
+    encoded crop to the shard that records the outcome.
+    """
+    _, live_img = await inference_executor.run(_prepare_image, image)
+    face = await embed_face_async(live_img) if live_img is not None else None
+    if face is None:
+        if live_img is None:
+            raise ValueError("Could not decode the provided live image.")
+        raise ValueError("No face detected in the live image.")
+    crop = await inference_executor.run(imaging.encode, face[1], settings.IMAGE_FORMAT, settings.IMAGE_QUALITY)
+    return face[0], crop
+
+async def search_gallery(embedding: np.ndarray, top_k: int = 5) -> List[Tuple[str, float]]:
+    """This shard's best matches for an embedding, without storing or logging anything."""
+    if _gallery_stale():
+        with span("gallery_load"):
+            await asyncio.to_thread(_ensure_gallery_current)
+    with span("gallery_search"):
+        return await inference_executor.run(gallery.search, embedding, top_k=max(top_k, 1))
+
+async def record_identification(image: Union[str, bytes], user_id: Optional[str], similarity: Optional[float],
+                                embedding: Optional[np.ndarray] = None, crop: Optional[bytes] = None,
+                                ip_address: Optional[str] = None, user_agent: Optional[str] = None):
+    """
+    Store the capture and log a sharded identification: a success for
+    `user_id`, or an unknown face. The embedding and encoded crop come from
+    `embed_identification` on another shard, so nothing is embedded again.
+    """
+    img_bytes, live_img = await inference_executor.run(_prepare_image, image)
+    image_ref, thumbnail_ref = await storage_executor.run(store_capture, img_bytes, live_img, None)
+    if crop is not None and settings.IMAGE_STORAGE == "crop":
+        image_ref = await storage_executor.run(blob_store.put, crop)
+    if user_id is None:
+        await _audit(
+            audit_writer.log_unknown_access, image_ref, embedding,
+            ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+        )
+        return
+    await _audit(
+        audit_writer.log_access_attempt, user_id, "identification_success", True,
+        image_ref=image_ref, embedding=embedding, similarity_score=similarity,
+        ip_address=ip_address, user_agent=user_agent, thumbnail_ref=thumbnail_ref
+    )
+
+def export_user(database: Session, user_id: str) -> Optional[dict]:
+    """An active user with their images and the image blobs (base64), for moving them to another shard."""
+    user = crud.get_user(database, user_id)
+    if not user:
+        return None
+    images = crud.get_user_images(database, user_id)
+    refs = {ref for image in images for ref in (image.image_ref, image.thumbnail_ref) if ref}
+    return {
+        "id": user.id,
+        "embedding": user.embedding.tolist(),
+        "templates": None if user.templates is None else user.templates.tolist(),
+        "created_at": user.created_at,
+        "updated_at": user.updated_at,
+        "images": [
+            {
+                "image_type": image.image_type, "image_ref": image.image_ref, "image_data": image.image_data,
+                "thumbnail_ref": image.thumbnail_ref, "created_at": image.created_at,
+                "embedding": None if image.embedding is None else image.embedding.tolist(),
+            }
+            for image in images
+        ],
+        "blobs": {
+            ref: base64.b64encode(blob_store.get(ref)).decode("ascii")
+            for ref in sorted(refs) if blob_store.exists(ref)
+        },
+    }
+
+def import_user(database: Session, transfer: dict):
+    """Recreate a user exported by another shard."""
+    user_id = transfer["id"]
+    if crud.get_existing_user_ids(database, [user_id]):
+        raise ValueError("User ID already exists.")
+    # Blobs are content-addressed, so they keep their references
+    for data in transfer["blobs"].values():
+        blob_store.put(base64.b64decode(data))
+    embedding = np.asarray(transfer["embedding"], dtype=np.float32)
+    template_matrix = transfer["templates"]
+    try:
+        crud.bulk_enroll(
+            database,
+            [{
+                "id": user_id, "embedding": embedding,
+                "templates": None if template_matrix is None else np.asarray(template_matrix, dtype=np.float32),
+                "created_at": transfer["created_at"],
+                # Stamped now, so other workers' gallery resyncs pick the user up
+                "updated_at": datetime.utcnow(),
+            }],
+            [
+                {
+                    "user_id": user_id, "image_ref": image["image_ref"], "image_data": image["image_data"],
+                    "thumbnail_ref": image["thumbnail_ref"], "image_type": image["image_type"],
+                    "created_at": image["created_at"],
+                    "embedding": None if image["embedding"] is None else np.asarray(image["embedding"], dtype=np.float32),
+                }
+                for image in transfer["images"]
+            ],
+            []
+        )
+    except IntegrityError:
+        raise ValueError("User ID already exists.")
+    embedding_cache.invalidate(user_id)
+    gallery.add(user_id, embedding)
+
+def purge_user(database: Session, user_id: str) -> bool:
+    """Delete a user that was moved to another shard and drop them from the caches."""
+    if not crud.purge_user(database, user_id):
+        return False
+    embedding_cache.invalidate(user_id)
+    gallery.remove(user_id)
+    return True
+
+def deactivate_user(database: Session, user_id: str):
+    """Deactivate a user and drop them from the identification gallery."""
+    user = crud.deactivate_user(database, user_id)
+    if user:
+        embedding_cache.invalidate(user_id)
+        gallery.remove(user_id)
+    return user
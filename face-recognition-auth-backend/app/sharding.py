@@ -0,0 +1,839 @@
+"""
+Sharded deployment: users partitioned across backend shards by a
+consistent hash of their user_id.
+
+Each shard is an ordinary instance of the app (`app.main:app`) with its own
+database and blob store, and so its own identification gallery. The router
+in this module is a small FastAPI app with no model or database:
+
+- /api/enroll, /api/verify (and their /upload variants) and the per-user
+  routes (/api/users/{user_id}/..., `?user_id=` filters) go to the shard
+  that owns the user;
+- /api/enroll/batch is split by owner and the per-user reports merged;
+- /api/identify has one shard embed the face, searches every shard's
+  gallery with that embedding, merges the candidates and records the
+  outcome once: on the matched user's shard or, for an unknown face, on the
+  shard of its nearest candidate, so that one intruder's attempts end up in
+  the same unknown-face clusters;
+- /api/users, /api/access-logs, /api/unknown-access(/clusters),
+  /api/duplicates and /api/stats/system(/timeseries) are fanned out to
+  every shard and merged. Listed items gain a `shard` field, and
+  /api/shards/{name}/... reaches one shard directly, e.g. for the images
+  of an access log, whose IDs are per shard (admin only).
+
+The router calls the shards' /api/shard endpoints with SHARD_TOKEN, which
+every shard must share. Changing the ring and the passthrough to one shard
+need SHARD_ADMIN_TOKEN in an X-Admin-Token header.
+
+GET /api/shards lists the ring, and /api/shards/owner/{user_id} names the
+shard of a user for clients that connect to it directly, such as the
+/api/verify/stream WebSocket, which the router does not proxy.
+
+Adding a shard (`POST /api/shards` with `{"name": ..., "url": ...}`) or
+removing one (`DELETE /api/shards/{name}`) changes the owner of about 1/N
+of the users. They are moved in the background: exported with their images
+from the old owner, imported on the new one, then deleted from the old one
+(their access logs stay behind as history). Until a user has moved, the
+router keeps sending their requests to the previous owner. The ring is kept
+in memory; restart the router with the SHARDS printed on /api/shards.
+Duplicate detection at enrollment only sees the owning shard's gallery.
+
+Usage:
+    python -m app.sharding local --shards 3 [--port 8000] [--dir shards]
+    python -m app.sharding serve --shards a=http://10.0.0.1:8000,b=http://10.0.0.2:8000 [--port 8000]
+    python -m app.sharding shard --name shard3 --port 8004 [--dir shards]
+    python -m app.sharding rebalance --from a=URL,b=URL --to a=URL,b=URL,c=URL
+
+`local` runs the router plus N shard processes on consecutive ports, each
+with a SQLite database and blob store under `--dir/<name>`, and generates
+SHARD_TOKEN and SHARD_ADMIN_TOKEN if they are not set; `shard` starts one
+more such shard, to add with POST /api/shards. `rebalance` moves users
+between two rings while the router is stopped.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import heapq
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+
+from . import schemas
+from .core.config import settings
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Response headers passed back from shards
+FORWARDED_HEADERS = ("content-type", "content-disposition", "etag", "cache-control", "retry-after", "x-next-cursor")
+
+# Reserved for /api/shards/owner/{user_id}
+RESERVED_NAMES = ("owner", "rebalance")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def parse_shards(spec: str) -> Dict[str, str]:
+    """'name=url,...' (bare URLs are named shard0, shard1, ...) as {name: url}."""
+    shards = {}
+    for index, part in enumerate(part.strip() for part in spec.split(",")):
+        if not part:
+            continue
+        name, separator, url = part.partition("=")
+        if not separator:
+            name, url = f"shard{index}", part
+        name, url = name.strip(), url.strip().rstrip("/")
+        if name in shards:
+            raise ValueError(f"Shard '{name}' is listed twice")
+        if name in RESERVED_NAMES:
+            raise ValueError(f"'{name}' cannot be used as a shard name")
+        shards[name] = url
+    return shards
+
+
+def format_shards(shards: Dict[str, str]) -> str:
+    return ",".join(f"{name}={url}" for name, url in shards.items())
+
+
+def shard_headers() -> Dict[str, str]:
+    """Header authenticating the router to the shards' /api/shard endpoints."""
+    return {"X-Shard-Token": settings.SHARD_TOKEN}
+
+
+class HashRing:
+    """
+    Consistent hash ring with `virtual_nodes` points per shard, so adding or
+    removing a shard only moves the keys of its neighbouring points.
+    """
+
+    def __init__(self, shards: Dict[str, str], virtual_nodes: int = 128):
+        self.shards = dict(shards)
+        self.virtual_nodes = virtual_nodes
+        points = sorted((_hash(f"{name}#{index}"), name) for name in self.shards for index in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key: str) -> str:
+        """Name of the shard owning the key."""
+        if not self._points:
+            raise LookupError("No shards configured")
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._names[index]
+
+    def url(self, key: str) -> str:
+        return self.shards[self.owner(key)]
+
+
+async def _move_user(client: httpx.AsyncClient, user_id: str, source: str, target: str) -> bool:
+    """Copy one user to the target shard, then delete them from the source; False if they are gone."""
+    path = f"/api/shard/users/{quote(user_id, safe='')}"
+    exported = await client.get(source + path, headers=shard_headers())
+    if exported.status_code == 404:
+        return False  # Deactivated in the meantime
+    exported.raise_for_status()
+    imported = await client.post(target + "/api/shard/users", json=exported.json(), headers=shard_headers())
+    if imported.status_code == 400:
+        # Already copied by an interrupted run, unless the ID is taken by an inactive user there
+        copied = await client.get(f"{target}/api/users/{quote(user_id, safe='')}")
+        if copied.status_code != 200:
+            raise RuntimeError(f"{user_id}: {imported.json().get('detail')}")
+    else:
+        imported.raise_for_status()
+    purged = await client.delete(source + path, headers=shard_headers())
+    if purged.status_code != 404:
+        purged.raise_for_status()
+    return True
+
+
+async def rebalance(client: httpx.AsyncClient, old: HashRing, new: HashRing, progress: Optional[dict] = None,
+                    concurrency: int = 8, page_size: int = 500) -> dict:
+    """
+    Move every user whose owner differs between two rings. Users are listed
+    page by page from each shard of the old ring and moved `concurrency` at
+    a time. Returns (and keeps updating) the progress counters.
+    """
+    progress = progress if progress is not None else {}
+    progress.update({"scanned": 0, "moved": 0, "failed": 0, "errors": []})
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def move(user_id: str, source: str, target: str):
+        async with semaphore:
+            try:
+                if await _move_user(client, user_id, source, target):
+                    progress["moved"] += 1
+            except (httpx.HTTPError, RuntimeError, ValueError) as e:
+                progress["failed"] += 1
+                progress["errors"] = (progress["errors"] + [f"{user_id}: {e}"])[-10:]
+
+    for name, url in old.shards.items():
+        after = None
+        while True:
+            params = {"limit": page_size} if after is None else {"limit": page_size, "after": after}
+            listed = await client.get(url + "/api/shard/users", params=params, headers=shard_headers())
+            listed.raise_for_status()
+            user_ids = listed.json()
+            if not user_ids:
+                break
+            # Moved users disappear behind the keyset cursor, so no page is skipped
+            after = user_ids[-1]
+            moves = [(user_id, new.owner(user_id)) for user_id in user_ids]
+            await asyncio.gather(*[
+                move(user_id, url, new.shards[owner]) for user_id, owner in moves if owner != name
+            ])
+            progress["scanned"] += len(user_ids)
+    return progress
+
+
+class ShardRouter:
+    """The ring, the HTTP client to the shards, and any rebalance in progress."""
+
+    def __init__(self, ring: HashRing):
+        self.ring = ring
+        # Ring before the last change, while users still move off it
+        self.previous: Optional[HashRing] = None
+        self.client: Optional[httpx.AsyncClient] = None
+        self.rebalancing: Optional[asyncio.Task] = None
+        self.progress: dict = {}
+
+    def members(self) -> Dict[str, str]:
+        """Every shard that may hold users: the current ring, plus shards being drained."""
+        members = dict(self.previous.shards) if self.previous is not None else {}
+        members.update(self.ring.shards)
+        return members
+
+    async def _has_user(self, url: str, user_id: str) -> bool:
+        response = await self.client.get(f"{url}/api/users/{quote(user_id, safe='')}")
+        return response.status_code == 200
+
+    async def locate(self, user_id: str) -> Tuple[str, str]:
+        """(name, url) of the shard holding an existing user."""
+        name = self.ring.owner(user_id)
+        if self.previous is not None:
+            old = self.previous.owner(user_id)
+            if old != name and not await self._has_user(self.ring.shards[name], user_id):
+                return old, self.previous.shards[old]  # Not moved yet
+        return name, self.ring.shards[name]
+
+    async def enrollment_target(self, user_id: str) -> Optional[str]:
+        """URL of the shard a new user is enrolled on, or None if the ID is still taken on its previous shard."""
+        name = self.ring.owner(user_id)
+        if self.previous is not None:
+            old = self.previous.owner(user_id)
+            if old != name and await self._has_user(self.previous.shards[old], user_id):
+                return None
+        return self.ring.shards[name]
+
+    async def send(self, request: Request, url: str, path: Optional[str] = None, internal: bool = False,
+                   **kwargs) -> httpx.Response:
+        """
+        Send a request on to a shard, with the client's address and User-Agent;
+        `internal` requests to the /api/shard endpoints also carry SHARD_TOKEN.
+        """
+        headers = {
+            "X-Forwarded-For": request.headers.get(
+                "X-Forwarded-For", request.headers.get("X-Real-IP", request.client.host if request.client else "")
+            ),
+        }
+        for name in ("content-type", "user-agent", "accept", "if-none-match"):
+            if name in request.headers and not (name == "content-type" and "json" in kwargs):
+                headers[name] = request.headers[name]
+        if internal:
+            headers.update(shard_headers())
+        if "json" not in kwargs and "content" not in kwargs and request.method in ("POST", "PUT", "PATCH"):
+            kwargs["content"] = await request.body()
+        kwargs.setdefault("params", request.query_params)
+        try:
+            return await self.client.request(request.method, url + (path or request.url.path), headers=headers, **kwargs)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Shard {url} is unavailable: {e}")
+
+    async def forward(self, request: Request, url: str, path: Optional[str] = None, **kwargs) -> Response:
+        """`send`, returning the shard's response as is."""
+        upstream = await self.send(request, url, path, **kwargs)
+        headers = {name: upstream.headers[name] for name in FORWARDED_HEADERS if name in upstream.headers}
+        return Response(upstream.content, status_code=upstream.status_code, headers=headers)
+
+    async def fan_out(self, request: Request, path: Optional[str] = None, **kwargs) -> Dict[str, httpx.Response]:
+        """Send a request to every shard; any failure is raised as that shard's error."""
+        members = self.members()
+        responses = await asyncio.gather(
+            *[self.send(request, url, path, **kwargs) for url in members.values()], return_exceptions=True
+        )
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        for name, response in zip(members, responses):
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=_detail(response, name))
+        return dict(zip(members, responses))
+
+    async def start_rebalance(self, old: HashRing):
+        """Move users from the old ring in the background; the fallback to it ends once all have moved."""
+        self.previous = old
+        self.progress = {"started_at": time.time()}
+        self.rebalancing = asyncio.create_task(self._rebalance(old))
+
+    async def _rebalance(self, old: HashRing):
+        try:
+            await rebalance(self.client, old, self.ring, self.progress, settings.SHARD_REBALANCE_CONCURRENCY)
+            if not self.progress["failed"]:
+                self.previous = None
+        except (httpx.HTTPError, LookupError) as e:
+            self.progress["errors"] = self.progress.get("errors", []) + [str(e)]
+        finally:
+            self.progress["finished_at"] = time.time()
+            logger.info("Rebalance finished: %s", self.progress)
+
+
+def _detail(response: httpx.Response, shard: str) -> str:
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        detail = response.text
+    return f"Shard '{shard}': {detail}"
+
+
+shard_router = ShardRouter(HashRing(parse_shards(settings.SHARDS), settings.SHARD_VIRTUAL_NODES))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    shard_router.client = httpx.AsyncClient(
+        timeout=settings.SHARD_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+    )
+    yield
+    if shard_router.rebalancing is not None:
+        shard_router.rebalancing.cancel()
+    await shard_router.client.aclose()
+
+app = FastAPI(
+    title="Face Recognition Shard Router",
+    description="Routes users to the shard owning them by a consistent hash of their user_id.",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+allowed = settings.ALLOWED_ORIGINS or "*"
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"] if allowed.strip() == "*" else [o.strip() for o in allowed.split(",") if o.strip()],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+def _tagged(responses: Dict[str, httpx.Response]) -> List[dict]:
+    """List items of every shard, each with the shard it came from."""
+    return [{**item, "shard": name} for name, response in responses.items() for item in response.json()]
+
+
+def _page(request: Request, default_limit: int) -> Tuple[int, int, dict]:
+    """skip/limit of a merged listing, and the shard parameters: the first skip + limit items of each."""
+    try:
+        skip = int(request.query_params.get("skip", 0))
+        limit = int(request.query_params.get("limit", default_limit))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="skip and limit must be integers")
+    if skip < 0 or limit < 0:
+        raise HTTPException(status_code=400, detail="skip and limit must not be negative")
+    params = {**request.query_params, "skip": 0, "limit": skip + limit}
+    return skip, limit, params
+
+
+@app.get("/", tags=["Root"])
+def read_root():
+    return {"message": "Welcome to the Face Recognition API (shard router)"}
+
+
+# Routed by user
+
+@app.post("/api/enroll")
+async def enroll(payload: schemas.EnrollRequest, request: Request):
+    """Enroll on the shard owning the user."""
+    url = await shard_router.enrollment_target(payload.user_id)
+    if url is None:
+        raise HTTPException(status_code=400, detail="User ID already exists.")
+    return await shard_router.forward(request, url, json=payload.model_dump())
+
+
+async def _upload_user_id(request: Request) -> str:
+    user_id = request.query_params.get("user_id")
+    if not user_id and request.headers.get("Content-Type", "").startswith("multipart/form-data"):
+        await request.body()  # Keep the raw body to forward after parsing the form
+        value = (await request.form()).get("user_id")
+        user_id = value if isinstance(value, str) else None
+    if not user_id:
+        raise HTTPException(status_code=400, detail="'user_id' is required")
+    return user_id
+
+
+@app.post("/api/enroll/upload")
+async def enroll_upload(request: Request):
+    """Enroll uploaded images on the shard owning the user."""
+    user_id = await _upload_user_id(request)
+    url = await shard_router.enrollment_target(user_id)
+    if url is None:
+        raise HTTPException(status_code=400, detail="User ID already exists.")
+    return await shard_router.forward(request, url, content=await request.body())
+
+
+@app.post("/api/enroll/batch")
+async def enroll_batch(payload: schemas.BatchEnrollRequest, request: Request):
+    """Split a bulk enrollment by owning shard and merge the per-user reports in request order."""
+    results: List[Optional[dict]] = [None] * len(payload.users)
+    groups: Dict[str, List[int]] = {}
+    for index, user in enumerate(payload.users):
+        url = await shard_router.enrollment_target(user.user_id)
+        if url is None:
+            results[index] = {"user_id": user.user_id, "status": "exists", "accepted_images": 0, "rejected_images": []}
+        else:
+            groups.setdefault(url, []).append(index)
+
+    async def enroll_group(url: str, indexes: List[int]):
+        response = await shard_router.send(
+            request, url, json={"users": [payload.users[index].model_dump() for index in indexes]}
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=_detail(response, url))
+        for index, result in zip(indexes, response.json()["results"]):
+            results[index] = result
+
+    outcomes = await asyncio.gather(
+        *[enroll_group(url, indexes) for url, indexes in groups.items()], return_exceptions=True
+    )
+    # Users of a failed shard are reported as errors; the other shards' enrollments stand
+    for (url, indexes), outcome in zip(groups.items(), outcomes):
+        if isinstance(outcome, BaseException):
+            detail = outcome.detail if isinstance(outcome, HTTPException) else str(outcome)
+            for index in indexes:
+                results[index] = {
+                    "user_id": payload.users[index].user_id, "status": "error", "accepted_images": 0,
+                    "rejected_images": [], "detail": detail,
+                }
+    return {"ok": True, "enrolled": sum(1 for result in results if result["status"] == "enrolled"), "results": results}
+
+
+@app.post("/api/verify")
+async def verify(payload: schemas.VerifyRequest, request: Request):
+    """Verify on the shard holding the user."""
+    _, url = await shard_router.locate(payload.user_id)
+    return await shard_router.forward(request, url, json=payload.model_dump())
+
+
+@app.post("/api/verify/upload")
+async def verify_upload(request: Request):
+    """Verify an uploaded image on the shard holding the user."""
+    _, url = await shard_router.locate(await _upload_user_id(request))
+    return await shard_router.forward(request, url, content=await request.body())
+
+
+@app.api_route("/api/users/{user_id}", methods=["GET", "DELETE"])
+async def user(user_id: str, request: Request):
+    """User details and deactivation, on the shard holding the user."""
+    _, url = await shard_router.locate(user_id)
+    return await shard_router.forward(request, url)
+
+
+@app.get("/api/users/{user_id}/{rest:path}")
+async def user_details(user_id: str, rest: str, request: Request):
+    """User images and stats, on the shard holding the user."""
+    _, url = await shard_router.locate(user_id)
+    return await shard_router.forward(request, url)
+
+
+# Fanned out to every shard
+
+@app.post("/api/identify")
+async def identify(payload: schemas.IdentifyRequest, request: Request):
+    """
+    Have one shard embed the face, search every shard with the embedding,
+    then record the outcome on one shard: the matched user's, or the nearest
+    candidate's for an unknown face.
+    """
+    # Spread the embedding work, and keep repeats of one frame on one shard
+    embed_on = shard_router.ring.url(hashlib.sha256(payload.image.encode("utf-8")).hexdigest())
+    embedded = await shard_router.send(
+        request, embed_on, "/api/shard/embed", internal=True, json={"image": payload.image}, params={}
+    )
+    if embedded.status_code == 400:
+        # No usable face: logged as an unknown attempt, like on a single instance
+        await _record(request, embed_on, payload.image, None, None, None)
+        raise HTTPException(status_code=400, detail=embedded.json().get("detail"))
+    if embedded.status_code != 200:
+        raise HTTPException(status_code=embedded.status_code, detail=_detail(embedded, embed_on))
+    face = embedded.json()
+
+    responses = await shard_router.fan_out(
+        request, "/api/shard/search", internal=True,
+        json={"embedding": face["embedding"], "top_k": payload.top_k}, params={}
+    )
+    results = {name: response.json() for name, response in responses.items()}
+    members = shard_router.members()
+    scored = [(result["similarity"], name) for name, result in results.items() if result["candidates"]]
+    candidates = heapq.nlargest(
+        max(payload.top_k, 1),
+        ((candidate, name) for name, result in results.items() for candidate in result["candidates"]),
+        key=lambda item: item[0]["similarity"],
+    )
+    if not scored:
+        await _record(request, embed_on, payload.image, None, None, face)
+        return {"ok": True, "match": False, "user_id": None, "similarity": 0.0, "candidates": []}
+
+    similarity, best = max(scored)
+    match = results[best]["match"]
+    user_id = results[best]["user_id"] if match else None
+    await _record(request, members[best], payload.image, user_id, similarity if match else None, face)
+    return {
+        "ok": True,
+        "match": match,
+        "user_id": user_id,
+        "similarity": similarity,
+        "candidates": [candidate for candidate, _ in candidates],
+    }
+
+
+async def _record(request: Request, url: str, image: str, user_id: Optional[str], similarity: Optional[float],
+                  face: Optional[dict]):
+    """Record an identification on one shard, with the face embedded for it; the answer is returned even if this fails."""
+    try:
+        response = await shard_router.send(
+            request, url, "/api/shard/identify/record", internal=True, params={},
+            json={"image": image, "user_id": user_id, "similarity": similarity, **(face or {})},
+        )
+        if response.status_code != 200:
+            logger.warning("Could not record identification on %s: %s %s", url, response.status_code, response.text)
+    except HTTPException as e:
+        logger.warning("Could not record identification on %s: %s", url, e.detail)
+
+
+@app.get("/api/users")
+async def list_users(request: Request):
+    """Active users of every shard, oldest first."""
+    skip, limit, params = _page(request, 100)
+    items = _tagged(await shard_router.fan_out(request, params=params))
+    items.sort(key=lambda item: (item["created_at"], item["id"]))
+    return items[skip:skip + limit]
+
+
+@app.get("/api/access-logs")
+async def access_logs(request: Request):
+    """Access logs of one user (on their shard) or of every shard, newest first."""
+    user_id = request.query_params.get("user_id")
+    if user_id:
+        _, url = await shard_router.locate(user_id)
+        return await shard_router.forward(request, url)
+    return await _newest_first(request)
+
+
+@app.get("/api/unknown-access")
+async def unknown_access(request: Request):
+    """Unknown access attempts of every shard, newest first."""
+    return await _newest_first(request)
+
+
+@app.get("/api/duplicates")
+async def duplicates(request: Request):
+    """Duplicate identities of one user (on their shard) or of every shard, newest first."""
+    user_id = request.query_params.get("user_id")
+    if user_id:
+        _, url = await shard_router.locate(user_id)
+        return await shard_router.forward(request, url)
+    return await _newest_first(request)
+
+
+async def _newest_first(request: Request):
+    if "cursor" in request.query_params:
+        raise HTTPException(
+            status_code=400,
+            detail="Cursors are per shard: page through /api/shards/{name}/... instead, or use skip and limit"
+        )
+    skip, limit, params = _page(request, 100)
+    items = _tagged(await shard_router.fan_out(request, params=params))
+    items.sort(key=lambda item: (item["created_at"], item["id"]), reverse=True)
+    return items[skip:skip + limit]
+
+
+@app.get("/api/unknown-access/clusters")
+async def unknown_clusters(request: Request):
+    """Unknown-face clusters of every shard, most attempts first."""
+    skip, limit, params = _page(request, 50)
+    items = _tagged(await shard_router.fan_out(request, params=params))
+    items.sort(key=lambda item: (-item["attempts"], item["shard"], item["id"]))
+    return items[skip:skip + limit]
+
+
+@app.get("/api/stats/system")
+async def system_stats(request: Request):
+    """Counters summed over every shard."""
+    totals = {"total_users": 0, "total_access_attempts": 0, "successful_attempts": 0, "unknown_attempts": 0}
+    for response in (await shard_router.fan_out(request)).values():
+        stats = response.json()
+        for key in totals:
+            totals[key] += stats[key]
+    attempts, successful = totals["total_access_attempts"], totals["successful_attempts"]
+    return {
+        **totals,
+        "failed_attempts": attempts - successful,
+        "success_rate": (successful / attempts * 100) if attempts > 0 else 0,
+    }
+
+
+@app.get("/api/stats/system/timeseries")
+async def system_stats_timeseries(request: Request):
+    """Per-bucket counters of one user (on their shard) or summed over every shard."""
+    user_id = request.query_params.get("user_id")
+    if user_id:
+        _, url = await shard_router.locate(user_id)
+        return await shard_router.forward(request, url)
+    buckets: Dict[Tuple[str, str], dict] = {}
+    for response in (await shard_router.fan_out(request)).values():
+        for bucket in response.json():
+            key = (bucket["bucket_start"], bucket["granularity"])
+            merged = buckets.setdefault(key, {**bucket, "total_attempts": 0, "successful_attempts": 0,
+                                              "unknown_attempts": 0, "enrolled_users": 0})
+            for field in ("total_attempts", "successful_attempts", "unknown_attempts", "enrolled_users"):
+                merged[field] += bucket[field]
+    return [buckets[key] for key in sorted(buckets)]
+
+
+# The ring
+
+async def _health(url: str) -> str:
+    try:
+        response = await shard_router.client.get(url + "/", timeout=2)
+        return "up" if response.status_code == 200 else f"status {response.status_code}"
+    except httpx.HTTPError:
+        return "down"
+
+
+@app.get("/api/shards")
+async def list_shards():
+    """Shards of the ring with their health, and the progress of the last rebalance."""
+    members = shard_router.members()
+    health = await asyncio.gather(*[_health(url) for url in members.values()])
+    return {
+        "shards": [
+            {"name": name, "url": url, "status": status, "in_ring": name in shard_router.ring.shards}
+            for (name, url), status in zip(members.items(), health)
+        ],
+        "virtual_nodes": shard_router.ring.virtual_nodes,
+        "SHARDS": format_shards(shard_router.ring.shards),
+        "rebalancing": shard_router.rebalancing is not None and not shard_router.rebalancing.done(),
+        "rebalance": shard_router.progress,
+    }
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Ring changes and the passthrough to one shard need SHARD_ADMIN_TOKEN."""
+    if not settings.SHARD_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Disabled: SHARD_ADMIN_TOKEN is not set")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode(), settings.SHARD_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def _check_idle():
+    if shard_router.rebalancing is not None and not shard_router.rebalancing.done():
+        raise HTTPException(status_code=409, detail="A rebalance is in progress")
+
+
+@app.post("/api/shards", dependencies=[Depends(require_admin)])
+async def add_shard(shard: schemas.ShardSpec):
+    """Add a shard to the ring and move the users it now owns to it."""
+    _check_idle()
+    name, url = shard.name.strip(), shard.url.strip().rstrip("/")
+    if not name or not url:
+        raise HTTPException(status_code=400, detail="'name' and 'url' are required")
+    if name in shard_router.members() or name in RESERVED_NAMES:
+        raise HTTPException(status_code=400, detail=f"Shard '{name}' already exists")
+    if await _health(url) != "up":
+        raise HTTPException(status_code=400, detail=f"Shard {url} is not reachable")
+    old = shard_router.ring
+    shard_router.ring = HashRing({**old.shards, name: url}, old.virtual_nodes)
+    await shard_router.start_rebalance(old)
+    return {"ok": True, "SHARDS": format_shards(shard_router.ring.shards)}
+
+
+@app.delete("/api/shards/{name}", dependencies=[Depends(require_admin)])
+async def remove_shard(name: str):
+    """Take a shard out of the ring, moving its users to the others."""
+    _check_idle()
+    old = shard_router.ring
+    if name not in old.shards:
+        raise HTTPException(status_code=404, detail="Shard not found")
+    if len(old.shards) == 1:
+        raise HTTPException(status_code=400, detail="Cannot remove the last shard")
+    shard_router.ring = HashRing({key: url for key, url in old.shards.items() if key != name}, old.virtual_nodes)
+    await shard_router.start_rebalance(old)
+    return {"ok": True, "SHARDS": format_shards(shard_router.ring.shards)}
+
+
+@app.post("/api/shards/rebalance", dependencies=[Depends(require_admin)])
+async def retry_rebalance():
+    """Retry moving the users a previous rebalance could not move."""
+    _check_idle()
+    if shard_router.previous is None:
+        return {"ok": True, "rebalancing": False}
+    await shard_router.start_rebalance(shard_router.previous)
+    return {"ok": True, "rebalancing": True}
+
+
+@app.get("/api/shards/owner/{user_id}")
+async def shard_owner(user_id: str):
+    """The shard holding a user, for clients that connect to it directly (e.g. the verification stream)."""
+    name, url = await shard_router.locate(user_id)
+    return {"user_id": user_id, "shard": name, "url": url}
+
+
+@app.api_route("/api/shards/{name}/{path:path}", methods=["GET", "POST", "DELETE"],
+               dependencies=[Depends(require_admin)])
+async def shard_passthrough(name: str, path: str, request: Request):
+    """Any request to one shard, e.g. /api/shards/shard0/api/unknown-access/12/image."""
+    url = shard_router.members().get(name)
+    if url is None:
+        raise HTTPException(status_code=404, detail="Shard not found")
+    return await shard_router.forward(request, url, "/" + path)
+
+
+@app.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"], include_in_schema=False)
+async def not_routed(path: str):
+    return JSONResponse(status_code=404, content={
+        "detail": f"/api/{path} is not routed across shards; an admin can send it to one shard with "
+                  f"/api/shards/{{name}}/api/{path}"
+    })
+
+
+# Running shards locally
+
+def _wait_until_up(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Shard at {url} exited with status {process.returncode}")
+        try:
+            if httpx.get(url + "/", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Shard at {url} did not start within {timeout} seconds")
+
+
+def shard_environment(name: str, directory: str) -> Dict[str, str]:
+    """Settings of a local shard: its own SQLite database and blob store under directory/name."""
+    root = os.path.abspath(os.path.join(directory, name))
+    os.makedirs(root, exist_ok=True)
+    return {
+        "DATABASE_URL": f"sqlite:///{os.path.join(root, 'database.db')}",
+        "ASYNC_DATABASE_URL": "",
+        "BLOB_STORE_PATH": os.path.join(root, "blobs"),
+        "ANN_SNAPSHOT_PATH": os.path.join(root, "ivf.snapshot") if settings.ANN_SNAPSHOT_PATH else "",
+        "AUDIT_SPILL_DIR": os.path.join(root, "audit") if settings.AUDIT_SPILL_DIR else "",
+        "EMBEDDING_CACHE_GENERATION_PATH": (
+            os.path.join(root, "cache.generation") if settings.EMBEDDING_CACHE_GENERATION_PATH else ""
+        ),
+    }
+
+
+def shard_command(name: str, host: str, port: int, directory: str) -> Tuple[List[str], Dict[str, str]]:
+    """Command line and environment of a local shard (settings are read at import, so not in this process)."""
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", host, "--port", str(port),
+               "--log-level", "warning"]
+    return command, {**os.environ, **shard_environment(name, directory)}
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the shard router, local shards, or a rebalance.")
+    parser.add_argument("command", choices=["local", "serve", "shard", "rebalance"])
+    parser.add_argument("--shards", help="serve: 'name=url,...' (default: SHARDS); local: number of shards")
+    parser.add_argument("--name", help="shard: its name")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="Router port; local shards use the following ones")
+    parser.add_argument("--dir", default="shards", help="Databases and blob stores of local shards")
+    parser.add_argument("--from", dest="source", help="rebalance: the old ring, 'name=url,...'")
+    parser.add_argument("--to", dest="target", help="rebalance: the new ring, 'name=url,...'")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    args = parser.parse_args()
+
+    if args.command == "local":
+        # Local shards and the router run here, so fresh tokens can be shared with them
+        generated = {name: secrets.token_urlsafe(32) for name in ("SHARD_TOKEN", "SHARD_ADMIN_TOKEN")
+                     if not getattr(settings, name)}
+        for name, token in generated.items():
+            setattr(settings, name, token)
+            os.environ[name] = token
+            print(f"{name}={token}", file=sys.stderr)
+    elif not settings.SHARD_TOKEN:
+        parser.error(f"{args.command} needs SHARD_TOKEN, the secret shared by the router and its shards")
+
+    if args.command == "shard":
+        if not args.name:
+            parser.error("shard needs --name")
+        command, env = shard_command(args.name, args.host, args.port, args.dir)
+        os.chdir(ROOT)
+        os.execve(sys.executable, command, env)
+
+    if args.command == "rebalance":
+        if not args.source or not args.target:
+            parser.error("rebalance needs --from and --to")
+        old = HashRing(parse_shards(args.source), settings.SHARD_VIRTUAL_NODES)
+        new = HashRing(parse_shards(args.target), settings.SHARD_VIRTUAL_NODES)
+
+        async def run():
+            async with httpx.AsyncClient(timeout=settings.SHARD_TIMEOUT_SECONDS) as client:
+                return await rebalance(client, old, new, concurrency=settings.SHARD_REBALANCE_CONCURRENCY)
+
+        started = time.perf_counter()
+        progress = asyncio.run(run())
+        print(f"Scanned {progress['scanned']} users, moved {progress['moved']}, failed {progress['failed']} "
+              f"in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        for error in progress["errors"]:
+            print(error, file=sys.stderr)
+        return
+
+    processes = []
+    try:
+        if args.command == "local":
+            count = int(args.shards or 2)
+            shards = {}
+            for index in range(count):
+                name, port = f"shard{index}", args.port + 1 + index
+                command, env = shard_command(name, args.host, port, args.dir)
+                processes.append(subprocess.Popen(command, cwd=ROOT, env=env))
+                shards[name] = f"http://{args.host}:{port}"
+            for process, url in zip(processes, shards.values()):
+                _wait_until_up(url, process, args.startup_timeout)
+        else:
+            shards = parse_shards(args.shards or settings.SHARDS)
+            if not shards:
+                parser.error("serve needs --shards or SHARDS")
+        shard_router.ring = HashRing(shards, settings.SHARD_VIRTUAL_NODES)
+        print(f"Routing to SHARDS={format_shards(shards)}", file=sys.stderr)
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Streaming verification over a WebSocket, for live-camera login.
+
+Connect to `/api/verify/stream?user_id=...` and send frames as binary
+messages (JPEG, PNG or WebP bytes) or as base64 data URLs in text
+messages. The user's templates are loaded once per session. Frames that
+arrive while the previous one is still being embedded replace each other,
+so only the newest is processed when inference lags behind the camera.
+
+Every processed frame gets a reply:
+
+    {"type": "frame", "frame": 3, "face": true, "similarity": 0.61, "window_similarity": 0.58}
+
+Similarities of the last STREAM_WINDOW frames with a face are averaged,
+and the session ends with a result as soon as the outcome is clear:
+
+    {"type": "result", "match": true, "similarity": 0.58, "frames": 4, "dropped": 2, "reason": "confident"}
+
+`reason` is 'confident' (the mean reached SIMILARITY_THRESHOLD after at
+least STREAM_MIN_FRAMES frames, or a full window stayed below it),
+'max_frames' or 'timeout'. One access log is written per session, with
+the best frame's capture and embedding, instead of one per frame. A session
+in which no frame had a face is logged as a failed verification, with the
+last frame's capture, like a `/verify` call without a face.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple, Union
+
+import numpy as np
+from fastapi import WebSocket, WebSocketDisconnect
+
+from . import services, templates
+from .audit import audit_writer
+from .core.config import settings
+from .db.database import AsyncSessionLocal
+from .executor import Overloaded, inference_executor, storage_executor
+from .gallery import normalize
+from .inference import Face
+from .metrics import span
+
+
+def _decode_frame(frame: Union[str, bytes]) -> Tuple[bytes, Optional[np.ndarray]]:
+    with span("read_payload"):
+        img_bytes = services.read_image_payload(frame)
+    with span("decode"):
+        return img_bytes, services.decode_image_bytes(img_bytes)
+
+
+class SlidingDecision:
+    """Sliding-window accept/reject decision over per-frame similarities."""
+
+    def __init__(self, threshold: float, window: int, min_frames: int, max_frames: int):
+        self.threshold = threshold
+        self.min_frames = max(1, min(min_frames, window))
+        self.max_frames = max_frames
+        self.scores: Deque[float] = deque(maxlen=max(1, window))
+        self.frames = 0
+
+    @property
+    def similarity(self) -> Optional[float]:
+        """Mean similarity of the window, or None before any face."""
+        return float(np.mean(self.scores)) if self.scores else None
+
+    def add(self, similarity: Optional[float]) -> Optional[Tuple[bool, str]]:
+        """Record one frame (None: no face); returns (match, reason) once decided."""
+        self.frames += 1
+        if similarity is not None:
+            self.scores.append(similarity)
+            if len(self.scores) >= self.min_frames and self.similarity >= self.threshold:
+                return True, "confident"
+            if len(self.scores) == self.scores.maxlen and max(self.scores) < self.threshold:
+                return False, "confident"
+        if self.frames >= self.max_frames:
+            return False, "max_frames"
+        return None
+
+
+class VerificationStream:
+    """One streaming verification session."""
+
+    def __init__(self, websocket: WebSocket, user_id: str, ip_address: Optional[str], user_agent: Optional[str]):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.ip_address = ip_address
+        self.user_agent = user_agent
+        self.decision = SlidingDecision(
+            settings.SIMILARITY_THRESHOLD, settings.STREAM_WINDOW, settings.STREAM_MIN_FRAMES, settings.STREAM_MAX_FRAMES
+        )
+        self.dropped = 0
+        # Best frame so far: (similarity, image bytes, frame, face), kept for the access log
+        self.best: Optional[Tuple[float, bytes, np.ndarray, Face]] = None
+        # Newest frame without a face: (image bytes, frame), logged when no frame had one
+        self.faceless: Optional[Tuple[bytes, np.ndarray]] = None
+        self._latest: Optional[Union[str, bytes]] = None
+        self._arrived = asyncio.Event()
+        self._closed = False
+
+    async def _receive(self):
+        """Keep only the newest unprocessed frame."""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                frame = message.get("bytes") or message.get("text")
+                if not frame:
+                    continue
+                if self._latest is not None:
+                    self.dropped += 1
+                self._latest = frame
+                self._arrived.set()
+        finally:
+            self._closed = True
+            self._arrived.set()
+
+    async def _next_frame(self) -> Optional[Union[str, bytes]]:
+        if self._closed and self._latest is None:
+            return None
+        await self._arrived.wait()
+        self._arrived.clear()
+        frame, self._latest = self._latest, None
+        return frame
+
+    async def _score(self, frame: Union[str, bytes], stored: np.ndarray) -> Tuple[Optional[float], Tuple]:
+        """Similarity of one frame (None: no face), with its (image bytes, frame, face)."""
+        img_bytes, image = await inference_executor.run(_decode_frame, frame)
+        if image is None:
+            raise ValueError("Could not decode the frame.")
+        face = await services.embed_face_async(image, services.VERIFY_DET_SIZE)
+        if face is None:
+            return None, (img_bytes, image, None)
+        with span("score"):
+            similarity = templates.score(
+                stored, normalize(face[0]), settings.TEMPLATE_SCORING, settings.TEMPLATE_TOP_K
+            )
+        return similarity, (img_bytes, image, face)
+
+    async def run(self):
+        async with AsyncSessionLocal() as database:
+            stored = await services.get_user_templates_async(database, self.user_id)
+        if stored is None:
+            await services._audit(
+                audit_writer.log_unknown_access, None, attempted_user_id=self.user_id,
+                ip_address=self.ip_address, user_agent=self.user_agent
+            )
+            await self.websocket.send_json({"type": "error", "detail": "User ID not found."})
+            await self.websocket.close(code=1008)
+            return
+        await self.websocket.send_json({"type": "ready"})
+
+        receiver = asyncio.create_task(self._receive())
+        deadline = time.monotonic() + settings.STREAM_TIMEOUT_SECONDS
+        outcome: Optional[Tuple[bool, str]] = None
+        try:
+            while outcome is None:
+                try:
+                    frame = await asyncio.wait_for(self._next_frame(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    outcome = (False, "timeout")
+                    break
+                if frame is None:
+                    break  # Disconnected
+                try:
+                    with inference_executor.admit():
+                        similarity, capture = await self._score(frame, stored)
+                except Overloaded:
+                    self.dropped += 1
+                    continue
+                except ValueError as e:
+                    await self.websocket.send_json({"type": "frame", "frame": self.decision.frames, "error": str(e)})
+                    continue
+                if similarity is None:
+                    self.faceless = capture[:2]
+                elif self.best is None or similarity > self.best[0]:
+                    self.best = (similarity, *capture)
+                outcome = self.decision.add(similarity)
+                window = self.decision.similarity
+                await self.websocket.send_json({
+                    "type": "frame", "frame": self.decision.frames, "face": similarity is not None,
+                    "similarity": None if similarity is None else round(similarity, 4),
+                    "window_similarity": None if window is None else round(window, 4),
+                })
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiver.cancel()
+
+        if outcome is not None and not self._closed:
+            match, reason = outcome
+            await self.websocket.send_json({
+                "type": "result", "match": match, "similarity": round(self.decision.similarity or 0.0, 4),
+                "frames": self.decision.frames, "dropped": self.dropped, "reason": reason,
+            })
+            await self.websocket.close()
+        await self._log(outcome is not None and outcome[0], stored)
+
+    async def _log(self, match: bool, stored: np.ndarray):
+        """The session's single access log; successful sessions also refresh the templates."""
+        if self.best is None:
+            # No frame had a face (or none arrived): a failed attempt, as in `/verify`
+            img_bytes, image = self.faceless or (None, None)
+            image_ref, thumbnail_ref = await storage_executor.run(services.store_capture, img_bytes, image, None)
+            await services._audit(
+                audit_writer.log_access_attempt, self.user_id, "verification_failed", False,
+                image_ref=image_ref, thumbnail_ref=thumbnail_ref, ip_address=self.ip_address, user_agent=self.user_agent
+            )
+            return
+        best_similarity, img_bytes, image, (embedding, crop) = self.best
+        image_ref, thumbnail_ref = await storage_executor.run(services.store_capture, img_bytes, image, crop)
+        if match and settings.TEMPLATE_REFRESH and best_similarity >= settings.TEMPLATE_REFRESH_MIN_SIMILARITY:
+            async with AsyncSessionLocal() as database:
+                await services.refresh_user_templates(database, self.user_id, stored, embedding)
+        await services._audit(
+            audit_writer.log_access_attempt, self.user_id,
+            "verification_success" if match else "verification_failed", match,
+            image_ref=image_ref, embedding=embedding, similarity_score=self.decision.similarity,
+            ip_address=self.ip_address, user_agent=self.user_agent, thumbnail_ref=thumbnail_ref
+        )
@@ -0,0 +1,80 @@
+"""
+Per-user template sets: several unit embeddings instead of one centroid.
+
+A user's templates are a K x D matrix (enrollment images, later refreshed
+from confident verifications), and a live face is scored against all of
+them with a single matrix-vector product:
+
+- 'max': the best-matching template. Tolerant of pose, lighting and
+  ageing, since one close template is enough.
+- 'topk_mean': the mean of the `top_k` best, which damps a single outlier.
+- 'centroid': the user's stored centroid (`User.embedding`, the mean of
+  every enrollment image), as before templates existed. Callers pass it as
+  a one-row matrix; given several rows, their normalized mean is used.
+"""
+from typing import List, Optional
+
+import numpy as np
+
+from .gallery import normalize
+
+STRATEGIES = ("max", "topk_mean", "centroid")
+
+
+def as_matrix(embeddings) -> np.ndarray:
+    """Unit-normalized float32 rows of a list of embeddings (or one embedding)."""
+    matrix = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def _most_redundant(templates: np.ndarray) -> int:
+    """Row whose closest other row is the closest overall; dropping it loses the least."""
+    similarities = templates @ templates.T
+    np.fill_diagonal(similarities, -np.inf)
+    return int(np.argmax(similarities.max(axis=1)))
+
+
+def build(embeddings: List[np.ndarray], max_size: int) -> np.ndarray:
+    """Template set from enrollment embeddings, pruned to the `max_size` most diverse."""
+    templates = as_matrix(embeddings)
+    while max_size > 0 and len(templates) > max_size:
+        templates = np.delete(templates, _most_redundant(templates), axis=0)
+    return templates
+
+
+def score(templates: np.ndarray, query: np.ndarray, strategy: str = "max", top_k: int = 3) -> float:
+    """Cosine similarity between a unit query embedding and a template set."""
+    scores = templates @ np.asarray(query, dtype=np.float32)
+    if strategy == "max" or len(scores) == 1:
+        return float(scores.max())
+    if strategy == "topk_mean":
+        k = min(max(top_k, 1), len(scores))
+        return float(np.partition(scores, len(scores) - k)[-k:].mean())
+    if strategy == "centroid":
+        # q . mean(T) / |mean(T)|, without materializing the centroid
+        norm = np.linalg.norm(templates.mean(axis=0))
+        return float(scores.mean() / norm) if norm > 0 else 0.0
+    raise ValueError(f"Unknown template scoring strategy: {strategy}")
+
+
+def refresh(templates: np.ndarray, embedding: np.ndarray, max_size: int,
+            max_redundancy: float) -> Optional[np.ndarray]:
+    """
+    Templates with a verified embedding added, or None if it adds nothing new.
+
+    Embeddings at least `max_redundancy` similar to an existing template are
+    skipped. Once the set holds `max_size` rows, the new embedding replaces
+    the most redundant one, so the set stays diverse instead of filling up
+    with near-identical captures.
+    """
+    embedding = normalize(embedding)
+    if float((templates @ embedding).max()) >= max_redundancy:
+        return None
+    updated = np.vstack([templates, embedding[None, :]])
+    if max_size > 0 and len(updated) > max_size:
+        dropped = _most_redundant(updated)
+        if dropped == len(updated) - 1:
+            return None  # The new embedding is the least useful one
+        updated = np.delete(updated, dropped, axis=0)
+    return updated
@@ -0,0 +1,354 @@
+"""
+Dedicated pool of inference worker processes.
+
+Run the pool once per host:
+
+    python -m app.workers --workers 4
+
+and point the API at it with `INFERENCE_POOL_ADDRESS`. API processes then
+never load the model themselves, so gunicorn can run several HTTP workers
+while inference uses every core. Frames and embeddings travel through
+`multiprocessing.shared_memory` blocks (frame, then embedding, then the
+aligned face crop); only the block name, the frame shape and a status flag
+go over the socket.
+
+The socket lives in a directory only its owner can access, next to a
+random key generated on every start; clients read the key from there to
+authenticate. Workers that die are respawned, and the requests they held
+fail with an error instead of waiting forever.
+"""
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import signal
+import stat
+import sys
+import tempfile
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener, wait
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Name of the key file kept next to the socket
+AUTHKEY_FILE = "authkey"
+
+# Shared-memory layout after the frame: (embedding length, crop shape),
+# taken from the recognition model the workers loaded
+Layout = Tuple[int, Tuple[int, int, int]]
+
+
+def default_address() -> str:
+    return os.path.join(tempfile.gettempdir(), f"face-inference-{os.getuid()}", "pool.sock")
+
+
+def private_directory(path: str):
+    """Create `path` with mode 0700, or check that an existing one is ours and private."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+
+
+def write_authkey(address: str) -> bytes:
+    """Generate this run's key and store it, readable by the owner only, next to the socket."""
+    authkey = secrets.token_bytes(32)
+    path = os.path.join(os.path.dirname(address), AUTHKEY_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    return authkey
+
+
+def read_authkey(address: str) -> bytes:
+    with open(os.path.join(os.path.dirname(address), AUTHKEY_FILE), "rb") as f:
+        return f.read()
+
+
+def _attach(name: str) -> SharedMemory:
+    """Attach to a block owned by another process without letting our resource tracker unlink it."""
+    shm = SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def block_size(shape: Tuple[int, ...], layout: Layout) -> int:
+    dim, crop_shape = layout
+    return int(np.prod(shape)) + dim * 4 + int(np.prod(crop_shape))
+
+
+def _frame_view(shm: SharedMemory, shape: Tuple[int, ...]) -> np.ndarray:
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+
+def _embedding_view(shm: SharedMemory, shape: Tuple[int, ...], layout: Layout) -> np.ndarray:
+    offset = int(np.prod(shape))
+    return np.ndarray((layout[0],), dtype=np.float32, buffer=shm.buf, offset=offset)
+
+
+def _crop_view(shm: SharedMemory, shape: Tuple[int, ...], layout: Layout) -> np.ndarray:
+    offset = int(np.prod(shape)) + layout[0] * 4
+    return np.ndarray(layout[1], dtype=np.uint8, buffer=shm.buf, offset=offset)
+
+
+def model_layout(analyzer) -> Layout:
+    """Embedding length and aligned crop shape of the analyzer's recognition model."""
+    recognizer = analyzer.models["recognition"]
+    width, height = recognizer.input_size
+    crop = np.zeros((height, width, 3), dtype=np.uint8)
+    return int(recognizer.get_feat([crop]).shape[1]), (height, width, 3)
+
+
+def _worker_main(index: int, tasks, results, ready, max_batch_size: int):
+    """Inference process: embed frames from shared memory and write embeddings and crops back in place."""
+    from .inference import embed_faces, load_face_analyzer, square_det_size, warm_up
+
+    analyzer = load_face_analyzer()
+    if settings.MODEL_WARMUP:
+        warm_up(analyzer, [None, square_det_size(settings.VERIFY_DET_SIZE)], [1, max_batch_size])
+    layout = model_layout(analyzer)
+    ready.put((index, layout))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch = [task]
+        # Drain whatever else is already waiting into the same recognition batch
+        while len(batch) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                tasks.put(None)
+                break
+            batch.append(task)
+
+        attached = []
+        for job_id, name, shape, det_size in batch:
+            try:
+                attached.append((job_id, _attach(name), shape, det_size))
+            except FileNotFoundError:
+                # The client gave up on this request and released its block
+                results.put((job_id, False, "request abandoned"))
+        try:
+            frames = [_frame_view(shm, shape) for _, shm, shape, _ in attached]
+            faces = embed_faces(analyzer, frames, [det_size for _, _, _, det_size in attached])
+            del frames
+            for (job_id, shm, shape, _), face in zip(attached, faces):
+                if face is not None:
+                    _embedding_view(shm, shape, layout)[:] = face[0]
+                    _crop_view(shm, shape, layout)[:] = face[1]
+                results.put((job_id, face is not None, None))
+        except Exception as e:
+            for job_id, _, _, _ in attached:
+                results.put((job_id, False, str(e)))
+        finally:
+            for _, shm, _, _ in attached:
+                shm.close()
+
+
+class InferencePoolServer:
+    """Owns the worker processes and serves embedding requests from API processes."""
+
+    def __init__(self, address: str, workers: int, max_batch_size: int = 8, timeout: float = 30):
+        self.address = address
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self._context = multiprocessing.get_context("spawn")
+        self.results = self._context.Queue()
+        self.ready = self._context.Queue()
+        self.layout: Optional[Layout] = None
+        # One task queue per worker, so the jobs a dead worker held are known
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.tasks: List = [None] * workers
+        self._load = [0] * workers
+        self._job_ids = itertools.count()
+        # job id -> (event, result slot, worker index)
+        self._pending: Dict[int, Tuple[threading.Event, list, int]] = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+        for index in range(workers):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, args=(index, tasks, self.results, self.ready, self.max_batch_size), daemon=True
+        )
+        process.start()
+        self.tasks[index], self.processes[index] = tasks, process
+
+    def _route_results(self):
+        while True:
+            job_id, found, error = self.results.get()
+            with self._lock:
+                event, slot, index = self._pending.pop(job_id, (None, None, None))
+                if event is not None:
+                    self._load[index] -= 1
+            if event is not None:
+                slot.append((found, error))
+                event.set()
+
+    def _watch_workers(self):
+        """Fail the jobs of workers that exit, and start replacements."""
+        while not self._stopping:
+            sentinels = {process.sentinel: index for index, process in enumerate(self.processes)}
+            for sentinel in wait(list(sentinels), timeout=1.0):
+                if self._stopping:
+                    return
+                index = sentinels[sentinel]
+                self.processes[index].join(1.0)
+                code = self.processes[index].exitcode
+                with self._lock:
+                    lost = [job_id for job_id, (_, _, owner) in self._pending.items() if owner == index]
+                    for job_id in lost:
+                        event, slot, _ = self._pending.pop(job_id)
+                        slot.append((False, f"inference worker exited with code {code}"))
+                        event.set()
+                    self._load[index] = 0
+                    self._spawn(index)
+                logger.warning("Inference worker %d exited with code %s; failed %d jobs and restarted it",
+                               index, code, len(lost))
+
+    def _wait_ready(self):
+        """Block until a worker has loaded the model, and take the shared-memory layout from it."""
+        while self.layout is None:
+            try:
+                _, self.layout = self.ready.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise RuntimeError("Every inference worker exited before loading the model")
+
+    def _embed(self, shm_name: str, shape: Tuple[int, ...], det_size) -> Tuple[bool, Optional[str]]:
+        job_id = next(self._job_ids)
+        event, slot = threading.Event(), []
+        with self._lock:
+            index = min(range(len(self._load)), key=self._load.__getitem__)
+            self._pending[job_id] = (event, slot, index)
+            self._load[index] += 1
+            self.tasks[index].put((job_id, shm_name, tuple(shape), det_size))
+        if not event.wait(self.timeout):
+            with self._lock:
+                if self._pending.pop(job_id, None) is not None:
+                    self._load[index] -= 1
+            return False, f"no result within {self.timeout:g}s"
+        return slot[0]
+
+    def _serve_connection(self, conn):
+        try:
+            conn.send(self.layout)
+            while True:
+                shm_name, shape, det_size = conn.recv()
+                conn.send(self._embed(shm_name, shape, det_size))
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        threading.Thread(target=self._route_results, daemon=True).start()
+        self._wait_ready()
+        threading.Thread(target=self._watch_workers, daemon=True).start()
+        private_directory(os.path.dirname(self.address))
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        authkey = write_authkey(self.address)
+        with Listener(self.address, family="AF_UNIX", authkey=authkey) as listener:
+            logger.info("Inference pool with %d workers listening on %s", len(self.processes), self.address)
+            try:
+                while True:
+                    conn = listener.accept()
+                    threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+            finally:
+                self._stopping = True
+                for tasks in self.tasks:
+                    tasks.put(None)
+
+
+class InferencePoolClient:
+    """Used by API processes in place of a local model: one socket per calling thread."""
+
+    def __init__(self, address: str, timeout: float = 30):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # The key changes on every pool start, so it is read again on reconnect
+            conn = Client(self.address, family="AF_UNIX", authkey=read_authkey(self.address))
+            self._local.layout = conn.recv()
+            self._local.conn = conn
+        return conn
+
+    def _request(self, shm: SharedMemory, shape: Tuple[int, ...], det_size) -> Tuple[bool, Optional[str]]:
+        conn = self._connection()
+        conn.send((shm.name, shape, det_size))
+        # The pool answers even when a worker dies; a silent pool means it is stuck
+        if not conn.poll(self.timeout):
+            conn.close()
+            self._local.conn = None
+            raise RuntimeError(f"Inference pool did not answer within {self.timeout:g}s")
+        return conn.recv()
+
+    def embed(self, image: np.ndarray, det_size: Optional[Tuple[int, int]] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """The single face in the image as (embedding, aligned crop), or None."""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        self._connection()
+        layout = self._local.layout
+        shm = SharedMemory(create=True, size=block_size(image.shape, layout))
+        try:
+            _frame_view(shm, image.shape)[:] = image
+            try:
+                found, error = self._request(shm, image.shape, det_size)
+            except (EOFError, ConnectionError, OSError):
+                # The pool restarted; reconnect once and retry
+                self._local.conn = None
+                self._connection()
+                if self._local.layout != layout:
+                    raise RuntimeError("The inference pool restarted with a different model")
+                found, error = self._request(shm, image.shape, det_size)
+            if error:
+                raise RuntimeError(f"Inference worker failed: {error}")
+            if not found:
+                return None
+            return _embedding_view(shm, image.shape, layout).copy(), _crop_view(shm, image.shape, layout).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the shared inference worker pool.")
+    parser.add_argument("--address", default=settings.INFERENCE_POOL_ADDRESS or default_address())
+    parser.add_argument("--workers", type=int, default=settings.INFERENCE_POOL_WORKERS or os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=settings.INFERENCE_BATCH_SIZE)
+    parser.add_argument("--timeout", type=float, default=settings.INFERENCE_POOL_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # Exit through serve_forever's cleanup, so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    InferencePoolServer(args.address, args.workers, args.batch_size, args.timeout).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
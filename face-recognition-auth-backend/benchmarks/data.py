@@ -0,0 +1,70 @@
+"""
+Images for the benchmarks: a labelled directory, or synthetic frames.
+
+Synthetic frames are smooth gradients with shapes and mild noise, so they
+compress like photos rather than like random noise. They contain no faces:
+detection still runs in full, but verification and identification stop at
+"no face detected". Pass a labelled set (`<root>/<identity>/*.jpg`, the
+bulk enrollment layout) to benchmark the whole path.
+"""
+import base64
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from app.bulk_enroll import read_directory
+
+
+def synthetic_image(side: int, seed: int = 0) -> np.ndarray:
+    """A photo-like BGR frame of `side` x `side` pixels."""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 1, side, dtype=np.float32)
+    base = rng.uniform(40, 200, 3).astype(np.float32)
+    slope = rng.uniform(-60, 60, 3).astype(np.float32)
+    image = base + slope * (ramp[:, None, None] + ramp[None, :, None]) / 2
+    for _ in range(6):
+        center = tuple(int(v) for v in rng.integers(0, side, 2))
+        axes = tuple(int(v) for v in rng.integers(side // 16 + 1, side // 4 + 2, 2))
+        color = tuple(float(v) for v in rng.uniform(0, 255, 3))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+    image += rng.normal(0, 4, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 90) -> bytes:
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode image")
+    return encoded.tobytes()
+
+
+def data_url(data: bytes) -> str:
+    """The base64 data URL form the JSON endpoints accept."""
+    return "data:image/jpeg;base64," + base64.b64encode(data).decode()
+
+
+def load_identities(root: Optional[str], identities: int, images_per_identity: int = 3,
+                    side: int = 640) -> Dict[str, List[bytes]]:
+    """
+    Encoded images per identity, from a labelled directory or synthetic.
+
+    A directory provides at most `identities` identities with all of their
+    images; synthetic identities get `images_per_identity` frames each.
+    """
+    if root:
+        users = {}
+        for identity, paths in list(read_directory(root).items())[:identities]:
+            images = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    images.append(f.read())
+            users[identity] = images
+        return users
+    return {
+        f"bench-{index:06d}": [
+            encode_jpeg(synthetic_image(side, seed=index * images_per_identity + offset))
+            for offset in range(images_per_identity)
+        ]
+        for index in range(identities)
+    }
@@ -0,0 +1,294 @@
+"""
+Concurrent HTTP load generator for the enroll / verify / identify endpoints.
+
+Usage:
+    python -m benchmarks.load --serve [--images DIR] [--users 50]
+        [--concurrency 16] [--duration 30] [--mix verify=8,identify=2]
+        [--json load.json]
+    python -m benchmarks.load --url http://127.0.0.1:8000 ...
+
+With `--serve` the app is started with uvicorn on a free local port,
+against a fresh SQLite database and blob directory (or `--database-url`),
+and stopped afterwards; `--url` targets an already running server.
+
+The run enrolls `--users` identities, then `--concurrency` closed-loop
+clients each send requests drawn from `--mix` (weights per endpoint;
+`enroll` creates new users) for `--duration` seconds or `--requests`
+requests in total. Every request is timed end to end. Results per
+endpoint, and overall: latency percentiles, requests/sec, and the status
+codes seen (429 = rejected by admission control). Only standard library
+HTTP is used, one keep-alive connection per client.
+
+Without `--images` the frames are synthetic and contain no faces, so the
+enrollments fail and verifications stop at detection; this still measures
+decode, detection and the request path, but pass a labelled set to
+exercise matching and the database writes.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from .data import data_url, load_identities
+from .results import summarize, write
+
+ENDPOINTS = {"enroll": "/api/enroll", "verify": "/api/verify", "identify": "/api/identify"}
+
+
+class Client:
+    """A keep-alive connection that reconnects after errors."""
+
+    def __init__(self, url: str, timeout: float):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.factory = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, float]:
+        """Send a request; returns (status, seconds), with status 0 for connection errors."""
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        started = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = self.factory(self.host, self.port, timeout=self.timeout)
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            return response.status, time.perf_counter() - started
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return 0, time.perf_counter() - started
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' in --mix (choose from {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+    if not any(weights.values()):
+        raise ValueError("--mix needs at least one endpoint with a positive weight")
+    return weights
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database_url: Optional[str], workdir: str, startup_timeout: float) -> Tuple[subprocess.Popen, str]:
+    """Run the app with uvicorn in a subprocess and wait until it answers."""
+    port = free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    env["DATABASE_URL"] = database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    env["BLOB_STORE_PATH"] = os.path.join(workdir, "blobs")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=workdir, env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    client = Client(url, timeout=5)
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        status, _ = client.request("GET", "/")
+        if status == 200:
+            client.close()
+            return process, url
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Server did not start within {startup_timeout} seconds")
+
+
+class LoadTest:
+    def __init__(self, url: str, identities: Dict[str, List[str]], weights: Dict[str, float],
+                 concurrency: int, timeout: float, seed: int = 0):
+        self.url = url
+        self.identities = identities
+        self.names = list(identities)
+        self.weights = weights
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.seed = seed
+        self.enrolled: List[str] = []
+        self._lock = threading.Lock()
+        self._new_users = 0
+        self.samples: List[Tuple[str, int, float]] = []
+
+    def enroll_all(self) -> List[Tuple[str, int, float]]:
+        """Enroll every identity (concurrently); returns the setup samples."""
+        samples: List[Tuple[str, int, float]] = []
+        pending = list(self.names)
+
+        def worker():
+            client = Client(self.url, self.timeout)
+            while True:
+                with self._lock:
+                    if not pending:
+                        break
+                    name = pending.pop()
+                status, seconds = client.request(
+                    "POST", ENDPOINTS["enroll"], {"user_id": name, "images": self.identities[name]}
+                )
+                with self._lock:
+                    samples.append(("setup_enroll", status, seconds))
+                    if status == 200:
+                        self.enrolled.append(name)
+            client.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.concurrency, len(pending)) or 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples
+
+    def _request(self, rng: random.Random, endpoint: str) -> dict:
+        if endpoint == "enroll":
+            with self._lock:
+                self._new_users += 1
+                user_id = f"load-{self.seed}-{self._new_users}"
+            return {"user_id": user_id, "images": self.identities[rng.choice(self.names)]}
+        if endpoint == "verify":
+            # Genuine attempts against enrolled users; impostor frames when nobody enrolled
+            name = rng.choice(self.enrolled or self.names)
+            return {"user_id": name, "image": rng.choice(self.identities[name])}
+        return {"image": rng.choice(self.identities[rng.choice(self.names)])}
+
+    def run(self, duration: Optional[float], requests: Optional[int]) -> float:
+        """Closed-loop clients until the duration or request budget is used; returns elapsed seconds."""
+        endpoints = list(self.weights)
+        weights = [self.weights[name] for name in endpoints]
+        remaining = [requests] if requests else None
+        started = time.perf_counter()
+        deadline = started + duration if duration else None
+
+        def worker(index: int):
+            rng = random.Random(self.seed * 1000 + index)
+            client = Client(self.url, self.timeout)
+            local = []
+            while True:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+                if remaining is not None:
+                    with self._lock:
+                        if remaining[0] <= 0:
+                            break
+                        remaining[0] -= 1
+                endpoint = rng.choices(endpoints, weights)[0]
+                status, seconds = client.request("POST", ENDPOINTS[endpoint], self._request(rng, endpoint))
+                local.append((endpoint, status, seconds))
+            client.close()
+            with self._lock:
+                self.samples.extend(local)
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+
+def report(name: str, samples: List[Tuple[str, int, float]], elapsed: float) -> Dict:
+    statuses = Counter(status for _, status, _ in samples)
+    return {
+        "name": name,
+        **summarize(seconds for _, _, seconds in samples),
+        "rps": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+        "ok_rate": round(sum(count for status, count in statuses.items() if 200 <= status < 300) / len(samples), 4)
+        if samples else None,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the enroll, verify and identify endpoints.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server")
+    target.add_argument("--serve", action="store_true", help="Start the app locally for the run")
+    parser.add_argument("--database-url", help="Database for --serve (default: a temporary SQLite file)")
+    parser.add_argument("--images", help="Labelled image directory (default: synthetic frames)")
+    parser.add_argument("--users", type=int, default=50, help="Identities enrolled before the run")
+    parser.add_argument("--image-side", type=int, default=640, help="Side of synthetic frames")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load (ignored with --requests)")
+    parser.add_argument("--requests", type=int, help="Total requests instead of a duration")
+    parser.add_argument("--mix", default="verify=8,identify=2", help="Endpoint weights, e.g. verify=8,identify=2,enroll=1")
+    parser.add_argument("--timeout", type=float, default=60, help="Per-request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    identities = {
+        name: [data_url(data) for data in images]
+        for name, images in load_identities(args.images, args.users, side=args.image_side).items()
+    }
+    if not identities:
+        parser.error(f"No images found under {args.images}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        process = None
+        url = args.url
+        if args.serve:
+            process, url = start_server(args.database_url, workdir, args.startup_timeout)
+        try:
+            test = LoadTest(url.rstrip("/"), identities, weights, args.concurrency, args.timeout, args.seed)
+            started = time.perf_counter()
+            setup = test.enroll_all()
+            setup_elapsed = time.perf_counter() - started
+            print(f"Enrolled {len(test.enrolled)} of {len(identities)} identities in {setup_elapsed:.1f}s")
+            elapsed = test.run(None if args.requests else args.duration, args.requests)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    results = [report("setup_enroll", setup, setup_elapsed)]
+    for endpoint in weights:
+        samples = [sample for sample in test.samples if sample[0] == endpoint]
+        if samples:
+            results.append(report(endpoint, samples, elapsed))
+    results.append(report("all", test.samples, elapsed))
+    for result in results:
+        print(json.dumps(result))
+
+    if args.json:
+        options = {key: value for key, value in vars(args).items() if key != "database_url"}
+        write(args.json, "load", {**options, "enrolled": len(test.enrolled), "elapsed_seconds": round(elapsed, 3)}, results)
+
+
+if __name__ == "__main__":
+    main()
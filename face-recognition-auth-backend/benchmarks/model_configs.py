@@ -0,0 +1,125 @@
+"""
+Latency / accuracy trade-off of model packs and detector input sizes.
+
+Usage:
+    python -m benchmarks.model_configs IMAGES [--packs buffalo_l,buffalo_sc]
+        [--det-sizes 640,320] [--threshold 0.42] [--json results.json]
+
+IMAGES is a labelled set laid out like bulk enrollment input: one
+sub-directory of images per identity (`<root>/<identity>/*.jpg`). Every
+configuration embeds every image one at a time (the same detection +
+recognition path the API uses) and reports per-image latency, how often
+exactly one face was found, and verification accuracy over all genuine
+(same identity) and impostor pairs of the embedded images.
+"""
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+from app.bulk_enroll import read_directory
+from app.core.config import settings
+
+
+def load_images(root: str):
+    labels, images = [], []
+    for identity, paths in read_directory(root).items():
+        for path in paths:
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if image is not None:
+                labels.append(identity)
+                images.append(image)
+    return labels, images
+
+
+def equal_error_rate(genuine: np.ndarray, impostor: np.ndarray) -> float:
+    """Error rate at the threshold where false accepts and false rejects are equal."""
+    if not len(genuine) or not len(impostor):
+        return float("nan")
+    thresholds = np.unique(np.concatenate([genuine, impostor]))
+    genuine = np.sort(genuine)
+    impostor = np.sort(impostor)
+    frr = np.searchsorted(genuine, thresholds, side="left") / len(genuine)
+    far = 1 - np.searchsorted(impostor, thresholds, side="left") / len(impostor)
+    best = np.argmin(np.abs(far - frr))
+    return float((far[best] + frr[best]) / 2)
+
+
+def evaluate(model_pack: str, det_size: int, labels: List[str], images: List[np.ndarray],
+             threshold: float) -> Dict:
+    from app.inference import embed_batch, load_face_analyzer, square_det_size
+
+    started = time.perf_counter()
+    analyzer = load_face_analyzer(model_pack=model_pack, det_size=det_size)
+    load_seconds = time.perf_counter() - started
+
+    size = square_det_size(det_size)
+    embed_batch(analyzer, images[:1], [size])  # Warm-up, excluded from timings
+    latencies, embeddings, owners = [], [], []
+    for label, image in zip(labels, images):
+        started = time.perf_counter()
+        embedding = embed_batch(analyzer, [image], [size])[0]
+        latencies.append(time.perf_counter() - started)
+        if embedding is not None:
+            embeddings.append(embedding)
+            owners.append(label)
+
+    result = {
+        "model_pack": model_pack,
+        "det_size": det_size,
+        "images": len(images),
+        "load_seconds": round(load_seconds, 3),
+        "latency_ms_mean": round(float(np.mean(latencies)) * 1000, 2),
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        "single_face_rate": round(len(embeddings) / len(images), 4),
+    }
+    if len(embeddings) >= 2:
+        matrix = np.stack(embeddings)
+        scores = matrix @ matrix.T
+        owner_ids = np.array(owners)
+        same = owner_ids[:, None] == owner_ids[None, :]
+        upper = np.triu(np.ones_like(same), k=1)
+        genuine = scores[same & upper]
+        impostor = scores[~same & upper]
+        result.update({
+            "genuine_pairs": int(len(genuine)),
+            "impostor_pairs": int(len(impostor)),
+            "tar_at_threshold": round(float(np.mean(genuine >= threshold)), 4) if len(genuine) else None,
+            "far_at_threshold": round(float(np.mean(impostor >= threshold)), 4) if len(impostor) else None,
+            "eer": round(equal_error_rate(genuine, impostor), 4),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare model packs and detector sizes on a labelled image set.")
+    parser.add_argument("images")
+    parser.add_argument("--packs", default=settings.MODEL_PACK)
+    parser.add_argument("--det-sizes", default=f"{settings.DET_SIZE},320")
+    parser.add_argument("--threshold", type=float, default=settings.SIMILARITY_THRESHOLD)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    labels, images = load_images(args.images)
+    if not images:
+        parser.error(f"No images found under {args.images}")
+    print(f"{len(images)} images of {len(set(labels))} identities")
+
+    results = []
+    for model_pack in [name.strip() for name in args.packs.split(",") if name.strip()]:
+        for det_size in [int(size) for size in args.det_sizes.split(",") if size.strip()]:
+            result = evaluate(model_pack, det_size, labels, images, args.threshold)
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"threshold": args.threshold, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
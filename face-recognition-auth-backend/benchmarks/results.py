@@ -0,0 +1,141 @@
+"""
+Machine-readable benchmark results, and comparison of two runs.
+
+Usage:
+    python -m benchmarks.results BASELINE.json CURRENT.json [--tolerance 0.10]
+
+Every benchmark writes the same envelope: which benchmark ran, when, on
+what (Python, NumPy, CPU count, git commit, the settings that affect
+speed), with which options, and a list of results. Each result has a
+`name` and latency summaries in milliseconds (`count`, `mean_ms`,
+`p50_ms`, `p95_ms`, `p99_ms`, `max_ms`) plus, for load tests, `rps`.
+
+The comparison matches results by name and exits with status 1 when a
+p50/p95/p99 grew, or rps dropped, by more than the tolerance, so it can
+gate a CI job.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# Settings recorded with each run, since they change the numbers
+RECORDED_SETTINGS = [
+    "DATABASE_URL", "MODEL_PACK", "DET_SIZE", "VERIFY_DET_SIZE", "PROVIDER", "GALLERY_INDEX",
+    "EMBEDDING_STORAGE_DTYPE", "INFERENCE_BATCHING", "INFERENCE_BATCH_SIZE", "TEMPLATE_SCORING",
+]
+
+# Lower is better for latencies, higher for throughput
+LATENCY_KEYS = ["p50_ms", "p95_ms", "p99_ms"]
+THROUGHPUT_KEYS = ["rps"]
+
+
+def summarize(seconds: Iterable[float]) -> Dict:
+    """Latency summary of a list of durations in seconds."""
+    samples = np.asarray(list(seconds), dtype=np.float64) * 1000
+    if not len(samples):
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "count": int(len(samples)),
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(samples.max()), 3),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment() -> Dict:
+    from sqlalchemy.engine import make_url
+    from app.core.config import settings
+
+    recorded = {name: getattr(settings, name) for name in RECORDED_SETTINGS}
+    recorded["DATABASE_URL"] = make_url(settings.DATABASE_URL).render_as_string(hide_password=True)
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "git_commit": _git_commit(),
+        "settings": recorded,
+    }
+
+
+def write(path: str, benchmark: str, options: Dict, results: List[Dict]):
+    """Write a run in the shared envelope."""
+    run = {
+        "format_version": FORMAT_VERSION,
+        "benchmark": benchmark,
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "options": options,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2, default=str)
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float) -> List[Dict]:
+    """Per-metric changes between two runs; `regressed` is set beyond the tolerance."""
+    previous = {result["name"]: result for result in baseline["results"]}
+    changes = []
+    for result in current["results"]:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        for key in LATENCY_KEYS + THROUGHPUT_KEYS:
+            if not before.get(key) or result.get(key) is None:
+                continue
+            ratio = result[key] / before[key]
+            worse = ratio - 1 if key in LATENCY_KEYS else 1 - ratio
+            changes.append({
+                "name": result["name"], "metric": key, "baseline": before[key],
+                "current": result[key], "change": round(ratio - 1, 4), "regressed": worse > tolerance,
+            })
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed relative slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get("benchmark") != current.get("benchmark"):
+        parser.error(f"Cannot compare '{baseline.get('benchmark')}' with '{current.get('benchmark')}' results")
+
+    changes = compare(baseline, current, args.tolerance)
+    for change in changes:
+        flag = "REGRESSED" if change["regressed"] else "ok"
+        print(f"{change['name']:<40} {change['metric']:<7} {change['baseline']:>10} -> "
+              f"{change['current']:>10} ({change['change']:+.1%}) {flag}")
+    sys.exit(1 if any(change["regressed"] for change in changes) else 0)
+
+
+if __name__ == "__main__":
+    main()
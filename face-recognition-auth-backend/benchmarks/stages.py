@@ -0,0 +1,259 @@
+"""
+Micro-benchmarks of each stage of a request, in isolation.
+
+Usage:
+    python -m benchmarks.stages [--images DIR] [--sizes 640,1280,3000]
+        [--repeat 50] [--users 10000] [--database-url sqlite:///bench.db]
+        [--skip-model] [--json stages.json]
+
+Stages:
+- decode: base64 payload checks and JPEG decoding (`imaging.decode`, with
+  the reduced-size decode of large frames) at each of `--sizes`.
+- embed: detection + recognition of one frame per detector size, and one
+  inference batch (skipped with `--skip-model`).
+- score: a live embedding against a template set of 1 (the single-vector
+  cosine similarity) and TEMPLATE_MAX_SIZE embeddings.
+- gallery: 1:N search over `--users` random users, exact and IVF.
+- crud: user reads and writes, single access logs and bulk audit batches,
+  against a fresh SQLite file unless `--database-url` points elsewhere
+  (the tables are created there and the rows are left behind).
+
+Results go to stdout as JSON lines and, with `--json`, to a file in the
+format of `benchmarks.results`.
+"""
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from app import imaging, templates
+from app.blobstore import decode_data_url
+from app.core.config import settings
+
+from .data import data_url, encode_jpeg, load_identities, synthetic_image
+from .results import summarize, write
+
+
+def measure(fn: Callable, repeat: int, warmup: int = 2) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def result(name: str, stage: str, samples: List[float], **extra) -> Dict:
+    return {"name": name, "stage": stage, **summarize(samples), **extra}
+
+
+def random_embeddings(count: int, dim: int = 512, seed: int = 0) -> np.ndarray:
+    return templates.as_matrix(np.random.default_rng(seed).normal(size=(count, dim)))
+
+
+def bench_decode(frames: Dict[str, bytes], repeat: int) -> List[Dict]:
+    results = []
+    for label, data in frames.items():
+        payload = data_url(data)
+
+        def read_payload():
+            imaging.check_base64_length(payload)
+            imaging.check_image_payload(decode_data_url(payload))
+
+        results.append(result(f"payload_{label}", "decode", measure(read_payload, repeat), bytes=len(data)))
+        decoded = imaging.decode(data)
+        results.append(result(
+            f"decode_{label}", "decode", measure(lambda: imaging.decode(data), repeat),
+            bytes=len(data), decoded_shape=list(decoded.shape) if decoded is not None else None,
+        ))
+    return results
+
+
+def bench_embed(frames: Dict[str, bytes], repeat: int) -> List[Dict]:
+    from app.inference import embed_batch, load_face_analyzer, square_det_size
+
+    analyzer = load_face_analyzer()
+    images = [imaging.decode(data) for data in frames.values()]
+    image = images[0]
+    det_sizes = sorted({settings.DET_SIZE, settings.VERIFY_DET_SIZE or settings.DET_SIZE, 320}, reverse=True)
+    results = []
+    for det_size in det_sizes:
+        size = square_det_size(det_size)
+        found = embed_batch(analyzer, [image], [size])[0] is not None
+        results.append(result(
+            f"embed_det{det_size}", "embed",
+            measure(lambda: embed_batch(analyzer, [image], [size]), repeat), face_found=found,
+        ))
+    batch = (images * settings.INFERENCE_BATCH_SIZE)[:settings.INFERENCE_BATCH_SIZE]
+    size = square_det_size(settings.DET_SIZE)
+    samples = measure(lambda: embed_batch(analyzer, batch, [size] * len(batch)), max(1, repeat // 4))
+    results.append(result(
+        f"embed_batch{len(batch)}_det{settings.DET_SIZE}", "embed", samples,
+        per_image_ms=round(float(np.mean(samples)) * 1000 / len(batch), 3),
+    ))
+    return results
+
+
+def bench_score(repeat: int) -> List[Dict]:
+    query = random_embeddings(1, seed=1)[0]
+    results = []
+    for count in sorted({1, settings.TEMPLATE_MAX_SIZE}):
+        matrix = random_embeddings(count)
+        for strategy in (templates.STRATEGIES if count > 1 else ("max",)):
+            results.append(result(
+                f"score_k{count}_{strategy}", "score",
+                measure(lambda: templates.score(matrix, query, strategy, settings.TEMPLATE_TOP_K), repeat * 10),
+            ))
+    return results
+
+
+def bench_gallery(users: int, repeat: int) -> List[Dict]:
+    from app.ann import IVFIndex
+    from app.gallery import EmbeddingMatrix
+
+    ids = [f"user-{index}" for index in range(users)]
+    vectors = random_embeddings(users)
+    queries = random_embeddings(repeat + 2, seed=2)
+    results = []
+
+    flat = EmbeddingMatrix(users)
+    flat.extend(ids, vectors)
+    query = itertools.cycle(queries)
+    results.append(result(
+        f"gallery_flat_{users}", "gallery", measure(lambda: flat.top_k(next(query), 5), repeat),
+    ))
+
+    nlist = max(1, min(settings.ANN_NLIST, users // 39))
+    index = IVFIndex(nlist=nlist, nprobe=min(settings.ANN_NPROBE, nlist),
+                     kmeans_iterations=settings.ANN_KMEANS_ITERATIONS)
+    started = time.perf_counter()
+    index._fill(ids, vectors, None)  # As IVFIndex.load does with the rows from the database
+    trained = index.train()
+    build_seconds = time.perf_counter() - started
+    results.append(result(
+        f"gallery_ivf_{users}", "gallery", measure(lambda: index.search(next(query), 5), repeat),
+        nlist=nlist, nprobe=index.nprobe, trained=trained, build_seconds=round(build_seconds, 3),
+    ))
+    return results
+
+
+def bench_crud(database_url: str, repeat: int) -> List[Dict]:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.db import crud, models
+    from app.db.database import configure_engine, engine_options
+
+    engine = create_engine(database_url, **engine_options(database_url))
+    configure_engine(engine)
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    run = uuid.uuid4().hex[:8]
+    embedding = random_embeddings(1)[0]
+    template_matrix = random_embeddings(settings.TEMPLATE_MAX_SIZE)
+    created: List[str] = []
+
+    def create_user():
+        user_id = f"bench-{run}-{len(created)}"
+        crud.create_user(db, user_id, embedding, template_matrix)
+        created.append(user_id)
+
+    batch_size = settings.AUDIT_BATCH_SIZE
+
+    def audit_batch():
+        crud.bulk_insert_audit_records(db, [
+            {"user_id": created[i % len(created)], "access_type": "verification_success", "success": True,
+             "embedding": embedding, "similarity_score": 0.8}
+            for i in range(batch_size)
+        ], [], [])
+
+    try:
+        results = [result("crud_create_user", "crud", measure(create_user, repeat))]
+        user = itertools.cycle(created)
+        results.append(result(
+            "crud_get_user", "crud",
+            measure(lambda: crud.get_user(db, next(user)), repeat),
+        ))
+        results.append(result(
+            "crud_update_user_templates", "crud",
+            measure(lambda: crud.update_user_templates(db, next(user), template_matrix), repeat),
+        ))
+        results.append(result(
+            "crud_log_access_attempt", "crud",
+            measure(lambda: crud.log_access_attempt(
+                db, next(user), "verification_success", True,
+                embedding=embedding, similarity_score=0.8,
+            ), repeat),
+        ))
+        samples = measure(audit_batch, max(1, repeat // 10))
+        results.append(result(
+            f"crud_bulk_audit_{batch_size}", "crud", samples,
+            per_record_ms=round(float(np.mean(samples)) * 1000 / batch_size, 4),
+        ))
+        return results
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decode, embedding, scoring, gallery and database stages.")
+    parser.add_argument("--images", help="Labelled image directory (default: synthetic frames)")
+    parser.add_argument("--sizes", default="640,1280,3000", help="Synthetic frame sides for the decode stage")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--users", type=int, default=10000, help="Gallery size")
+    parser.add_argument("--database-url", help="Database for the crud stage (default: a temporary SQLite file)")
+    parser.add_argument("--stages", default="decode,embed,score,gallery,crud")
+    parser.add_argument("--skip-model", action="store_true", help="Skip the embed stage")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    stages = {stage.strip() for stage in args.stages.split(",") if stage.strip()}
+    if args.skip_model:
+        stages.discard("embed")
+
+    if args.images:
+        identities = load_identities(args.images, identities=8)
+        frames = {f"{identity}_{index}": data for identity, images in identities.items()
+                  for index, data in enumerate(images[:1])}
+        if not frames:
+            parser.error(f"No images found under {args.images}")
+    else:
+        frames = {f"{side}px": encode_jpeg(synthetic_image(side, seed=side))
+                  for side in (int(size) for size in args.sizes.split(",") if size.strip())}
+
+    results = []
+
+    def emit(stage_results: List[Dict]):
+        for stage_result in stage_results:
+            print(json.dumps(stage_result))
+        results.extend(stage_results)
+
+    if "decode" in stages:
+        emit(bench_decode(frames, args.repeat))
+    if "embed" in stages:
+        emit(bench_embed(frames, args.repeat))
+    if "score" in stages:
+        emit(bench_score(args.repeat))
+    if "gallery" in stages:
+        emit(bench_gallery(args.users, args.repeat))
+    if "crud" in stages:
+        if args.database_url:
+            emit(bench_crud(args.database_url, args.repeat))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                emit(bench_crud(f"sqlite:///{os.path.join(directory, 'bench.db')}", args.repeat))
+
+    if args.json:
+        write(args.json, "stages", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import numpy as np
+
+from app.ann import IVFIndex
+from app.db import crud
+
+
+def _unit_rows(rng, count: int, dim: int = 32) -> np.ndarray:
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _trained_index(vectors: np.ndarray, **kwargs) -> IVFIndex:
+    index = IVFIndex(nlist=16, min_train_size=len(vectors), **kwargs)
+    index._loaded = True
+    for row, vector in enumerate(vectors):
+        index.add(f"u{row}", vector)
+    assert index.trained
+    return index
+
+
+def test_untrained_index_is_an_exact_scan():
+    rng = np.random.default_rng(0)
+    vectors = _unit_rows(rng, 20)
+    index = IVFIndex(nlist=4)
+    index._loaded = True
+    for row, vector in enumerate(vectors):
+        index.add(f"u{row}", vector)
+    assert not index.trained
+    expected = np.argsort(-(vectors @ vectors[3]))[:3]
+    assert [user_id for user_id, _ in index.search(vectors[3], top_k=3)] == [f"u{i}" for i in expected]
+
+
+def test_recall_against_exact_search():
+    rng = np.random.default_rng(1)
+    vectors = _unit_rows(rng, 2000)
+    index = _trained_index(vectors, nprobe=4)
+    queries = vectors[rng.choice(len(vectors), 200, replace=False)] + 0.3 * _unit_rows(rng, 200)
+    hits = 0
+    for query in queries:
+        exact = f"u{int(np.argmax(vectors @ query))}"
+        hits += index.search(query, top_k=1)[0][0] == exact
+    assert hits / len(queries) >= 0.9
+    # Probing every list is exact
+    query = queries[0]
+    exact = np.argsort(-(vectors @ (query / np.linalg.norm(query))))[:5]
+    assert [user_id for user_id, _ in index.search(query, top_k=5, nprobe=16)] == [f"u{i}" for i in exact]
+
+
+def test_add_moves_and_remove_drops_a_user():
+    rng = np.random.default_rng(2)
+    vectors = _unit_rows(rng, 640)
+    index = _trained_index(vectors)
+    index.add("u0", -vectors[0])
+    assert len(index) == 640
+    assert index.search(-vectors[0], top_k=1, nprobe=16)[0][0] == "u0"
+    assert index.remove("u0") and "u0" not in index
+    assert index.search(-vectors[0], top_k=1, nprobe=16)[0][0] != "u0"
+
+
+def test_snapshot_round_trip(tmp_path):
+    rng = np.random.default_rng(3)
+    vectors = _unit_rows(rng, 640)
+    index = _trained_index(vectors)
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    restored = IVFIndex(nlist=16)
+    restored.restore(path)
+    assert len(restored) == 640 and restored.loaded
+    np.testing.assert_array_equal(restored.centroids, index.centroids)
+    for query in vectors[:10]:
+        assert restored.search(query, top_k=3) == index.search(query, top_k=3)
+
+
+def test_resync_picks_up_changes_made_by_other_workers(db):
+    rng = np.random.default_rng(4)
+    for row in range(4):
+        crud.create_user(db, f"u{row}", rng.standard_normal(8).astype(np.float32))
+    index = IVFIndex(nlist=2)
+    index.ensure_current(db, generation=0)
+    assert len(index) == 4
+
+    crud.deactivate_user(db, "u1")
+    crud.purge_user(db, "u2")
+    crud.create_user(db, "u9", np.ones(8, dtype=np.float32))
+
+    index.ensure_current(db, generation=0)
+    assert len(index) == 4  # Counter unchanged, no resync
+    index.ensure_current(db, generation=1)
+    assert {user_id for user_id, _ in index.search(np.ones(8), top_k=10)} == {"u0", "u3", "u9"}
@@ -0,0 +1,115 @@
+import glob
+import json
+import os
+import time
+
+import pytest
+
+from app.audit import AuditWriter
+
+
+class _Writer(AuditWriter):
+    """Writes to a list instead of the database; `fail` makes the next writes raise."""
+
+    def __init__(self, **kwargs):
+        # The thread only flushes when stopped, the tests flush by hand
+        kwargs.setdefault("flush_interval_ms", 60000)
+        super().__init__(batch_size=1000, **kwargs)
+        self.rows = []
+        self.fail = 0
+
+    def _write(self, batch):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("database unavailable")
+        if any(record["user_id"] == "poison" for _, record in batch):
+            raise ValueError("bad record")
+        self.rows.extend(record["user_id"] for _, record in batch)
+
+
+def _log(writer, *user_ids):
+    for user_id in user_ids:
+        writer.log_access_attempt(None, user_id, "verification", True)
+
+
+@pytest.fixture
+def writer(tmp_path):
+    writer = _Writer(spill_dir=str(tmp_path), max_retries=3)
+    yield writer
+    writer.stop()
+
+
+def _files(tmp_path, prefix):
+    return glob.glob(os.path.join(str(tmp_path), f"{prefix}-*.jsonl"))
+
+
+def test_flush_writes_the_batch_and_deletes_its_journal(writer, tmp_path):
+    _log(writer, "a", "b")
+    assert len(_files(tmp_path, "audit")) == 1
+    writer.flush()
+    assert writer.rows == ["a", "b"]
+    assert _files(tmp_path, "audit") == []
+    assert writer.stats()["written"] == 2
+
+
+def test_failed_batch_is_kept_and_retried(writer, tmp_path):
+    writer.fail = 1
+    _log(writer, "a")
+    writer.flush()
+    assert writer.rows == [] and writer.stats()["pending_retry"] == 1
+    # Not due yet; the journal segment stays until the retry succeeds
+    writer.flush()
+    assert writer.rows == [] and len(_files(tmp_path, "audit")) == 1
+    writer.flush(force=True)
+    assert writer.rows == ["a"] and writer.stats()["pending_retry"] == 0
+    assert _files(tmp_path, "audit") == []
+
+
+def test_record_that_keeps_failing_is_quarantined(writer, tmp_path):
+    _log(writer, "a", "poison", "b")
+    for _ in range(writer.max_retries):
+        writer.flush(force=True)
+    assert writer.rows == ["a", "b"]
+    assert writer.stats()["quarantined"] == 1 and writer.stats()["pending_retry"] == 0
+    [quarantine] = _files(tmp_path, "quarantine")
+    with open(quarantine) as f:
+        assert [json.loads(line)["record"]["user_id"] for line in f] == ["poison"]
+    assert _files(tmp_path, "audit") == []
+
+
+def test_journal_left_by_a_crash_is_replayed(tmp_path):
+    record = dict(user_id="a", access_type="verification", success=True)
+    segment = tmp_path / f"audit-{os.getpid()}-0-1.jsonl"
+    # A torn final line, as a crash mid-write leaves it, is ignored
+    segment.write_text(AuditWriter._journal_line("access_log", record) + '{"kind": "acc')
+
+    writer = _Writer(spill_dir=str(tmp_path))
+    writer.start()
+    writer.stop()
+    assert writer.rows == ["a"]
+    assert _files(tmp_path, "audit") == []
+
+
+def test_thread_survives_errors_and_is_restarted(tmp_path, monkeypatch):
+    writer = _Writer(spill_dir=str(tmp_path), flush_interval_ms=10)
+    broken = {"flush": True}
+    flush = writer.flush
+
+    def flaky_flush(force=False):
+        if broken.pop("flush", False):
+            raise OSError("disk full")
+        flush(force)
+
+    monkeypatch.setattr(writer, "flush", flaky_flush)
+    _log(writer, "a")
+    deadline = time.monotonic() + 5
+    while writer.rows != ["a"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.rows == ["a"]
+
+    # A writer thread that died anyway is started again by the next record
+    writer._stopping.set()
+    writer._thread.join()
+    _log(writer, "b")
+    writer.stop()
+    assert writer.rows == ["a", "b"]
@@ -0,0 +1,36 @@
+import json
+import sys
+
+from app import bulk_enroll, services
+from app.db import database
+
+
+class _Session:
+    def close(self):
+        pass
+
+
+def test_duplicate_reports_are_counted_and_written(tmp_path, monkeypatch, capsys):
+    for user_id in ("alice", "bob", "carol"):
+        (tmp_path / "src" / user_id).mkdir(parents=True)
+        (tmp_path / "src" / user_id / "1.jpg").write_bytes(b"jpeg")
+    statuses = {"alice": "enrolled", "bob": "duplicate", "carol": "rejected"}
+
+    def enroll_users_batch(db, chunk, **kwargs):
+        for user_id, images in chunk:
+            rejected = [{"index": 0, "reason": "No face detected"}] if statuses[user_id] == "rejected" else []
+            yield {"user_id": user_id, "status": statuses[user_id], "accepted_images": 1, "rejected_images": rejected}
+
+    monkeypatch.setattr(services, "enroll_users_batch", enroll_users_batch)
+    monkeypatch.setattr(database, "SessionLocal", _Session)
+    report_path = tmp_path / "report.jsonl"
+    monkeypatch.setattr(sys, "argv", ["bulk_enroll", str(tmp_path / "src"), "--report", str(report_path)])
+
+    bulk_enroll.main()
+
+    reports = [json.loads(line) for line in report_path.read_text().splitlines()]
+    assert [report["status"] for report in reports] == ["enrolled", "duplicate", "rejected"]
+    assert reports[2]["rejected_images"][0]["path"].endswith("carol/1.jpg")
+    assert "'duplicate': 1" in capsys.readouterr().out
+    # A re-run skips everyone already in the report
+    assert bulk_enroll.read_report(str(report_path)) == {"alice", "bob", "carol"}
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from app import calibration
+from app.db import crud
+
+
+def _centred(scores) -> np.ndarray:
+    """Scores moved to the centre of their bin, so no score sits on a threshold."""
+    bins = np.floor((np.asarray(scores) + 1.0) / calibration.BIN_WIDTH)
+    return -1.0 + (bins + 0.5) * calibration.BIN_WIDTH
+
+
+def test_rates_match_counting_scores_at_every_threshold():
+    rng = np.random.default_rng(0)
+    genuine = _centred(np.clip(rng.normal(0.6, 0.15, 500), -0.99, 0.99))
+    impostor = _centred(np.clip(rng.normal(0.0, 0.15, 2000), -0.99, 0.99))
+    thresholds, far, frr = calibration.rates(calibration.histogram(genuine), calibration.histogram(impostor))
+
+    assert len(thresholds) == calibration.SCORE_BINS + 1
+    assert far[0] == 1.0 and far[-1] == 0.0 and frr[0] == 0.0 and frr[-1] == 1.0
+    for index in range(0, len(thresholds), 97):
+        t = thresholds[index]
+        assert far[index] == pytest.approx(np.mean(impostor >= t))
+        assert frr[index] == pytest.approx(np.mean(genuine < t))
+
+
+def test_report_recommends_the_lowest_threshold_within_the_target_far():
+    genuine = calibration.histogram(_centred([0.8] * 4))
+    impostor = calibration.histogram(_centred([0.1] * 9 + [0.6]))
+    result = calibration.report(genuine, impostor, target_far=0.0, threshold=0.5)
+
+    assert result["genuine_pairs"] == 4 and result["impostor_pairs"] == 10
+    # Just above the highest impostor, which keeps every genuine attempt
+    assert 0.6 < result["recommended"]["threshold"] <= 0.6 + calibration.BIN_WIDTH
+    assert result["recommended"]["far"] == 0.0 and result["recommended"]["frr"] == 0.0
+    assert result["current"] == {"threshold": 0.5, "far": 0.1, "frr": 0.0, "tar": 1.0}
+    assert result["eer"] == 0.0 and 0.6 < result["eer_threshold"] <= 0.8
+
+    loose = calibration.report(genuine, impostor, target_far=0.1, threshold=0.5)
+    assert 0.1 < loose["recommended"]["threshold"] <= 0.1 + calibration.BIN_WIDTH
+    assert loose["recommended"]["far"] == 0.1
+
+
+def test_report_needs_both_kinds_of_scores():
+    empty = np.zeros(calibration.SCORE_BINS, dtype=np.int64)
+    with pytest.raises(ValueError, match="Not enough data"):
+        calibration.report(calibration.histogram([0.5]), empty, target_far=0.01)
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_score_histograms_counts_genuine_and_impostor_pairs(db):
+    alice, bob = _unit([1, 0, 0]), _unit([0, 1, 0])
+    # Alice's second template is a probe added by template refresh
+    probe = _unit([1, 1, 0])
+    crud.create_user(db, "alice", alice, np.stack([alice, probe]))
+    crud.create_user(db, "bob", bob, bob[None, :])
+    crud.log_access_attempt(db, "alice", "verification_success", True, embedding=probe)
+    crud.log_access_attempt(db, "bob", "verification_failed", False, embedding=_unit([0, 1, 1]))
+    crud.log_access_attempt(db, "carol", "verification_failed", False, embedding=alice)
+
+    # Bob's probe against Alice: her refreshed template with 'max', her enrollment centroid with 'centroid'
+    for strategy, bob_as_alice in (("max", 0.5), ("centroid", 0.0)):
+        genuine, impostor, stats = calibration.score_histograms(db, strategy=strategy)
+        assert stats == {"users": 2, "probes": 2, "skipped_probes": 1}
+        assert genuine.sum() == 2 and impostor.sum() == 2
+        # The probe's own template is left out: Alice's genuine score is cos 45 degrees, not 1
+        expected = calibration.histogram([np.sqrt(0.5), np.sqrt(0.5)])
+        np.testing.assert_array_equal(genuine, expected)
+        np.testing.assert_array_equal(impostor, calibration.histogram([np.sqrt(0.5), bob_as_alice]))
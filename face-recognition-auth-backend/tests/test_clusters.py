@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from app.core.config import settings
+from app.db import clusters, models
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def clustering(monkeypatch):
+    monkeypatch.setattr(settings, "UNKNOWN_CLUSTERING", True)
+    monkeypatch.setattr(settings, "UNKNOWN_CLUSTER_THRESHOLD", 0.5)
+    monkeypatch.setattr(clusters, "cluster_cache", clusters.ClusterCache())
+
+
+def _assign(db, *embeddings):
+    records = [{"embedding": np.asarray(embedding, dtype=np.float32)} for embedding in embeddings]
+    clusters.assign_attempts(db, records)
+    db.commit()
+    return [record.get("cluster_id") for record in records]
+
+
+def test_assign_labels_by_nearest_centroid_then_leaders():
+    centroids = np.stack([_unit([1, 0, 0])])
+    vectors = np.stack([_unit([1, 0.1, 0]), _unit([0, 1, 0]), _unit([0, 1, 0.1]), _unit([0, 0, 1])])
+    labels, seeds = clusters.assign(vectors, centroids, 0.9)
+    assert labels.tolist() == [0, 1, 1, 2]
+    assert seeds.tolist() == [1, 3]
+
+
+def test_assign_attempts_keeps_attempts_and_centroid_consistent(db, clustering):
+    faces = [_unit([1, 0.1 * i, 0]) for i in range(4)] + [_unit([0, 0, 1])]
+    ids = _assign(db, *faces[:2]) + _assign(db, *faces[2:])
+    assert ids[:4] == [ids[0]] * 4 and ids[4] != ids[0]
+
+    for cluster_id in set(ids):
+        members = [face for face, assigned in zip(faces, ids) if assigned == cluster_id]
+        cluster = db.get(models.UnknownCluster, cluster_id)
+        assert cluster.attempts == len(members)
+        # The stored centroid is a normalised running mean, close to the normalised sum
+        np.testing.assert_allclose(cluster.centroid, _unit(np.sum(members, axis=0)), atol=1e-3)
+
+
+def test_concurrent_processes_do_not_overwrite_each_other(db, monkeypatch, clustering):
+    first, second = clusters.ClusterCache(), clusters.ClusterCache()
+    monkeypatch.setattr(clusters, "cluster_cache", first)
+    [cluster_id] = _assign(db, [1, 0, 0])
+    monkeypatch.setattr(clusters, "cluster_cache", second)
+    assert _assign(db, [1, 0.2, 0]) == [cluster_id]
+
+    # The first process has not seen the second one's update yet
+    first.synced_at = datetime(3000, 1, 1)
+    monkeypatch.setattr(clusters, "cluster_cache", first)
+    assert _assign(db, [1, -0.2, 0]) == [cluster_id]
+
+    cluster = db.get(models.UnknownCluster, cluster_id)
+    db.refresh(cluster)
+    assert cluster.attempts == 3
+    expected = _unit(_unit([1, 0, 0]) + _unit([1, 0.2, 0]) + _unit([1, -0.2, 0]))
+    np.testing.assert_allclose(cluster.centroid, expected, atol=1e-3)
+
+
+def test_clustering_is_off_by_default(db, monkeypatch):
+    monkeypatch.setattr(clusters, "cluster_cache", clusters.ClusterCache())
+    assert _assign(db, [1, 0, 0]) == [None]
+    assert db.query(models.UnknownCluster).count() == 0
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytest
+
+from app.db import crud, models
+
+
+def _log(db, user_id: str, created_at: datetime):
+    db.add(models.AccessLog(user_id=user_id, access_type="verification", success=True, created_at=created_at))
+
+
+def test_keyset_cursor_walks_every_row_once_across_equal_timestamps(db):
+    same = datetime(2024, 1, 1, 12)
+    for index in range(7):
+        _log(db, f"u{index}", same if index < 4 else datetime(2024, 1, 1, 13, index))
+    db.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        page = crud.get_access_logs(db, limit=3, cursor=cursor)
+        seen += [row.id for row in page]
+        cursor = crud.next_cursor(page, 3)
+        if cursor is None:
+            break
+    newest_first = [row.id for row in db.query(models.AccessLog).order_by(
+        models.AccessLog.created_at.desc(), models.AccessLog.id.desc())]
+    assert seen == newest_first
+
+
+def test_next_cursor_is_none_on_a_short_page(db):
+    _log(db, "u0", datetime(2024, 1, 1))
+    db.commit()
+    page = crud.get_access_logs(db, limit=5)
+    assert len(page) == 1
+    assert crud.next_cursor(page, 5) is None
+
+
+def test_cursor_round_trip_and_invalid_cursor():
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    assert crud.decode_cursor(crud.encode_cursor(created_at, 42)) == (created_at, 42)
+    with pytest.raises(ValueError):
+        crud.decode_cursor("not-a-cursor")
+
+
+def test_iter_access_logs_streams_a_window_oldest_first(db):
+    for day in (3, 1, 2, 4):
+        _log(db, "u0", datetime(2024, 1, day))
+    _log(db, "u1", datetime(2024, 1, 2, 12))
+    db.commit()
+    rows = crud.iter_access_logs(db, since=datetime(2024, 1, 2), until=datetime(2024, 1, 4), batch_size=1)
+    assert [(row.user_id, row.created_at.day) for row in rows] == [("u0", 2), ("u1", 2), ("u0", 3)]
+    rows = crud.iter_access_logs(db, user_id="u1")
+    assert [row.user_id for row in rows] == ["u1"]
@@ -0,0 +1,56 @@
+import numpy as np
+
+from app import duplicates
+from app.db import crud, models
+
+
+def _unit_rows(rng, count: int, dim: int = 64) -> np.ndarray:
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _brute_force(vectors: np.ndarray, threshold: float) -> set:
+    scores = np.triu(vectors @ vectors.T, k=1)
+    return set(zip(*[axis.tolist() for axis in np.nonzero(scores >= threshold)]))
+
+
+def test_near_duplicate_pairs_recall_against_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = _unit_rows(rng, 2000)
+    # Plant 100 near-duplicates of random rows
+    sources = rng.choice(len(vectors), 100, replace=False)
+    noisy = vectors[sources] + 0.15 * _unit_rows(rng, 100)
+    vectors = np.vstack([vectors, noisy / np.linalg.norm(noisy, axis=1, keepdims=True)])
+
+    expected = _brute_force(vectors, 0.9)
+    assert len(expected) >= 100
+    first, second, similarity = duplicates.near_duplicate_pairs(vectors, 0.9, nprobe=3)
+    found = set(zip(first.tolist(), second.tolist()))
+    assert found <= expected  # Never a pair below the threshold
+    assert len(found) / len(expected) >= 0.95
+    assert np.all(first < second)
+    np.testing.assert_allclose(similarity, np.sum(vectors[first] * vectors[second], axis=1), rtol=1e-5)
+
+
+def test_near_duplicate_pairs_is_exact_with_every_block_probed():
+    rng = np.random.default_rng(1)
+    vectors = _unit_rows(rng, 300, dim=8)
+    first, second, _ = duplicates.near_duplicate_pairs(vectors, 0.8, nlist=5, nprobe=5)
+    assert set(zip(first.tolist(), second.tolist())) == _brute_force(vectors, 0.8)
+
+
+def test_clusters_join_pairs_transitively():
+    groups = duplicates.clusters(6, np.array([0, 1, 4]), np.array([1, 2, 5]))
+    assert groups == [[0, 1, 2], [4, 5]]
+
+
+def test_record_duplicates_skips_known_pairs_in_either_order(db):
+    def record(user_id, other):
+        return {"user_id": user_id, "duplicate_of": other, "similarity": 0.9, "status": "flagged", "source": "audit"}
+
+    assert crud.record_duplicates(db, [record("b", "a")]) == 1
+    # Known in the reverse order, repeated within the batch, and one new pair
+    assert crud.record_duplicates(db, [record("a", "b"), record("c", "a"), record("a", "c")]) == 1
+    pairs = {(row.user_id, row.duplicate_of) for row in db.query(models.DuplicateIdentity)}
+    assert pairs == {("b", "a"), ("c", "a")}
+    assert crud.get_duplicate_pairs(db, [("a", "b"), ("x", "y")]) == {("b", "a")}
@@ -0,0 +1,83 @@
+import numpy as np
+
+from app import embedding_cache as cache_module
+from app.embedding_cache import EmbeddingCache
+
+
+def _matrix(value: float) -> np.ndarray:
+    return np.full((1, 4), value, dtype=np.float32)
+
+
+def test_get_or_load_caches_until_invalidated():
+    cache = EmbeddingCache(max_size=10)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return _matrix(len(loads))
+
+    assert cache.get_or_load("alice", loader)[0, 0] == 1
+    assert cache.get_or_load("alice", loader)[0, 0] == 1
+    cache.invalidate("alice")
+    assert cache.get_or_load("alice", loader)[0, 0] == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_missing_users_are_not_cached():
+    cache = EmbeddingCache(max_size=10)
+    assert cache.get_or_load("ghost", lambda: None) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = EmbeddingCache(max_size=2)
+    for user_id in ("a", "b"):
+        cache.get_or_load(user_id, lambda: _matrix(1))
+    cache.get("a")
+    cache.get_or_load("c", lambda: _matrix(1))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    cache = EmbeddingCache(max_size=10, ttl_seconds=5)
+    cache.get_or_load("alice", lambda: _matrix(1))
+    now[0] += 4
+    assert cache.get("alice") is not None
+    now[0] += 2
+    assert cache.get("alice") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_value_loaded_across_an_invalidation_is_not_cached():
+    cache = EmbeddingCache(max_size=10)
+    _, epoch = cache.lookup("alice")
+    cache.invalidate("alice")  # Lands while the loader reads the old row
+    cache.store("alice", _matrix(1), epoch)
+    assert cache.get("alice") is None
+
+
+def test_invalidation_reaches_other_workers_through_the_shared_counter(tmp_path):
+    path = str(tmp_path / "generation")
+    first, second = EmbeddingCache(generation_path=path), EmbeddingCache(generation_path=path)
+    first.get_or_load("alice", lambda: _matrix(1))
+    second.get_or_load("alice", lambda: _matrix(1))
+    second.get_or_load("bob", lambda: _matrix(2))
+
+    first.invalidate("alice")
+    assert first.generation() == second.generation() == 1
+    # The other worker drops its whole cache on its next look
+    assert second.get("bob") is None
+    assert second.stats()["remote_clears"] == 1
+    # The invalidating worker keeps its other entries
+    first.get_or_load("bob", lambda: _matrix(2))
+    assert first.get("bob") is not None
+
+
+def test_disabled_cache_always_loads():
+    cache = EmbeddingCache(max_size=0)
+    assert cache.get_or_load("alice", lambda: _matrix(3))[0, 0] == 3
+    assert len(cache) == 0
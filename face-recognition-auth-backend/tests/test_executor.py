@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from app.executor import InferenceExecutor, Overloaded
+
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(max_workers=2, max_pending=1, name="test")
+    yield executor
+    executor.shutdown()
+
+
+def test_admission_rejects_past_workers_plus_pending(executor):
+    with executor.admit(), executor.admit(), executor.admit():
+        with pytest.raises(Overloaded):
+            with executor.admit():
+                pass
+        assert executor.stats()["in_flight"] == 3
+    # Slots are released when requests finish, even on errors
+    with pytest.raises(RuntimeError):
+        with executor.admit():
+            raise RuntimeError("handler failed")
+    with executor.admit():
+        pass
+    stats = executor.stats()
+    assert stats["in_flight"] == 0 and stats["peak_in_flight"] == 3
+    assert stats["admitted"] == 5 and stats["rejected"] == 1
+
+
+def test_run_uses_the_pool_and_keeps_the_callers_context(executor):
+    request_id = contextvars.ContextVar("request_id")
+
+    def work(value):
+        return threading.current_thread().name, request_id.get(), value * 2
+
+    async def handler():
+        request_id.set("r1")
+        return await executor.run(work, 21)
+
+    thread_name, seen, result = asyncio.run(handler())
+    assert thread_name.startswith("test") and seen == "r1" and result == 42
+
+
+def test_wait_awaits_a_concurrent_future(executor):
+    future: Future = Future()
+    threading.Timer(0.01, future.set_result, args=("done",)).start()
+    assert asyncio.run(executor.wait(future)) == "done"
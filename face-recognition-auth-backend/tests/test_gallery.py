@@ -0,0 +1,46 @@
+import numpy as np
+
+from app.db import crud
+from app.gallery import EmbeddingGallery, EmbeddingMatrix
+
+
+def test_top_k_is_exact_and_best_first():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((50, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    matrix = EmbeddingMatrix(initial_capacity=4)
+    matrix.extend([f"u{i}" for i in range(50)], vectors)
+    query = vectors[7]
+    expected = np.argsort(-(vectors @ query))[:5]
+    assert [user_id for user_id, _ in matrix.top_k(query, 5)] == [f"u{i}" for i in expected]
+
+
+def test_remove_keeps_the_matrix_dense():
+    matrix = EmbeddingMatrix()
+    for index, vector in enumerate(np.eye(3, dtype=np.float32)):
+        matrix.add(f"u{index}", vector)
+    assert matrix.remove("u0") and not matrix.remove("u0")
+    assert len(matrix) == 2 and "u0" not in matrix
+    # The last row moved into the freed slot still scores as itself
+    assert matrix.top_k(np.array([0, 0, 1], dtype=np.float32), 1) == [("u2", 1.0)]
+
+
+def test_resync_picks_up_changes_made_by_other_workers(db):
+    rng = np.random.default_rng(0)
+    for index in range(4):
+        crud.create_user(db, f"u{index}", rng.standard_normal(8).astype(np.float32))
+    gallery = EmbeddingGallery()
+    gallery.ensure_current(db, generation=0)
+    assert len(gallery) == 4
+
+    # Changes made elsewhere: this process's gallery was not told
+    crud.deactivate_user(db, "u1")
+    crud.purge_user(db, "u2")
+    crud.create_user(db, "u9", np.ones(8, dtype=np.float32))
+
+    gallery.ensure_current(db, generation=0)
+    assert len(gallery) == 4  # Counter unchanged, no resync
+    gallery.ensure_current(db, generation=1)
+    assert {user_id for user_id, _ in gallery.search(np.ones(8), top_k=10)} == {"u0", "u3", "u9"}
+    assert gallery.search(np.ones(8), top_k=1)[0][0] == "u9"
+    assert gallery.generation == 1
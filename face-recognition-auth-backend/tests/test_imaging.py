@@ -0,0 +1,50 @@
+import cv2
+import numpy as np
+import pytest
+
+from app import imaging
+from app.core.config import settings
+
+
+def _encode(extension: str, width: int, height: int) -> bytes:
+    return cv2.imencode(extension, np.zeros((height, width, 3), dtype=np.uint8))[1].tobytes()
+
+
+@pytest.mark.parametrize("extension, media_type", [(".jpg", "image/jpeg"), (".png", "image/png"), (".webp", "image/webp")])
+def test_accepts_supported_images(extension, media_type):
+    assert imaging.check_image_payload(_encode(extension, 64, 48)) == (media_type, (64, 48))
+
+
+def test_rejects_an_empty_payload():
+    with pytest.raises(ValueError, match="Empty"):
+        imaging.check_image_payload(b"")
+
+
+def test_rejects_a_payload_over_the_byte_limit(monkeypatch):
+    data = _encode(".png", 64, 64)
+    monkeypatch.setattr(settings, "MAX_IMAGE_BYTES", len(data) - 1)
+    with pytest.raises(ValueError, match="byte limit"):
+        imaging.check_image_payload(data)
+
+
+def test_rejects_an_unsupported_format():
+    with pytest.raises(ValueError, match="Unsupported"):
+        imaging.check_image_payload(b"%PDF-1.7" + bytes(32))
+
+
+def test_rejects_an_image_over_the_pixel_limit(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_IMAGE_PIXELS", 64 * 64 - 1)
+    with pytest.raises(ValueError, match="pixel limit"):
+        imaging.check_image_payload(_encode(".jpg", 64, 64))
+
+
+def test_rejects_a_truncated_header():
+    with pytest.raises(ValueError):
+        imaging.check_image_payload(_encode(".png", 8, 8)[:12])
+
+
+def test_base64_length_is_checked_before_decoding(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_IMAGE_BYTES", 30)
+    imaging.check_base64_length("A" * 40)
+    with pytest.raises(ValueError, match="byte limit"):
+        imaging.check_base64_length("A" * 48)
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app.inference import InferenceScheduler
+
+LANDMARKS = np.array([[[38, 52], [74, 52], [56, 72], [42, 92], [70, 92]]], dtype=np.float32)
+
+
+class _Detector:
+    """One face in frames with a non-zero pixel, none in blank frames."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def detect(self, image, input_size=None, max_num=0, metric=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if not image.any():
+            return np.zeros((0, 5)), None
+        return np.array([[10, 10, 100, 100, 0.9]]), LANDMARKS
+
+
+class _Recognizer:
+    input_size = (112, 112)
+
+    def __init__(self):
+        self.batches = []
+
+    def get_feat(self, crops):
+        self.batches.append(len(crops))
+        # Distinct per frame brightness; the scheduler normalizes it
+        return np.array([[crop.mean() / 255, 1.0] for crop in crops], dtype=np.float32)
+
+
+class _Analyzer:
+    def __init__(self, delay: float = 0.0):
+        self.det_model = _Detector(delay)
+        self.models = {"recognition": _Recognizer()}
+
+
+def _frame(value: int) -> np.ndarray:
+    return np.full((120, 120, 3), value, dtype=np.uint8)
+
+
+@pytest.fixture
+def scheduler():
+    schedulers = []
+
+    def make(analyzer, **kwargs):
+        scheduler = InferenceScheduler(analyzer, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def test_concurrent_frames_share_a_recognition_batch(scheduler):
+    analyzer = _Analyzer()
+    inference = scheduler(analyzer, max_batch_size=8, max_wait_ms=200, detection_workers=4)
+    futures = [inference.submit(_frame(value)) for value in (0, 50, 100, 150, 200)]
+    results = [future.result(timeout=5) for future in futures]
+
+    # The blank frame has no face and is left out of the recognition batch
+    assert results[0] is None
+    assert analyzer.models["recognition"].batches == [4]
+    embeddings = [embedding for embedding, _ in results[1:]]
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-6)
+    assert len({round(float(embedding[0]), 4) for embedding in embeddings}) == 4
+    assert results[1][1].shape == (112, 112, 3)
+    assert inference.stats()["batches"] == 1 and inference.stats()["jobs"] == 5
+
+
+def test_batches_are_capped_at_max_batch_size(scheduler):
+    inference = scheduler(_Analyzer(), max_batch_size=3, max_wait_ms=200, detection_workers=1)
+    futures = [inference.submit(_frame(100)) for _ in range(7)]
+    for future in futures:
+        future.result(timeout=5)
+    assert max(int(size) for size in inference.stats()["batch_size_histogram"]) <= 3
+    assert inference.stats()["jobs"] == 7
+
+
+def test_stop_fails_queued_jobs_instead_of_leaving_them_hanging(scheduler):
+    inference = scheduler(_Analyzer(delay=0.05), max_batch_size=1, max_wait_ms=0, detection_workers=1)
+    futures = [inference.submit(_frame(100)) for _ in range(20)]
+    time.sleep(0.02)
+    inference.stop()
+    assert all(future.done() for future in futures)
+    failed = [future for future in futures if future.exception() is not None]
+    assert failed and all("stopped" in str(future.exception()) for future in failed)
+    # Nothing left to pick up a frame submitted after stop; it fails at once
+    late = inference.submit(_frame(100))
+    inference.stop()
+    assert late.done()
+
+
+def test_detector_errors_fail_the_batch_not_the_scheduler(scheduler):
+    analyzer = _Analyzer()
+    inference = scheduler(analyzer, max_batch_size=8, max_wait_ms=0, detection_workers=1)
+    broken = threading.Event()
+    detect = analyzer.det_model.detect
+
+    def flaky(image, **kwargs):
+        if not broken.is_set():
+            broken.set()
+            raise RuntimeError("onnx failure")
+        return detect(image, **kwargs)
+
+    analyzer.det_model.detect = flaky
+    with pytest.raises(RuntimeError, match="onnx"):
+        inference.embed(_frame(100))
+    assert inference.embed(_frame(100)) is not None
@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pytest
+
+from app.db import crud, models
+from app.db.models import EmbeddingBlob, TemplateBlob
+
+
+def _unit(seed: int, dim: int = 512) -> np.ndarray:
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_embedding_blob_float32_round_trip_is_exact():
+    blob = EmbeddingBlob("float32")
+    vector = _unit(0)
+    encoded = blob.encode(vector)
+    assert len(encoded) == EmbeddingBlob.HEADER.size + vector.nbytes
+    np.testing.assert_array_equal(EmbeddingBlob.decode(encoded), vector)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float16", 1e-3), ("int8", 1e-2)])
+def test_embedding_blob_compact_dtypes_round_trip(dtype, tolerance):
+    vector = _unit(1)
+    decoded = EmbeddingBlob.decode(EmbeddingBlob(dtype).encode(vector))
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, vector, atol=tolerance)
+
+
+def test_embedding_blob_decodes_legacy_json_text():
+    vector = [0.25, -0.5, 1.0]
+    decoded = EmbeddingBlob.decode(json.dumps(vector))
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, np.array(vector, dtype=np.float32))
+
+
+def test_embedding_blob_rejects_unknown_encoding():
+    with pytest.raises(ValueError):
+        EmbeddingBlob.decode(b"XX" + bytes(64))
+
+
+def test_embedding_blob_rejects_unknown_dtype():
+    with pytest.raises(ValueError):
+        EmbeddingBlob("float64")
+
+
+def test_user_embedding_is_stored_as_a_blob(db):
+    vector = _unit(2)
+    crud.create_user(db, "alice", vector)
+    db.expire_all()
+    stored = db.get(models.User, "alice").embedding
+    assert stored.dtype == np.float32
+    np.testing.assert_allclose(stored, vector, atol=1e-2)
+
+
+def test_template_blob_round_trip_keeps_shape():
+    matrix = np.stack([_unit(seed, 128) for seed in range(3)])
+    for dtype in ("float32", "int8"):
+        decoded = TemplateBlob.decode(TemplateBlob(dtype).encode(matrix))
+        assert decoded.shape == matrix.shape
+        np.testing.assert_allclose(decoded, matrix, atol=1e-2)
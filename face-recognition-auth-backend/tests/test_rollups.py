@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import numpy as np
+
+from app.db import crud, models, rollups
+
+
+def _record(user_id: str, success: bool, created_at: datetime) -> dict:
+    return {"user_id": user_id, "access_type": "verification", "success": success, "created_at": created_at}
+
+
+def test_logged_attempts_update_user_and_global_counters(db):
+    crud.log_access_attempt(db, "alice", "verification", True)
+    crud.log_access_attempt(db, "alice", "verification", False)
+    crud.log_access_attempt(db, "bob", "verification", True)
+    crud.log_unknown_access(db, None)
+
+    assert crud.get_user_stats(db, "alice")["total_attempts"] == 2
+    assert crud.get_user_stats(db, "alice")["successful_attempts"] == 1
+    system = rollups.totals(db)
+    assert system["total_attempts"] == 3
+    assert system["successful_attempts"] == 2
+    assert system["unknown_attempts"] == 1
+
+
+def test_windows_sum_hour_and_day_buckets(db):
+    crud.bulk_insert_audit_records(db, [
+        _record("alice", True, datetime(2024, 1, 1, 9, 30)),
+        _record("alice", True, datetime(2024, 1, 1, 10, 5)),
+        _record("alice", False, datetime(2024, 1, 2, 10, 5)),
+    ], [], [])
+    hours = rollups.totals(db, "alice", since=datetime(2024, 1, 1, 10, 15), until=datetime(2024, 1, 2, 11))
+    assert hours["total_attempts"] == 2  # The 10:05 bucket counts whole
+    days = rollups.totals(db, "alice", since=datetime(2024, 1, 1), until=datetime(2024, 1, 2))
+    assert days["total_attempts"] == 2 and days["successful_attempts"] == 2
+    assert rollups.totals(db, "alice")["total_attempts"] == 3
+
+
+def test_backfill_matches_the_incremental_counters(db):
+    crud.create_user(db, "alice", np.ones(4, dtype=np.float32))
+    crud.bulk_insert_audit_records(db, [
+        _record("alice", True, datetime(2024, 1, 1, 9)),
+        _record("bob", False, datetime(2024, 1, 3, 18)),
+    ], [{"image_ref": None, "created_at": datetime(2024, 1, 2)}], [])
+    incremental = {scope: rollups.totals(db, scope) for scope in (rollups.GLOBAL, "alice", "bob")}
+
+    assert rollups.backfill(db, batch_size=1, max_pending_buckets=2) == 4
+    assert {scope: rollups.totals(db, scope) for scope in incremental} == incremental
+    assert db.query(models.AccessStats).count() > 0
+
+
+def test_rollup_totals_after_deactivate(db):
+    embedding = np.ones(4, dtype=np.float32)
+    crud.create_user(db, "alice", embedding)
+    crud.create_user(db, "bob", embedding)
+    assert rollups.totals(db)["enrolled_users"] == 2
+
+    assert crud.deactivate_user(db, "alice") is not None
+    assert rollups.totals(db)["enrolled_users"] == 1
+    # Deactivating again finds no active user and must not count twice
+    assert crud.deactivate_user(db, "alice") is None
+    assert rollups.totals(db)["enrolled_users"] == 1
+    assert crud.count_active_users(db) == 1
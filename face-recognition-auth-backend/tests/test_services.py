@@ -0,0 +1,32 @@
+import base64
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from app import services
+from app.core.config import settings
+
+
+def test_read_upload_reports_rejected_payloads_instead_of_raising():
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    data = cv2.imencode(".png", frame)[1].tobytes()
+    img_bytes, img, reason = services._read_upload(base64.b64encode(data).decode())
+    assert img_bytes == data and img.shape == frame.shape and reason is None
+
+    assert services._read_upload(b"%PDF-1.7" + bytes(32)) == (None, None, "Unsupported image format.")
+    # A valid header over an undecodable body
+    img_bytes, img, reason = services._read_upload(data[:40])
+    assert img_bytes == data[:40] and img is None and reason == "could not decode image"
+
+
+def test_centroid_scoring_uses_the_stored_centroid(monkeypatch):
+    # Templates pruned to two rows whose mean differs from the enrollment centroid
+    user = SimpleNamespace(
+        embedding=np.array([3.0, 4.0, 0.0], dtype=np.float32),
+        templates=np.array([[1, 0, 0], [0, 0, 1]], dtype=np.float32),
+    )
+    monkeypatch.setattr(settings, "TEMPLATE_SCORING", "centroid")
+    np.testing.assert_allclose(services._user_templates(user), [[0.6, 0.8, 0.0]])
+    monkeypatch.setattr(settings, "TEMPLATE_SCORING", "max")
+    assert services._user_templates(user) is user.templates
@@ -0,0 +1,38 @@
+import pytest
+
+from app.sharding import HashRing
+
+KEYS = [f"user-{index}" for index in range(5000)]
+SHARDS = {"a": "http://a", "b": "http://b", "c": "http://c"}
+
+
+def test_owner_is_deterministic_and_url_matches():
+    ring = HashRing(SHARDS)
+    again = HashRing(dict(reversed(list(SHARDS.items()))))
+    for key in KEYS[:100]:
+        assert ring.owner(key) == again.owner(key)
+        assert ring.url(key) == SHARDS[ring.owner(key)]
+
+
+def test_adding_a_shard_only_moves_keys_to_it():
+    old = HashRing(SHARDS)
+    new = HashRing({**SHARDS, "d": "http://d"})
+    moved = [key for key in KEYS if old.owner(key) != new.owner(key)]
+    assert all(new.owner(key) == "d" for key in moved)
+    # Roughly a quarter of the keys, not a reshuffle
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_a_shard_only_moves_its_keys():
+    old = HashRing(SHARDS)
+    new = HashRing({name: url for name, url in SHARDS.items() if name != "b"})
+    for key in KEYS:
+        if old.owner(key) != "b":
+            assert new.owner(key) == old.owner(key)
+        else:
+            assert new.owner(key) in ("a", "c")
+
+
+def test_empty_ring_has_no_owner():
+    with pytest.raises(LookupError):
+        HashRing({}).owner("user-1")
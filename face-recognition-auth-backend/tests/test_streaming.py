@@ -0,0 +1,39 @@
+from app.streaming import SlidingDecision
+
+
+def test_accepts_once_min_frames_reach_the_threshold():
+    decision = SlidingDecision(threshold=0.5, window=5, min_frames=3, max_frames=20)
+    assert decision.add(0.9) is None
+    assert decision.add(0.8) is None
+    assert decision.add(0.7) == (True, "confident")
+    assert decision.frames == 3
+
+
+def test_rejects_a_full_window_below_the_threshold():
+    decision = SlidingDecision(threshold=0.5, window=3, min_frames=2, max_frames=20)
+    assert decision.add(0.1) is None
+    assert decision.add(0.2) is None
+    assert decision.add(0.3) == (False, "confident")
+
+
+def test_a_low_frame_in_the_window_delays_the_decision():
+    decision = SlidingDecision(threshold=0.5, window=3, min_frames=2, max_frames=20)
+    assert decision.add(0.2) is None
+    # Mean 0.4 is below the threshold, but one frame matched
+    assert decision.add(0.6) is None
+    assert decision.add(0.9) == (True, "confident")
+
+
+def test_frames_without_a_face_count_towards_max_frames_only():
+    decision = SlidingDecision(threshold=0.5, window=3, min_frames=2, max_frames=3)
+    assert decision.add(None) is None
+    assert decision.add(None) is None
+    assert decision.similarity is None
+    assert decision.add(None) == (False, "max_frames")
+
+
+def test_min_frames_is_capped_by_the_window():
+    decision = SlidingDecision(threshold=0.5, window=2, min_frames=10, max_frames=20)
+    assert decision.min_frames == 2
+    assert decision.add(0.9) is None
+    assert decision.add(0.9) == (True, "confident")
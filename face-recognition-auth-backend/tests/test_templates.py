@@ -0,0 +1,52 @@
+import numpy as np
+
+from app import templates
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_build_normalizes_rows():
+    built = templates.build([np.array([3.0, 4.0]), np.array([0.0, 2.0])], max_size=5)
+    np.testing.assert_allclose(np.linalg.norm(built, axis=1), 1.0, rtol=1e-6)
+
+
+def test_build_prunes_the_most_redundant_rows():
+    near_a, near_b = _unit([1, 0.01, 0]), _unit([1, 0, 0.01])
+    distinct = [_unit([0, 1, 0]), _unit([0, 0, 1])]
+    built = templates.build([near_a, near_b] + distinct, max_size=3)
+    assert built.shape == (3, 3)
+    # One of the two near-duplicates goes; both distinct rows stay
+    for row in distinct:
+        assert np.isclose(built @ row, 1.0).any()
+    assert np.isclose(built @ near_a, 1.0).sum() + np.isclose(built @ near_b, 1.0).sum() == 1
+
+
+def test_refresh_skips_an_embedding_close_to_an_existing_template():
+    current = templates.build([_unit([1, 0, 0]), _unit([0, 1, 0])], max_size=4)
+    assert templates.refresh(current, _unit([1, 0.01, 0]), max_size=4, max_redundancy=0.95) is None
+
+
+def test_refresh_adds_a_new_embedding_below_the_cap():
+    current = templates.build([_unit([1, 0, 0])], max_size=4)
+    updated = templates.refresh(current, np.array([0.0, 0.0, 5.0]), max_size=4, max_redundancy=0.95)
+    assert updated.shape == (2, 3)
+    np.testing.assert_allclose(updated[-1], [0, 0, 1])
+
+
+def test_refresh_at_the_cap_replaces_the_most_redundant_template():
+    current = templates.build([_unit([1, 0, 0]), _unit([1, 0.2, 0]), _unit([0, 1, 0])], max_size=3)
+    updated = templates.refresh(current, _unit([0, 0, 1]), max_size=3, max_redundancy=0.99)
+    assert updated.shape == (3, 3)
+    assert np.isclose(updated @ _unit([0, 0, 1]), 1.0).any()
+    assert np.isclose(updated @ _unit([0, 1, 0]), 1.0).any()
+
+
+def test_score_strategies():
+    matrix = templates.build([_unit([1, 0]), _unit([0, 1])], max_size=2)
+    query = _unit([1, 0])
+    assert np.isclose(templates.score(matrix, query, "max"), 1.0)
+    assert np.isclose(templates.score(matrix, query, "topk_mean", top_k=2), 0.5)
+    assert np.isclose(templates.score(matrix, query, "centroid"), np.sqrt(0.5))
@@ -0,0 +1,50 @@
+import os
+import stat
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+from app import workers
+
+
+def test_socket_directory_is_made_private(tmp_path):
+    path = tmp_path / "pool"
+    path.mkdir(mode=0o755)
+    os.chmod(path, 0o755)
+    workers.private_directory(str(path))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+
+def test_a_file_in_place_of_the_socket_directory_is_refused(tmp_path):
+    path = tmp_path / "pool"
+    path.write_text("")
+    with pytest.raises(FileExistsError):
+        workers.private_directory(str(path))
+
+
+def test_authkey_is_new_on_every_start_and_owner_only(tmp_path):
+    address = str(tmp_path / "pool.sock")
+    first = workers.write_authkey(address)
+    second = workers.write_authkey(address)
+    assert first != second and len(second) == 32
+    assert workers.read_authkey(address) == second
+    key_path = tmp_path / workers.AUTHKEY_FILE
+    assert stat.S_IMODE(os.stat(key_path).st_mode) == 0o600
+
+
+def test_frame_embedding_and_crop_share_one_block_without_overlap():
+    shape, layout = (48, 64, 3), (512, (112, 112, 3))
+    shm = SharedMemory(create=True, size=workers.block_size(shape, layout))
+    try:
+        frame = workers._frame_view(shm, shape)
+        embedding = workers._embedding_view(shm, shape, layout)
+        crop = workers._crop_view(shm, shape, layout)
+        frame[:] = 7
+        embedding[:] = 0.5
+        crop[:] = 9
+        assert (frame == 7).all() and (embedding == 0.5).all() and (crop == 9).all()
+        del frame, embedding, crop
+    finally:
+        shm.close()
+        shm.unlink()